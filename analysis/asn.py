@@ -0,0 +1,293 @@
+"""
+Offline IPv4 to ASN (autonomous system) and hosting organization lookup.
+
+A local dump of announced prefixes (e.g. from RouteViews or iptoasn.com) is flattened into a table of disjoint,
+sorted address intervals, where each address maps to its longest (most specific) matching prefix. Lookups are a
+vectorized binary search (`np.searchsorted`) over the interval starts, so millions of addresses are annotated in well
+under a second. The table is saved as a `.npz` file next to the outputs and loaded instead of the dump while the dump
+is unchanged.
+"""
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from analysis.infrastructure import ipv4_to_int
+from utils.fileio import iter_lines
+
+
+logger = logging.getLogger(__name__)
+
+NO_ASN = 0  # ASN 0 is reserved, so it marks addresses outside of every prefix
+
+# Columns of the headerless ip2asn dumps of iptoasn.com (e.g. `ip2asn-v4-u32.tsv.gz`)
+IP2ASN_COLUMNS = ["start", "end", "asn", "country", "org"]
+
+
+def _parse_asn(values):
+    # 'AS13335' or 13335 -> 13335
+    return pd.to_numeric(pd.Series(values, dtype=object).astype(str).str.upper().str.removeprefix("AS"),
+                         errors="coerce").fillna(NO_ASN).astype(np.int64).to_numpy()
+
+
+def _parse_address(values):
+    # Dotted quads or integers (also as strings, e.g. '16777216') -> integers (-1 if invalid)
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values):
+        numbers, dotted = values, None
+    else:
+        dotted = ~values.astype(str).str.fullmatch(r"\d+").to_numpy()
+        numbers = pd.to_numeric(values.where(~dotted), errors="coerce")
+    numbers = numbers.to_numpy(dtype=np.float64)
+    ip_ints = np.where((numbers >= 0) & (numbers < 2**32), numbers, -1).astype(np.int64)
+    if dotted is not None and dotted.any():
+        ip_ints[dotted] = ipv4_to_int(values[dotted].to_numpy(dtype=object))
+    return ip_ints
+
+
+def _has_header(path, sep):
+    # A header has no address in its first field, unlike the rows of a headerless dump
+    first = next(iter_lines(path), "")
+    field = first.split(sep, 1)[0].strip().strip('"').partition("/")[0]
+    return _parse_address([field])[0] < 0
+
+
+def flatten_intervals(starts, ends, values):
+    """
+    Flatten nested address intervals into disjoint ones, where each address keeps the value of the narrowest interval
+    containing it (longest prefix match). Intervals must be nested or disjoint, as CIDR prefixes are.
+
+    Args:
+        starts (np.ndarray) : First address of each interval.
+        ends (np.ndarray) : Last address of each interval.
+        values (np.ndarray) : Value (e.g. row index) of each interval.
+
+    Returns:
+        starts, ends, values (np.ndarray) : The disjoint intervals, sorted by address.
+    """
+    order = np.lexsort((-ends, starts))  # Outer intervals before the intervals they contain
+    out_starts, out_ends, out_values = list(), list(), list()
+    stack = list()  # Open intervals, innermost last: (end, value)
+    pos = 0  # First address not emitted yet
+
+    def emit(start, end, value):
+        if start <= end:
+            out_starts.append(start)
+            out_ends.append(end)
+            out_values.append(value)
+
+    for s, e, v in zip(starts[order].tolist(), ends[order].tolist(), values[order].tolist()):
+        while stack and stack[-1][0] < s:
+            end, value = stack.pop()
+            emit(pos, end, value)
+            pos = max(pos, end + 1)
+        if stack:
+            emit(pos, s - 1, stack[-1][1])
+        pos = s
+        stack.append((e, v))
+    while stack:
+        end, value = stack.pop()
+        emit(pos, end, value)
+        pos = max(pos, end + 1)
+    return np.array(out_starts, dtype=np.int64), np.array(out_ends, dtype=np.int64), \
+        np.array(out_values, dtype=np.int64)
+
+
+class AsnIndex:
+    """
+    Disjoint, sorted address intervals with the ASN and organization of each.
+
+    Args:
+        starts (np.ndarray) : First address of each interval.
+        ends (np.ndarray) : Last address of each interval.
+        asns (np.ndarray) : ASN of each interval.
+        org_codes (np.ndarray) : Index in `orgs` of the organization of each interval.
+        orgs (list[str]) : Organization names.
+    """
+
+    def __init__(self, starts, ends, asns, org_codes, orgs):
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.asns = np.asarray(asns, dtype=np.int64)
+        self.org_codes = np.asarray(org_codes, dtype=np.int64)
+        self.orgs = np.asarray(orgs, dtype=object)
+
+    def __len__(self):
+        return len(self.starts)
+
+    @classmethod
+    def from_csv(cls, path, sep=",", names=None):
+        """
+        Build the index from a CSV file with either a `prefix` column (CIDR, e.g. '1.0.0.0/24') or `start` and `end`
+        columns (first and last address, dotted or as integers), an `asn` column ('13335' or 'AS13335') and an
+        optional `org` column. Rows with invalid addresses or prefixes are ignored.
+
+        Files without a header are read with the columns `names`, by default those of the ip2asn dumps of iptoasn.com
+        (`start`, `end`, `asn`, `country`, `org`).
+
+        Args:
+            path (str or Path) : Path to the file (possibly compressed, e.g. `.csv.gz`).
+            sep (str) : Field separator (e.g. '\\t' for TSV dumps).
+            names (list[str]) : Column names, for files without a header.
+        """
+        if names is None and not _has_header(path, sep):
+            names = IP2ASN_COLUMNS
+        df = pd.read_csv(path, sep=sep, names=names, header=0 if names is None else None, dtype=str,
+                         keep_default_na=False)
+        if "prefix" in df.columns:
+            parts = df["prefix"].str.partition("/")
+            address = parts[0]
+            length = pd.to_numeric(parts[2], errors="coerce").fillna(-1).astype(np.int64).to_numpy()
+            starts = _parse_address(address)
+            valid = (starts >= 0) & (length >= 0) & (length <= 32)
+            size = np.left_shift(1, 32 - np.clip(length, 0, 32), dtype=np.int64)
+            starts = starts & ~(size - 1)  # Host bits of sloppy prefixes (e.g. '1.0.0.1/24') are cleared
+            ends = starts + size - 1
+        else:
+            starts = _parse_address(df["start"])
+            ends = _parse_address(df["end"])
+            valid = (starts >= 0) & (ends >= starts)
+        org_codes, orgs = pd.factorize(df["org"] if "org" in df.columns else pd.Series("", index=df.index))
+        asns = _parse_asn(df["asn"])
+        valid &= asns != NO_ASN
+        if not valid.all():
+            logger.warning(f"{path}: ignoring {np.count_nonzero(~valid)} rows without a valid range or ASN")
+
+        rows = np.flatnonzero(valid)
+        starts, ends, rows = flatten_intervals(starts[rows], ends[rows], rows)
+        logger.info(f"Built an ASN index of {len(starts)} intervals from {len(df)} rows of {path}")
+        return cls(starts, ends, asns[rows], org_codes[rows], list(orgs))
+
+    def save(self, path, **extra):
+        """
+        Save the index to a `.npz` file, along with the arrays in `extra`.
+        """
+        path = Path(path)
+        path.parent.mkdir(exist_ok=True, parents=True)
+        encoded = [org.encode("utf-8") for org in self.orgs]
+        tmp_path = path.with_name(f"{path.stem}.tmp.npz")
+        np.savez(tmp_path, starts=self.starts, ends=self.ends, asns=self.asns, org_codes=self.org_codes,
+                 org_bytes=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+                 org_offsets=np.cumsum([0] + [len(e) for e in encoded]), **extra)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load an index saved by `save`.
+        """
+        with np.load(path) as data:
+            org_bytes = data["org_bytes"].tobytes()
+            offsets = data["org_offsets"].tolist()
+            orgs = [org_bytes[a:b].decode("utf-8") for a, b in zip(offsets[:-1], offsets[1:])]
+            return cls(data["starts"], data["ends"], data["asns"], data["org_codes"], orgs)
+
+    def lookup(self, ip_ints):
+        """
+        Find the interval of each address.
+
+        Args:
+            ip_ints (np.ndarray) : Integer addresses (negative values are invalid, see `ipv4_to_int`).
+
+        Returns:
+            intervals (np.ndarray) : Index of the interval of each address, or -1 if no prefix contains it.
+        """
+        ip_ints = np.asarray(ip_ints, dtype=np.int64)
+        i = np.searchsorted(self.starts, ip_ints, side="right") - 1
+        found = (i >= 0) & (ip_ints >= 0)
+        found[found] = ip_ints[found] <= self.ends[i[found]]
+        return np.where(found, i, -1)
+
+    def annotate(self, ipaddrs):
+        """
+        Returns the ASN and organization of IPv4 addresses.
+
+        Args:
+            ipaddrs (array-like of str) : Dotted-quad addresses. Anything else (e.g. IPv6 or 'UNKNOWN') is not found.
+
+        Returns:
+            r (DataFrame) : Columns `asn` (0 if not found) and `as_org` (empty if not found), one row per address.
+        """
+        i = self.lookup(ipv4_to_int(ipaddrs))
+        if len(self) == 0:
+            return pd.DataFrame({"asn": np.full(len(i), NO_ASN, dtype=np.int64), "as_org": np.full(len(i), "", object)})
+        found = i >= 0
+        orgs = np.append(self.orgs, "")
+        return pd.DataFrame({"asn": np.where(found, self.asns[i], NO_ASN),
+                             "as_org": orgs[np.where(found, self.org_codes[i], -1)]})
+
+    def annotate_records(self, records, batch_size=10000):
+        """
+        Add the ASN (`asnlist`) and organization (`orglist`) of each IP address of `source_IPs.jsonl` records, in the
+        order of their `ipaddrlist`.
+
+        Args:
+            records (iterable[dict]) : The records. They are updated.
+            batch_size (int) : Records looked up at once.
+
+        Returns:
+            records (generator[dict]) : The annotated records.
+        """
+        batch = list()
+        for record in records:
+            batch.append(record)
+            if len(batch) == batch_size:
+                yield from self._annotate_batch(batch)
+                batch = list()
+        yield from self._annotate_batch(batch)
+
+    def _annotate_batch(self, batch):
+        ipaddrs = [ip for record in batch for ip in record["ipaddrlist"]]
+        if not ipaddrs:
+            yield from batch
+            return
+        annotated = self.annotate(ipaddrs)
+        asns, orgs = annotated["asn"].tolist(), annotated["as_org"].tolist()
+        pos = 0
+        for record in batch:
+            n = len(record["ipaddrlist"])
+            record["asnlist"] = asns[pos:pos + n]
+            record["orglist"] = orgs[pos:pos + n]
+            pos += n
+            yield record
+
+
+def load_asn_index(prefixes_path, index_path, names=None):
+    """
+    Returns the index of the prefix dump at `prefixes_path`, loaded from `index_path` if it was built from the current
+    version of the dump, or else built and saved to `index_path`. `names` are the columns of a dump without a header
+    (see `AsnIndex.from_csv`).
+    """
+    prefixes_path, index_path = Path(prefixes_path), Path(index_path)
+    sep = "\t" if ".tsv" in prefixes_path.suffixes else ","
+    stat = prefixes_path.stat()
+    key = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    # How the dump is read also determines the index
+    read_key = np.array([sep, json.dumps(list(names) if names is not None else None)])
+    if index_path.exists():
+        with np.load(index_path) as data:
+            fresh = "source_key" in data and np.array_equal(data["source_key"], key) and \
+                "read_key" in data and np.array_equal(data["read_key"], read_key)
+        if fresh:
+            return AsnIndex.load(index_path)
+    index = AsnIndex.from_csv(prefixes_path, sep=sep, names=names)
+    # Record which version of the dump the index was built from, and how
+    index.save(index_path, source_key=key, read_key=read_key)
+    return index
+
+
+def index_from_config(config):
+    """
+    Returns the ASN index set up in the `asn` section of the config, or `None` if there is none.
+    Relative paths of prefix dumps are relative to the data directory.
+    """
+    settings = config.get("asn", None) or dict()
+    if not settings.get("prefixes", None):
+        return None
+    prefixes_path = Path(config.path.data).joinpath(settings["prefixes"])
+    if not prefixes_path.exists():
+        logger.warning(f"ASN prefix dump {prefixes_path} not found, skipping the ASN annotations")
+        return None
+    return load_asn_index(prefixes_path, settings.get("index", "asn_index.npz"), names=settings.get("columns", None))
@@ -0,0 +1,227 @@
+"""
+Shared-infrastructure clustering of sources.
+
+Sources that resolve to the same IP address, or to addresses in the same /24 or /16 network, are likely hosted
+together. This module groups sources by IP and by prefix, and finds clusters of sources connected through shared
+hosting as the connected components of the source-IP bipartite graph. Clusters that mix sources of known networks
+with `UNKNOWN` sources point at outlets that may belong to a network without being listed in it.
+"""
+import logging
+import socket
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.config import init_workspace
+from utils.registry import SourceRegistry
+
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN = "UNKNOWN"
+
+
+def ipv4_to_int(ipaddrs):
+    """
+    Encode dotted-quad IPv4 addresses as integers.
+
+    Args:
+        ipaddrs (array-like of str) : IP addresses.
+
+    Returns:
+        ip_ints (np.ndarray) : int64 array with the encoded addresses, and -1 for invalid (or IPv6) addresses.
+    """
+    # Sources share few addresses, so only the distinct strings are parsed
+    codes, uniques = pd.factorize(pd.Series(ipaddrs, dtype=object))
+    ip_ints = np.fromiter(map(_parse_dotted_quad, uniques), dtype=np.int64, count=len(uniques))
+    ip_ints = np.append(ip_ints, -1)  # Missing values have code -1
+    return ip_ints[codes]
+
+
+def _parse_dotted_quad(ipaddr):
+    # Strict dotted quad (no leading zeros or spaces) -> integer, or -1
+    try:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET, ipaddr), "big")
+    except (OSError, TypeError):
+        return -1
+
+
+def int_to_prefix(ip_ints, bits):
+    """
+    Format integer addresses as CIDR prefixes of length `bits` (e.g. '10.0.1.0/24').
+    """
+    ip_ints = (np.asarray(ip_ints, dtype=np.int64) >> (32 - bits)) << (32 - bits)
+    octets = [(ip_ints >> shift) & 255 for shift in (24, 16, 8, 0)]
+    return pd.Series(octets[0]).astype(str) + "." + pd.Series(octets[1]).astype(str) + "." + \
+        pd.Series(octets[2]).astype(str) + "." + pd.Series(octets[3]).astype(str) + f"/{bits}"
+
+
+def connected_components(n, a, b):
+    """
+    Label the connected components of a graph with an array-backed union-find.
+
+    Edges are merged in bulk: every round hooks the root of each edge's larger endpoint onto the smaller root with
+    `np.minimum.at`, then compresses all paths by pointer jumping, until no edge joins two different roots.
+
+    Args:
+        n (int) : Number of nodes.
+        a (np.ndarray) : First endpoint of each edge.
+        b (np.ndarray) : Second endpoint of each edge.
+
+    Returns:
+        labels (np.ndarray) : Component label of each node (the smallest node id in its component).
+    """
+    parent = np.arange(n, dtype=np.int64)
+    a = np.asarray(a, dtype=np.int64)
+    b = np.asarray(b, dtype=np.int64)
+    while True:
+        ra, rb = parent[a], parent[b]
+        joined = ra != rb
+        if not joined.any():
+            return parent
+        a, b = a[joined], b[joined]  # Edges inside a component never matter again
+        lo, hi = np.minimum(ra[joined], rb[joined]), np.maximum(ra[joined], rb[joined])
+        np.minimum.at(parent, hi, lo)
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+
+def _pairs(df):
+    # Unique (source, network, ip_int) rows with a valid IPv4 address
+    df = df[["source", "network", "ipaddr"]].copy()
+    df["ip_int"] = ipv4_to_int(df["ipaddr"].to_numpy())
+    return df[df["ip_int"] >= 0].drop_duplicates(["source", "ip_int"])
+
+
+def _join_groups(df, key, column):
+    # ','.join of the sorted `column` values of each `key`, without a Python-level groupby per group
+    df = df.sort_values([key, column])
+    keys, values = df[key].to_numpy(), df[column].to_numpy().tolist()
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=np.int64)
+    ends = np.r_[starts[1:], len(keys)]
+    return pd.Series([",".join(values[a:b]) for a, b in zip(starts, ends)], index=keys[starts], dtype=object)
+
+
+def _summarize(pairs, key, min_sources):
+    # Per-group counts, known networks and the mixed known/UNKNOWN flag, for groups with at least `min_sources`
+    memberships = pairs.drop_duplicates([key, "source"])
+    n_sources = memberships.groupby(key).size()
+    keep = n_sources.index[n_sources >= min_sources]
+    pairs = pairs[pairs[key].isin(keep)]
+    memberships = memberships[memberships[key].isin(keep)]
+
+    summary = pd.DataFrame({"n_sources": n_sources[keep], "n_ips": pairs.groupby(key)["ip_int"].nunique()})
+    unknown = memberships["network"] == UNKNOWN
+    summary["n_unknown"] = memberships[unknown].groupby(key).size()
+    summary["n_unknown"] = summary["n_unknown"].fillna(0).astype(np.int64)
+    known = memberships[~unknown].drop_duplicates([key, "network"])
+    summary["networks"] = _join_groups(known, key, "network")
+    summary["networks"] = summary["networks"].fillna("")
+    summary["sources"] = _join_groups(memberships, key, "source")
+    summary["unknown_with_known"] = (summary["n_unknown"] > 0) & (summary["networks"] != "")
+    return summary.sort_values("n_sources", ascending=False)
+
+
+def group_by_prefix(df, bits=32, min_sources=2):
+    """
+    Group sources by exact IP (`bits=32`) or by network prefix (e.g. `bits=24`).
+
+    Args:
+        df (DataFrame) : One row per (source, IP) pair, with columns `source`, `network` and `ipaddr`.
+        bits (int) : Prefix length.
+        min_sources (int) : Only keep groups with at least this many sources.
+
+    Returns:
+        groups (DataFrame) : One row per prefix with `n_sources`, `n_ips`, `n_unknown`, `networks`, `sources` and
+            `unknown_with_known`, sorted by decreasing number of sources.
+    """
+    pairs = _pairs(df)
+    pairs["prefix"] = pairs["ip_int"].to_numpy() >> (32 - bits)
+    summary = _summarize(pairs, "prefix", min_sources)
+    summary.index = int_to_prefix(summary.index.to_numpy() << (32 - bits), bits).to_numpy()
+    summary.index.name = "prefix"
+    return summary
+
+
+def group_by_asn(df, asn_index, min_sources=2):
+    """
+    Group sources by the autonomous system (hosting provider) of their IP addresses.
+
+    Args:
+        df (DataFrame) : One row per (source, IP) pair, with columns `source`, `network` and `ipaddr`.
+        asn_index (analysis.asn.AsnIndex) : The ASN of each address.
+        min_sources (int) : Only keep groups with at least this many sources.
+
+    Returns:
+        groups (DataFrame) : One row per ASN with `as_org` and the columns of `group_by_prefix`, sorted by decreasing
+            number of sources. Addresses outside of every prefix of the index are left out.
+    """
+    pairs = _pairs(df)
+    intervals = asn_index.lookup(pairs["ip_int"].to_numpy())
+    pairs = pairs[intervals >= 0].assign(asn=asn_index.asns[intervals[intervals >= 0]])
+    summary = _summarize(pairs, "asn", min_sources)
+    orgs = dict(zip(asn_index.asns.tolist(), asn_index.orgs[asn_index.org_codes].tolist()))
+    summary.insert(0, "as_org", [orgs[asn] for asn in summary.index.tolist()])
+    return summary
+
+
+def cluster_sources(df, bits=32):
+    """
+    Cluster sources connected through shared hosting.
+
+    Builds the bipartite graph between sources and IP addresses (or prefixes of length `bits`) and labels its
+    connected components, so two sources are in the same cluster if a chain of shared addresses links them.
+
+    Args:
+        df (DataFrame) : One row per (source, IP) pair, with columns `source`, `network` and `ipaddr`.
+        bits (int) : Link sources through exact IPs (32) or through prefixes of this length.
+
+    Returns:
+        clusters (DataFrame) : One row per cluster with at least two sources, with `n_sources`, `n_ips`,
+            `n_unknown`, `networks`, `sources` and `unknown_with_known`, sorted by decreasing number of sources.
+        assignments (DataFrame) : Cluster of each source, with columns `source`, `network` and `cluster`.
+    """
+    pairs = _pairs(df)
+    source_ids, sources = pd.factorize(pairs["source"])
+    ip_ids, ips = pd.factorize(pairs["ip_int"].to_numpy() >> (32 - bits))
+    labels = connected_components(len(sources) + len(ips), source_ids, ip_ids + len(sources))
+
+    pairs["cluster"] = labels[source_ids]
+    clusters = _summarize(pairs, "cluster", min_sources=2)
+    assignments = pairs.drop_duplicates("source")[["source", "network", "cluster"]].reset_index(drop=True)
+    return clusters, assignments
+
+
+def main(config):
+    """
+    Cluster the sources of the registry by shared hosting and write the tables to `infrastructure/`.
+    """
+    output_dir = Path("infrastructure")
+    output_dir.mkdir(exist_ok=True, parents=True)
+    with SourceRegistry(config.get("registry", {}).get("path", "registry.db")) as registry:
+        df = registry.source_ips()
+
+    clusters, assignments = cluster_sources(df)
+    clusters.to_csv(output_dir.joinpath("clusters_ip.csv"))
+    assignments.to_csv(output_dir.joinpath("source_clusters_ip.csv"), index=None)
+    logger.info(f"Found {len(clusters)} shared-IP clusters, "
+                f"{clusters['unknown_with_known'].sum()} with UNKNOWN sources next to known networks")
+    for bits in (32, 24, 16):
+        groups = group_by_prefix(df, bits)
+        groups.to_csv(output_dir.joinpath(f"groups_prefix{bits}.csv"))
+        logger.info(f"/{bits}: {len(groups)} groups shared by 2+ sources")
+
+    from analysis.asn import index_from_config  # analysis.asn imports this module
+    asn_index = index_from_config(config)
+    if asn_index is not None:
+        groups = group_by_asn(df, asn_index)
+        groups.to_csv(output_dir.joinpath("groups_asn.csv"))
+        logger.info(f"ASN: {len(groups)} autonomous systems shared by 2+ sources")
+
+
+if __name__ == "__main__":
+    main(init_workspace(config_path="config/config.yaml", do_chdir=True))
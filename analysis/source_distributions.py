@@ -4,19 +4,28 @@ from pathlib import Path
 
 
 from utils.config import init_workspace
+from utils.registry import SourceRegistry
 
 
 logger = logging.getLogger(__name__)
 
 
-if __name__ == "__main__":
-    config = init_workspace(config_path="config/config.yaml", do_chdir=True)
-    input_file = config.path.data.joinpath("source_network_ip.csv")
+def main(config):
+    """
+    Print the number of distinct IP addresses of each network.
+    """
+    registry_path = Path(config.get("registry", {}).get("path", "registry.db"))
     print(Path.cwd())
-    df = pd.read_csv(input_file, header=None)
-    df.columns = ['source', 'network', 'ipaddr']
+    with SourceRegistry(registry_path) as registry:
+        # One row per (source, IP) pair, including every address seen over time
+        df = registry.source_ips()
+    df = df[df['ipaddr'] != 'UNKNOWN']
 
     g = df.groupby(['network'])
     unique_ips = g['ipaddr'].unique()
     n_unique_ips = g['ipaddr'].nunique()
-    print(n_unique_ips)
\ No newline at end of file
+    print(n_unique_ips)
+
+
+if __name__ == "__main__":
+    main(init_workspace(config_path="config/config.yaml", do_chdir=True))
@@ -0,0 +1,240 @@
+"""
+Out-of-core, parallel per-source and per-network statistics of `newsdata`.
+
+The table is split into rowid ranges, and each range is aggregated by a worker process with its own read-only
+connection, reading the range in chunks. Workers produce `Partial` aggregates, which are merged as they complete:
+
+    - number of articles,
+    - first and last publication time,
+    - hour-of-week histogram of publication times (cadence),
+    - HyperLogLog sketch of the distinct URLs.
+
+Every aggregate is a count, a min, a max or a register-wise max, so partials merge exactly in any order, and memory is
+bounded by the number of groups rather than the number of rows.
+"""
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.config import init_workspace
+from utils.db import get_connection, iter_query_pandas
+from utils.instrument import span
+
+
+logger = logging.getLogger(__name__)
+
+GROUPS = ("source", "network")
+HOURS_PER_WEEK = 168
+
+_NO_TIME_MIN = np.iinfo(np.int64).max
+_NO_TIME_MAX = np.iinfo(np.int64).min
+
+
+def hour_of_week(published_utc):
+    """
+    Returns the hour of the week (0 is Monday 00:00 UTC, 167 is Sunday 23:00 UTC) of UTC timestamps.
+    """
+    hours = np.asarray(published_utc, dtype=np.int64) // 3600
+    # 1970-01-01 was a Thursday
+    return ((hours // 24 + 3) % 7) * 24 + hours % 24
+
+
+def hll_update(registers, codes, hashes, precision):
+    """
+    Add 64-bit hashes to HyperLogLog sketches.
+
+    Args:
+        registers (np.ndarray) : uint8 array of shape (n_groups, 2**precision), updated in place.
+        codes (np.ndarray) : Group of each hash.
+        hashes (np.ndarray) : uint64 hashes.
+        precision (int) : Number of hash bits that select the register.
+    """
+    index = (hashes >> np.uint64(64 - precision)).astype(np.int64)
+    rest = hashes << np.uint64(precision)
+    # Rank of the first set bit of the remaining bits, from 1 (frexp gives the bit length)
+    _, bit_length = np.frexp(rest.astype(np.float64))
+    rank = np.where(rest == 0, 64 - precision + 1, 64 - bit_length + 1).astype(np.uint8)
+    np.maximum.at(registers, (codes, index), rank)
+
+
+def hll_estimate(registers):
+    """
+    Returns the HyperLogLog estimate of the number of distinct values of each sketch (rows of `registers`).
+    """
+    m = registers.shape[1]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.exp2(-registers.astype(np.float64)), axis=1)
+    zeros = np.count_nonzero(registers == 0, axis=1)
+    # Linear counting is more accurate for small cardinalities
+    small = (estimate <= 2.5 * m) & (zeros > 0)
+    linear = m * np.log(m / np.maximum(zeros, 1))
+    return np.round(np.where(small, linear, estimate)).astype(np.int64)
+
+
+class Partial:
+    """
+    Mergeable aggregates of the articles of each group (e.g. each source).
+
+    Args:
+        keys (np.ndarray) : Group names.
+        precision (int) : HyperLogLog precision (2**precision registers per group).
+    """
+
+    def __init__(self, keys, precision=12):
+        n = len(keys)
+        self.keys = np.asarray(keys, dtype=object)
+        self.precision = precision
+        self.count = np.zeros(n, dtype=np.int64)
+        self.first = np.full(n, _NO_TIME_MIN, dtype=np.int64)
+        self.last = np.full(n, _NO_TIME_MAX, dtype=np.int64)
+        self.hist = np.zeros((n, HOURS_PER_WEEK), dtype=np.int64)
+        self.hll = np.zeros((n, 1 << precision), dtype=np.uint8)
+
+    @classmethod
+    def from_frame(cls, df, column, precision=12):
+        """
+        Aggregate a chunk of `newsdata` (columns `column`, `published_utc` and `url`) by `column`.
+        """
+        codes, keys = pd.factorize(df[column].fillna(""))
+        partial = cls(keys, precision)
+        partial.count += np.bincount(codes, minlength=len(keys))
+
+        published = df["published_utc"]
+        timed = published.notna().to_numpy()
+        t = published[timed].to_numpy(dtype=np.int64)
+        np.minimum.at(partial.first, codes[timed], t)
+        np.maximum.at(partial.last, codes[timed], t)
+        np.add.at(partial.hist, (codes[timed], hour_of_week(t)), 1)
+
+        urls = df["url"]
+        has_url = urls.notna().to_numpy()
+        hashes = pd.util.hash_array(urls[has_url].to_numpy(dtype=object))
+        hll_update(partial.hll, codes[has_url], hashes, precision)
+        return partial
+
+    def merge(self, other):
+        """
+        Returns the aggregates of the union of the articles of `self` and `other`.
+        """
+        keys = pd.Index(self.keys).union(pd.Index(other.keys))
+        merged = Partial(keys.to_numpy(dtype=object), self.precision)
+        for part in (self, other):
+            pos = keys.get_indexer(part.keys)
+            merged.count[pos] += part.count
+            merged.first[pos] = np.minimum(merged.first[pos], part.first)
+            merged.last[pos] = np.maximum(merged.last[pos], part.last)
+            merged.hist[pos] += part.hist
+            merged.hll[pos] = np.maximum(merged.hll[pos], part.hll)
+        return merged
+
+    def to_frame(self, column):
+        """
+        Returns the statistics of each group, and its hour-of-week histogram.
+
+        Returns:
+            stats (DataFrame) : `articles`, `first_published`, `last_published` (UTC timestamps), `active_days`,
+                `articles_per_day`, `distinct_urls` (estimated), `peak_hour_of_week` and `weekend_share`, indexed
+                by `column`, sorted by decreasing number of articles.
+            cadence (DataFrame) : Articles published in each hour of the week, with columns 0 (Monday 00:00 UTC)
+                to 167.
+        """
+        untimed = self.first == _NO_TIME_MIN
+        active_days = np.where(untimed, 1, (self.last - self.first) // 86400 + 1)
+        stats = pd.DataFrame({
+            "articles": self.count,
+            # Groups without publication times get missing values
+            "first_published": pd.arrays.IntegerArray(np.where(untimed, 0, self.first), untimed),
+            "last_published": pd.arrays.IntegerArray(np.where(untimed, 0, self.last), untimed),
+            "active_days": pd.arrays.IntegerArray(active_days, untimed.copy()),
+        }, index=pd.Index(self.keys, name=column))
+        stats["articles_per_day"] = self.hist.sum(axis=1) / active_days
+        stats["distinct_urls"] = hll_estimate(self.hll)
+        stats["peak_hour_of_week"] = self.hist.argmax(axis=1)
+        stats["weekend_share"] = self.hist[:, 5 * 24:].sum(axis=1) / np.maximum(self.hist.sum(axis=1), 1)
+        cadence = pd.DataFrame(self.hist, index=stats.index)
+        order = np.argsort(-self.count, kind="stable")
+        return stats.iloc[order], cadence.iloc[order]
+
+
+def rowid_ranges(db_path, n_ranges):
+    """
+    Split the rowids of `newsdata` into at most `n_ranges` contiguous (start, end] ranges of similar width.
+    """
+    lo, hi = get_connection(db_path).execute("SELECT min(rowid), max(rowid) FROM newsdata").fetchone()
+    if lo is None:
+        return []
+    bounds = np.unique(np.linspace(lo - 1, hi, n_ranges + 1).astype(np.int64))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def aggregate_range(db_path, start, end, precision=12, chunksize=100000):
+    """
+    Aggregate the `newsdata` rows with `start < rowid <= end` by source and by network.
+
+    Returns:
+        partials (dict[str,Partial]) : Aggregates per grouping column.
+    """
+    partials = {column: Partial([], precision) for column in GROUPS}
+    chunks = iter_query_pandas(db_path, "SELECT source, network, published_utc, url FROM newsdata "
+                                        "WHERE rowid > ? AND rowid <= ?", (start, end), chunksize=chunksize)
+    for df in chunks:
+        for column in GROUPS:
+            partials[column] = partials[column].merge(Partial.from_frame(df, column, precision))
+    return partials
+
+
+def source_stats(db_path, workers=None, ranges_per_worker=4, precision=12, chunksize=100000):
+    """
+    Compute per-source and per-network statistics of `newsdata` in parallel (see `Partial.to_frame`).
+
+    Args:
+        db_path (str or Path) : Path to the NELA database.
+        workers (int) : Number of worker processes (default: CPU count).
+        ranges_per_worker (int) : Rowid ranges per worker. More ranges balance the load better.
+        precision (int) : HyperLogLog precision. The relative error of `distinct_urls` is about 1.04 / 2**(p/2).
+        chunksize (int) : Rows read at a time by each worker.
+
+    Returns:
+        partials (dict[str,Partial]) : Merged aggregates per grouping column ('source' and 'network').
+    """
+    workers = workers or os.cpu_count() or 1
+    ranges = rowid_ranges(db_path, workers * ranges_per_worker)
+    merged = {column: Partial([], precision) for column in GROUPS}
+    ctx = multiprocessing.get_context("spawn")
+    with span("stats.aggregate", ranges=len(ranges)), \
+            ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+        futures = [executor.submit(aggregate_range, str(db_path), start, end, precision, chunksize)
+                   for start, end in ranges]
+        for future in as_completed(futures):
+            for column, partial in future.result().items():
+                merged[column] = merged[column].merge(partial)
+    return merged
+
+
+def main(config):
+    """
+    Write per-source and per-network statistics and cadence histograms to `stats/`.
+    """
+    settings = config.get("stats", {})
+    output_dir = Path("stats")
+    output_dir.mkdir(exist_ok=True, parents=True)
+    db_path = config.path.data.joinpath("nela_ps_final.db")
+
+    partials = source_stats(db_path, workers=settings.get("workers", None),
+                            ranges_per_worker=settings.get("ranges_per_worker", 4),
+                            precision=settings.get("hll_precision", 12),
+                            chunksize=settings.get("chunksize", 100000))
+    for column, partial in partials.items():
+        stats, cadence = partial.to_frame(column)
+        stats.to_csv(output_dir.joinpath(f"{column}s.csv"))
+        cadence.to_csv(output_dir.joinpath(f"cadence_{column}s.csv"))
+        logger.info(f"Wrote the statistics of {len(stats)} {column}s")
+
+
+if __name__ == "__main__":
+    main(init_workspace(config_path="config/config.yaml", do_chdir=True))
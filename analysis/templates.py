@@ -0,0 +1,384 @@
+"""
+Near-duplicate (templated) article detection with MinHash and banded LSH.
+
+Networks publish the same template across many outlets, with a few words changed (place names, figures). Each article
+is reduced to a MinHash signature of its word shingles: the fraction of equal signature values estimates the Jaccard
+similarity of two articles' shingle sets. Signatures are split into bands, and articles that agree on every value of
+at least one band are linked. Template clusters are the connected components of these links; two articles in a band
+bucket have a Jaccard similarity of about (1/bands)^(1/rows) or more.
+
+Signatures are computed from `newsdata` in chunks, in a pool of worker processes, and stored in their own SQLite
+database keyed by `newsdata` rowid. Like the rollups, only rows added since the previous update are hashed.
+"""
+import logging
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.config import init_workspace
+from utils.db import iter_query, connect_writable, get_connection, get_watermark, set_watermark
+from utils.instrument import span
+from analysis.infrastructure import connected_components
+
+
+logger = logging.getLogger(__name__)
+
+WATERMARK = "templates"
+SEED = 1
+
+# Bytes that are part of words, once lowercased: ASCII letters and digits, and any non-ASCII (UTF-8) byte
+_WORD_BYTES = np.zeros(256, dtype=bool)
+_WORD_BYTES[[ord(c) for c in "0123456789abcdefghijklmnopqrstuvwxyz"]] = True
+_WORD_BYTES[128:] = True
+
+# Only the first bytes of a token are hashed (longer words are rare, and collisions among them are harmless)
+_TOKEN_BYTES = 16
+
+
+def _mix(x):
+    # splitmix64 finalizer, on uint64 arrays (arithmetic wraps around)
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xbf58476d1ce4e5b9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94d049bb133111eb)
+    return x ^ (x >> np.uint64(31))
+
+
+def token_hashes(texts):
+    """
+    Split texts into lowercase words and hash them.
+
+    Args:
+        texts (list[str]) : The texts.
+
+    Returns:
+        hashes (np.ndarray) : uint64 hash of each word, in order.
+        doc (np.ndarray) : Index of the text of each word.
+    """
+    encoded = [t.lower().encode("utf-8") for t in texts]
+    # Newlines are not word bytes, so words never span two texts
+    buf = np.frombuffer(b"\n".join(encoded), dtype=np.uint8)
+    is_word = np.r_[False, _WORD_BYTES[buf], False].astype(np.int8)
+    changes = np.diff(is_word)
+    starts, ends = np.flatnonzero(changes == 1), np.flatnonzero(changes == -1)
+    # Position of the newline after each text
+    offsets = np.cumsum(np.array([len(e) for e in encoded], dtype=np.int64) + 1) - 1
+    doc = np.minimum(np.searchsorted(offsets, starts), len(texts) - 1)
+
+    size = np.minimum(ends - starts, _TOKEN_BYTES)
+    last = max(len(buf) - 1, 0)
+    words = [np.zeros(len(starts), dtype=np.uint64), np.zeros(len(starts), dtype=np.uint64)]
+    for j in range(_TOKEN_BYTES):
+        byte = np.where(j < size, buf[np.minimum(starts + j, last)], 0).astype(np.uint64)
+        words[j // 8] |= byte << np.uint64(8 * (j % 8))
+    return _mix(words[0] ^ _mix(words[1] + size.astype(np.uint64))), doc
+
+
+def shingle_hashes(hashes, doc, size):
+    """
+    Hash the sequences of `size` consecutive words (shingles) of each text.
+
+    Args:
+        hashes (np.ndarray) : Word hashes, as returned by `token_hashes`.
+        doc (np.ndarray) : Text of each word.
+        size (int) : Words per shingle.
+
+    Returns:
+        shingles (np.ndarray) : uint64 hash of each shingle.
+        doc (np.ndarray) : Text of each shingle, in increasing order.
+    """
+    n = len(hashes) - size + 1
+    if n <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int64)
+    shingles = hashes[:n].copy()
+    for j in range(1, size):
+        shingles = _mix(shingles ^ hashes[j:j + n])
+    # Drop the shingles that span two texts
+    valid = doc[:n] == doc[size - 1:]
+    return shingles[valid], doc[:n][valid]
+
+
+def permutations(num_perm, seed=SEED):
+    """
+    Returns the parameters (a, b) of the `num_perm` hash functions `(a * x + b) >> 32` of the signatures.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2**63, size=num_perm, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2**63, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash(texts, num_perm=64, shingle_size=3, seed=SEED):
+    """
+    Compute the MinHash signatures of texts.
+
+    Args:
+        texts (list[str]) : The texts.
+        num_perm (int) : Signature length.
+        shingle_size (int) : Words per shingle.
+        seed (int) : Seed of the hash functions. Signatures are only comparable if computed with the same seed.
+
+    Returns:
+        signatures (np.ndarray) : uint32 array of shape (n, num_perm), for the texts with at least one shingle.
+        indices (np.ndarray) : Index in `texts` of each signature.
+    """
+    shingles, doc = shingle_hashes(*token_hashes(texts), shingle_size)
+    indices, starts = np.unique(doc, return_index=True)
+    signatures = np.empty((len(indices), num_perm), dtype=np.uint32)
+    if len(shingles) == 0:
+        return signatures, indices
+    for i, (a, b) in enumerate(zip(*permutations(num_perm, seed))):
+        values = ((a * shingles + b) >> np.uint64(32)).astype(np.uint32)
+        signatures[:, i] = np.minimum.reduceat(values, starts)
+    return signatures, indices
+
+
+def _minhash_chunk(rows, num_perm, shingle_size):
+    # Runs in a worker process
+    rowids, sources, networks, texts = zip(*rows)
+    signatures, indices = minhash(texts, num_perm, shingle_size)
+    return [(rowids[i], sources[i], networks[i], signatures[k].tobytes()) for k, i in enumerate(indices)]
+
+
+def _open_signatures(path, num_perm, shingle_size):
+    """
+    Open the signature database at `path`, emptying it if it was built with other parameters.
+    """
+    Path(path).parent.mkdir(exist_ok=True, parents=True)
+    con = connect_writable(path)
+    con.execute("CREATE TABLE IF NOT EXISTS signatures (rowid INTEGER PRIMARY KEY, source TEXT, network TEXT, "
+                "signature BLOB NOT NULL)")
+    con.execute("CREATE TABLE IF NOT EXISTS params (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    params = {"num_perm": num_perm, "shingle_size": shingle_size, "seed": SEED}
+    stored = dict(con.execute("SELECT name, value FROM params").fetchall())
+    if stored != params:
+        if stored:
+            logger.warning(f"Signatures were computed with {stored}, recomputing them with {params}")
+        with con:
+            con.execute("DELETE FROM signatures")
+            con.execute("DELETE FROM params")
+            con.executemany("INSERT INTO params(name, value) VALUES (?, ?)", params.items())
+            set_watermark(con, WATERMARK, 0)
+    return con
+
+
+def update_signatures(db_path, signatures_path, num_perm=64, shingle_size=3, batch_size=2000, workers=None):
+    """
+    Compute the signatures of the `newsdata` rows added since the previous update.
+
+    Args:
+        db_path (str or Path) : Path to the NELA database.
+        signatures_path (str or Path) : Path to the signature database (created if needed).
+        num_perm (int) : Signature length.
+        shingle_size (int) : Words per shingle.
+        batch_size (int) : Articles per chunk sent to a worker.
+        workers (int) : Number of worker processes (default: CPU count).
+
+    Returns:
+        n_rows (int) : Number of `newsdata` rows read by this update.
+    """
+    con = _open_signatures(signatures_path, num_perm, shingle_size)
+    try:
+        last_rowid = get_watermark(con, WATERMARK)
+        max_rowid = get_connection(db_path).execute("SELECT coalesce(max(rowid), 0) FROM newsdata").fetchone()[0]
+        if max_rowid < last_rowid:
+            logger.warning(f"newsdata max rowid {max_rowid} is below the signature watermark {last_rowid}, "
+                           f"rebuilding")
+            with con:
+                con.execute("DELETE FROM signatures")
+            last_rowid = 0
+        if max_rowid == last_rowid:
+            return 0
+
+        workers = workers or os.cpu_count() or 1
+        rows = iter_query(db_path, "SELECT rowid, source, network, content FROM newsdata "
+                                   "WHERE rowid > ? AND rowid <= ? AND length(content) > 0 ORDER BY rowid",
+                          (last_rowid, max_rowid), batch_size=batch_size)
+
+        def write(future):
+            with con:
+                con.executemany("INSERT OR REPLACE INTO signatures(rowid, source, network, signature) "
+                                "VALUES (?, ?, ?, ?)", future.result())
+
+        ctx = multiprocessing.get_context("spawn")
+        with span("templates.minhash") as s, \
+                ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+            pending = deque()
+            chunk = list()
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == batch_size:
+                    pending.append(executor.submit(_minhash_chunk, chunk, num_perm, shingle_size))
+                    s.count("articles", len(chunk))
+                    chunk = list()
+                    # Bound the chunks in flight, so that memory does not grow with the database
+                    while len(pending) > 2 * workers:
+                        write(pending.popleft())
+            if chunk:
+                pending.append(executor.submit(_minhash_chunk, chunk, num_perm, shingle_size))
+                s.count("articles", len(chunk))
+            while pending:
+                write(pending.popleft())
+        with con:
+            set_watermark(con, WATERMARK, max_rowid)
+        logger.info(f"Computed the signatures of newsdata rows {last_rowid + 1}..{max_rowid}")
+        return max_rowid - last_rowid
+    finally:
+        con.close()
+
+
+def band_keys(signatures, bands):
+    """
+    Hash each band of the signatures.
+
+    Args:
+        signatures (np.ndarray) : uint32 array of shape (n, num_perm).
+        bands (int) : Number of bands. Must divide num_perm.
+
+    Returns:
+        keys (np.ndarray) : uint64 array of shape (n, bands).
+    """
+    n, num_perm = signatures.shape
+    if num_perm % bands:
+        raise ValueError(f"The number of bands ({bands}) must divide the signature length ({num_perm})")
+    values = signatures.reshape(n, bands, num_perm // bands).astype(np.uint64)
+    keys = np.full((n, bands), np.arange(bands, dtype=np.uint64))
+    for j in range(values.shape[2]):
+        keys = _mix(keys ^ values[:, :, j])
+    return keys
+
+
+def lsh_edges(keys):
+    """
+    Link the signatures that share a band key: in each band, every signature is linked to the next one with the same
+    key, which connects each bucket with as few edges as possible.
+
+    Returns:
+        a, b (np.ndarray) : Endpoints (signature indices) of the edges.
+    """
+    edges_a, edges_b = list(), list()
+    for band in range(keys.shape[1]):
+        order = np.argsort(keys[:, band], kind="stable")
+        sorted_keys = keys[order, band]
+        same = sorted_keys[1:] == sorted_keys[:-1]
+        edges_a.append(order[:-1][same])
+        edges_b.append(order[1:][same])
+    return np.concatenate(edges_a), np.concatenate(edges_b)
+
+
+def find_templates(signatures_path, bands=16, min_articles=2, batch_size=100000):
+    """
+    Cluster the articles of the signature database by banded LSH.
+
+    Args:
+        signatures_path (str or Path) : Path to the signature database.
+        bands (int) : Number of bands.
+        min_articles (int) : Only keep clusters with at least this many articles.
+        batch_size (int) : Signatures read at a time.
+
+    Returns:
+        members (DataFrame) : `rowid`, `source`, `network` and `cluster` (the smallest rowid in the cluster) of each
+            article in a cluster.
+    """
+    rowids, sources, networks, keys = list(), list(), list(), list()
+    chunk = list()
+    rows = iter_query(signatures_path, "SELECT rowid, source, network, signature FROM signatures ORDER BY rowid",
+                      batch_size=batch_size)
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == batch_size:
+            keys.append(_chunk_keys(chunk, bands, rowids, sources, networks))
+            chunk = list()
+    if chunk:
+        keys.append(_chunk_keys(chunk, bands, rowids, sources, networks))
+    if not keys:
+        return pd.DataFrame(columns=["rowid", "source", "network", "cluster"])
+    keys = np.concatenate(keys)
+    rowids = np.concatenate(rowids)
+
+    labels = connected_components(len(rowids), *lsh_edges(keys))
+    sizes = np.bincount(labels, minlength=len(rowids))
+    keep = sizes[labels] >= min_articles
+    return pd.DataFrame({"rowid": rowids[keep],
+                         "source": np.concatenate(sources)[keep],
+                         "network": np.concatenate(networks)[keep],
+                         "cluster": rowids[labels[keep]]})
+
+
+def _chunk_keys(chunk, bands, rowids, sources, networks):
+    ids, srcs, nets, blobs = zip(*chunk)
+    rowids.append(np.array(ids, dtype=np.int64))
+    sources.append(np.array(srcs, dtype=object))
+    networks.append(np.array(nets, dtype=object))
+    signatures = np.frombuffer(b"".join(blobs), dtype=np.uint32).reshape(len(chunk), -1)
+    return band_keys(signatures, bands)
+
+
+def summarize(members, db_path=None):
+    """
+    Count the articles of each template cluster, overall, per source and per network.
+
+    Args:
+        members (DataFrame) : As returned by `find_templates`.
+        db_path (str or Path) : If given, add the title of the first article of each cluster from this database.
+
+    Returns:
+        clusters (DataFrame) : One row per cluster with `n_articles`, `n_sources`, `n_networks` and `networks`
+            ('network:articles', by decreasing number of articles), sorted by decreasing number of articles.
+        per_source (DataFrame) : `cluster`, `source`, `network` and `n_articles`.
+        per_network (DataFrame) : `cluster`, `network` and `n_articles`.
+    """
+    members = members.assign(network=members["network"].fillna(""))
+    per_source = members.groupby(["cluster", "source", "network"]).size().rename("n_articles").reset_index()
+    per_network = members.groupby(["cluster", "network"]).size().rename("n_articles").reset_index()
+    per_network = per_network.sort_values(["cluster", "n_articles"], ascending=[True, False])
+
+    clusters = pd.DataFrame({"n_articles": members.groupby("cluster").size(),
+                             "n_sources": per_source.groupby("cluster").size(),
+                             "n_networks": per_network[per_network["network"] != ""].groupby("cluster").size()})
+    clusters["n_networks"] = clusters["n_networks"].fillna(0).astype(np.int64)
+    labels = per_network["network"].replace("", "UNKNOWN") + ":" + per_network["n_articles"].astype(str)
+    clusters["networks"] = labels.groupby(per_network["cluster"]).agg(",".join)
+    if db_path is not None and len(clusters):
+        ids = clusters.index.to_numpy().tolist()
+        titles = dict()
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            titles.update(iter_query(db_path, f"SELECT rowid, title FROM newsdata "
+                                              f"WHERE rowid IN ({', '.join('?' * len(batch))})", batch))
+        clusters["title"] = clusters.index.map(titles)
+    clusters.index.name = "cluster"
+    return clusters.sort_values("n_articles", ascending=False), per_source, per_network
+
+
+def main(config):
+    """
+    Update the article signatures and write the template clusters to `templates/`.
+    """
+    settings = config.get("templates", {})
+    output_dir = Path("templates")
+    output_dir.mkdir(exist_ok=True, parents=True)
+    db_path = config.path.data.joinpath("nela_ps_final.db")
+    signatures_path = output_dir.joinpath("signatures.db")
+
+    update_signatures(db_path, signatures_path, num_perm=settings.get("num_perm", 64),
+                      shingle_size=settings.get("shingle_size", 3), batch_size=settings.get("batch_size", 2000),
+                      workers=settings.get("workers", None))
+    with span("templates.cluster"):
+        members = find_templates(signatures_path, bands=settings.get("bands", 16),
+                                 min_articles=settings.get("min_articles", 2))
+        clusters, per_source, per_network = summarize(members, db_path)
+    clusters.to_csv(output_dir.joinpath("clusters.csv"))
+    per_source.to_csv(output_dir.joinpath("cluster_sources.csv"), index=None)
+    per_network.to_csv(output_dir.joinpath("cluster_networks.csv"), index=None)
+    logger.info(f"Found {len(clusters)} templates covering {len(members)} articles, "
+                f"{(clusters['n_networks'] > 1).sum()} of them used by several networks")
+
+
+if __name__ == "__main__":
+    main(init_workspace(config_path="config/config.yaml", do_chdir=True))
@@ -0,0 +1,287 @@
+"""
+Benchmark suite.
+
+Generates synthetic datasets of the requested sizes (see `benchmarks/synthetic.py`), then times each case on them
+and records its wall time and peak memory to a JSON results file. Each case runs in a fresh process, so that peak RSS
+is measured per case and no case warms caches for another.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run --rows 10000 1000000 --output results.json
+    python -m benchmarks.run --rows 10000 --compare results.json
+"""
+import argparse
+import gc
+import json
+import logging
+import multiprocessing
+import platform
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import generate, dataset_paths
+
+
+logger = logging.getLogger(__name__)
+
+# Name -> (setup function, number of repetitions or None for the default)
+CASES = dict()
+
+
+def register_case(name, repeat=None):
+    """
+    Register a benchmark case. The decorated function takes the dataset paths (see `synthetic.generate`) and a
+    scratch directory, does any untimed setup, and returns the zero-argument function to time.
+
+    Args:
+        name (str) : Name of the case.
+        repeat (int) : Fixed number of timed repetitions (e.g. 1 for cases that change their input).
+    """
+    def decorator(func):
+        CASES[name] = (func, repeat)
+        return func
+    return decorator
+
+
+@register_case("timeseries_scan")
+def case_timeseries_scan(paths, scratch):
+    from plot.over_time import get_article_timeseries
+    con = sqlite3.connect(paths["db"])
+    return lambda: get_article_timeseries(con, days=7, group_by="source")
+
+
+@register_case("rollups_build", repeat=1)
+def case_rollups_build(paths, scratch):
+    from utils.rollups import update_rollups
+    db_path = Path(shutil.copy(paths["db"], scratch.joinpath("rollups.db")))
+    return lambda: update_rollups(db_path)
+
+
+@register_case("timeseries_rollups")
+def case_timeseries_rollups(paths, scratch):
+    from utils.rollups import update_rollups, get_timeseries, _cached_timeseries
+    db_path = Path(shutil.copy(paths["db"], scratch.joinpath("rollups.db")))
+    update_rollups(db_path)
+
+    def run():
+        _cached_timeseries.cache_clear()
+        return get_timeseries(db_path, days=7, group_by="source")
+    return run
+
+
+@register_case("fts_build", repeat=1)
+def case_fts_build(paths, scratch):
+    from utils.fts import update_fts
+    db_path = Path(shutil.copy(paths["db"], scratch.joinpath("fts.db")))
+    return lambda: update_fts(db_path)
+
+
+@register_case("fts_search")
+def case_fts_search(paths, scratch):
+    from utils.fts import update_fts, search, phrase
+    db_path = Path(shutil.copy(paths["db"], scratch.joinpath("fts.db")))
+    update_fts(db_path)
+
+    def run():
+        search(db_path, phrase("school board"))
+        search(db_path, "tax*", networks=["metric_media"], start="2020-03-01", end="2020-04-01")
+    return run
+
+
+@register_case("stack_matrix")
+def case_stack_matrix(paths, scratch):
+    from plot.over_time import get_article_timeseries
+    from plot.stack_matrix import build_stack_matrix
+    with sqlite3.connect(paths["db"]) as con:
+        t = get_article_timeseries(con, days=7, group_by="source")
+    return lambda: build_stack_matrix(t, "source")
+
+
+@register_case("load_source_list")
+def case_load_source_list(paths, scratch):
+    from utils.data import load_source_list
+    return lambda: load_source_list(paths["sources"])
+
+
+@register_case("crossref")
+def case_crossref(paths, scratch):
+    from utils.data import load_source_list
+    from media_networks.matching import load_network_lists
+    from media_networks.source_crossref import crossref, load_source_ips
+
+    # media_networks/source_crossref.py without the outputs (CSV and registry)
+    def run():
+        return crossref(load_source_list(paths["sources"]), load_network_lists(paths["network_lists"]),
+                        load_source_ips(paths["source_ips"]))
+    return run
+
+
+@register_case("minhash")
+def case_minhash(paths, scratch):
+    from analysis.templates import minhash
+    from utils.db import iter_query
+    # One chunk, as hashed by a worker of `update_signatures`
+    texts = [content for content, in iter_query(paths["db"], "SELECT content FROM newsdata LIMIT 2000")]
+    return lambda: minhash(texts)
+
+
+@register_case("json_loading")
+def case_json_loading(paths, scratch):
+    from utils.nela_json import iter_articles, list_json_files
+    files = list_json_files(paths["json"])
+    return lambda: sum(1 for path in files for _ in iter_articles(path))
+
+
+def _cli(*args):
+    # Run nela_ps.py in a fresh interpreter, as a user would
+    root = Path(__file__).absolute().parents[1]
+    command = [sys.executable, str(root.joinpath("nela_ps.py")), *map(str, args)]
+    return lambda: subprocess.run(command, cwd=root, check=True, stdout=subprocess.DEVNULL)
+
+
+@register_case("cli_help")
+def case_cli_help(paths, scratch):
+    return _cli("--help")
+
+
+@register_case("cli_load_json")
+def case_cli_load_json(paths, scratch):
+    from utils.nela_json import list_json_files
+    return _cli("load", list_json_files(paths["json"])[0])
+
+
+@register_case("cli_python")
+def case_cli_python(paths, scratch):
+    # Interpreter start-up alone, the baseline of the cli_* cases
+    return lambda: subprocess.run([sys.executable, "-c", "pass"], check=True)
+
+
+def _maxrss():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def measure(name, paths, scratch, repeat):
+    """
+    Run case `name`: `repeat` timed runs, then one run under `tracemalloc` for the peak of traced allocations.
+
+    Returns:
+        result (dict) : Wall times, best and mean, peak traced memory and peak RSS (bytes) of the case.
+    """
+    setup, fixed_repeat = CASES[name]
+    repeat = fixed_repeat or repeat
+    scratch = Path(scratch)
+    scratch.mkdir(exist_ok=True, parents=True)
+    func = setup({k: Path(v) for k, v in paths.items()}, scratch)
+    rss_before = _maxrss()
+
+    times = list()
+    for _ in range(repeat):
+        gc.collect()
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    peak_traced = None
+    if fixed_repeat is None:
+        # A separate run, since tracing slows allocations down
+        gc.collect()
+        tracemalloc.start()
+        func()
+        peak_traced = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    shutil.rmtree(scratch, ignore_errors=True)
+    return {"case": name, "repeat": repeat, "wall_seconds": times, "best_seconds": min(times),
+            "mean_seconds": float(np.mean(times)), "peak_traced_bytes": peak_traced,
+            "maxrss_bytes": _maxrss(), "setup_maxrss_bytes": rss_before}
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_dataset(workdir, rows, seed, regenerate=False):
+    """
+    Generate the dataset with `rows` articles in `workdir`, unless it already exists with the same parameters.
+    """
+    directory = Path(workdir).joinpath(f"rows={rows}")
+    params = {"rows": rows, "seed": seed}
+    params_path = directory.joinpath("params.json")
+    if not regenerate and params_path.exists() and json.loads(params_path.read_text()) == params:
+        return {k: str(v) for k, v in dataset_paths(directory).items()}
+    logger.info(f"Generating a dataset with {rows} rows in {directory}")
+    content_words = 20 if rows <= 1000000 else 0  # Keep very large databases to a manageable size
+    paths = generate(directory, rows=rows, content_words=content_words, seed=seed)
+    params_path.write_text(json.dumps(params))
+    return {k: str(v) for k, v in paths.items()}
+
+
+def compare(results, baseline):
+    """
+    Print the best time and peak memory of each case relative to a previous results file.
+    """
+    previous = {(r["rows"], r["case"]): r for r in baseline["results"]}
+    print(f"{'case':<22}{'rows':>10}{'best (s)':>12}{'baseline':>12}{'ratio':>8}{'peak MB':>10}")
+    for r in results["results"]:
+        b = previous.get((r["rows"], r["case"]))
+        base = f"{b['best_seconds']:.4f}" if b else "-"
+        ratio = f"{r['best_seconds'] / b['best_seconds']:.2f}" if b and b["best_seconds"] > 0 else "-"
+        peak = f"{r['peak_traced_bytes'] / 1e6:.1f}" if r["peak_traced_bytes"] is not None else "-"
+        print(f"{r['case']:<22}{r['rows']:>10}{r['best_seconds']:>12.4f}{base:>12}{ratio:>8}{peak:>10}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the benchmark suite on synthetic data")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000], help="Dataset sizes (articles)")
+    parser.add_argument("--cases", type=str, nargs="+", default=None, choices=list(CASES),
+                        help="Cases to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed repetitions per case")
+    parser.add_argument("--workdir", type=str, default="data/benchmarks", help="Where datasets are generated")
+    parser.add_argument("--output", type=str, default=None, help="Results file (default: timestamped in workdir)")
+    parser.add_argument("--compare", type=str, default=None, help="Previous results file to compare against")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--regenerate", action="store_true", help="Regenerate datasets even if they exist")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    cases = args.cases or list(CASES)
+    results = {"meta": {"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "git_commit": _git_commit(),
+                        "python": platform.python_version(), "platform": platform.platform(),
+                        "sqlite": sqlite3.sqlite_version, "numpy": np.__version__, "pandas": pd.__version__,
+                        "seed": args.seed, "repeat": args.repeat},
+               "results": list()}
+
+    # One fresh process per case; spawn so that nothing is inherited from this one
+    ctx = multiprocessing.get_context("spawn")
+    for rows in args.rows:
+        paths = prepare_dataset(args.workdir, rows, args.seed, args.regenerate)
+        for name in cases:
+            scratch = Path(args.workdir).joinpath("scratch", name)
+            with ctx.Pool(1) as pool:
+                result = pool.apply(measure, (name, paths, scratch, args.repeat))
+            result["rows"] = rows
+            results["results"].append(result)
+            logger.info(f"{name} ({rows} rows): best {result['best_seconds']:.4f}s, "
+                        f"peak RSS {result['maxrss_bytes'] / 1e6:.1f} MB")
+
+    output = Path(args.output or Path(args.workdir).joinpath(f"results-{time.strftime('%Y%m%d-%H%M%S')}.json"))
+    output.parent.mkdir(exist_ok=True, parents=True)
+    with open(output, "w") as fout:
+        json.dump(results, fout, indent=2)
+    logger.info(f"Wrote results to {output}")
+    if args.compare:
+        with open(args.compare) as fin:
+            compare(results, json.load(fin))
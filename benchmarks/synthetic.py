@@ -0,0 +1,253 @@
+"""
+Deterministic generator of synthetic NELA Pink Slime data for benchmarks.
+
+Everything is derived from a seed, so two runs with the same arguments produce identical files. The generated layout
+mirrors the one the scripts expect:
+
+    <output_dir>/
+        nela_ps_final.db            `newsdata` table with the NELA columns
+        ps_sources.txt              one `source,feed_url` line per source
+        media_network_lists/        one `<network>.txt` file per network
+        ipaddrs/source_IPs.jsonl    one resolution record per source
+        json/                       one NELA-GT style JSON file per source
+
+Usage (from the repository root):
+
+    python -m benchmarks.synthetic data/synthetic --rows 1000000
+"""
+import argparse
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+NETWORKS = ("metric_media", "franklin_archer", "lgis", "the_record", "metro_business")
+
+NEWSDATA_SCHEMA = "CREATE TABLE newsdata (id TEXT, date TEXT, source TEXT, title TEXT, content TEXT, author TEXT, " \
+                  "url TEXT, published TEXT, published_utc INTEGER, collection_utc INTEGER, network TEXT)"
+
+_PLACES = ("alabama", "alaska", "arizona", "arkansas", "boise", "carolina", "chicago", "dayton", "delaware", "denver",
+           "erie", "fresno", "georgia", "hudson", "idaho", "illinois", "iowa", "kansas", "kent", "lansing", "macon",
+           "maine", "marion", "memphis", "michigan", "monroe", "nevada", "ohio", "omaha", "peoria", "quincy", "salem",
+           "topeka", "tulsa", "utah", "vermont", "wayne", "yuma")
+_TOPICS = ("business", "news", "times", "today", "reporter", "courier", "gazette", "ledger", "observer", "sun",
+           "record", "post", "tribune", "wire", "dispatch", "journal")
+_SUFFIXES = ("daily", "weekly", "now", "review", "press", "herald", "")
+_WORDS = ("county", "school", "board", "tax", "city", "council", "report", "announces", "new", "local", "state",
+          "budget", "election", "police", "health", "road", "court", "vote", "grant", "office", "public", "plan",
+          "meeting", "residents", "officials", "project", "million", "year", "week", "district")
+
+START_UTC = 1577836800  # 2020-01-01
+
+
+def source_names(n, seed=0):
+    """
+    Returns `n` distinct, deterministic source names (e.g. 'daytonbusinessdaily').
+    """
+    rng = np.random.default_rng(seed)
+    names = [f"{p}{t}{s}" for p in _PLACES for t in _TOPICS for s in _SUFFIXES]
+    names = [names[i] for i in rng.permutation(len(names))]
+    # Past the combinations of words, number the names
+    return [names[i % len(names)] + (str(i // len(names)) if i >= len(names) else "") for i in range(n)]
+
+
+def make_sources(n_sources=500, network_fraction=0.6, seed=0):
+    """
+    Draw the synthetic sources and their networks.
+
+    Args:
+        n_sources (int) : Number of sources.
+        network_fraction (float) : Fraction of the sources that belong to a network.
+        seed (int) : Random seed.
+
+    Returns:
+        sources (list[tuple(str,str,str)]) : (source, feed_url, network) tuples. `network` is `None` outside networks.
+    """
+    rng = np.random.default_rng(seed)
+    names = source_names(n_sources, seed)
+    in_network = rng.random(n_sources) < network_fraction
+    # Network sizes are skewed, like the real lists (Metric Media is by far the largest)
+    networks = rng.choice(len(NETWORKS), size=n_sources, p=[0.6, 0.2, 0.1, 0.05, 0.05])
+    return [(name, f"https://{name}.com/feed", NETWORKS[k] if member else None)
+            for name, member, k in zip(names, in_network, networks)]
+
+
+def write_source_list(path, sources):
+    """
+    Write `ps_sources.txt` (one `source,feed_url` line per source).
+    """
+    with open(path, "w") as fout:
+        for source, feed_url, _ in sources:
+            fout.write(f"{source},{feed_url}\n")
+
+
+def write_network_lists(directory, sources, seed=0):
+    """
+    Write one `<network>.txt` list per network. Names are written the way the scraped lists spell them (spaced,
+    capitalized, sometimes with '.com'), and a few are misspelled so that fuzzy matching has work to do.
+    """
+    rng = np.random.default_rng(seed + 1)
+    directory = Path(directory)
+    directory.mkdir(exist_ok=True, parents=True)
+    members = {network: list() for network in NETWORKS}
+    for source, _, network in sources:
+        if network is None:
+            continue
+        name = source
+        if rng.random() < 0.1 and len(name) > 4:
+            i = int(rng.integers(1, len(name) - 1))
+            name = name[:i] + name[i + 1:]
+        if rng.random() < 0.2:
+            name += ".com"
+        members[network].append(name.title())
+    for network, names in members.items():
+        with open(directory.joinpath(f"{network}.txt"), "w") as fout:
+            fout.writelines(f"{name}\n" for name in names)
+
+
+def write_source_ips(path, sources, seed=0):
+    """
+    Write `source_IPs.jsonl`. Sources of the same network are packed into a few shared /24 networks.
+    """
+    rng = np.random.default_rng(seed + 2)
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    with open(path, "w") as fout:
+        for source, _, network in sources:
+            if network is None:
+                a, b, c = rng.integers(1, 224), rng.integers(0, 256), rng.integers(0, 256)
+            else:
+                a, b, c = 10, NETWORKS.index(network), rng.integers(0, 4)
+            ips = [f"{a}.{b}.{c}.{d}" for d in rng.integers(1, 255, size=rng.integers(1, 3))]
+            record = {"source": source, "hostname": f"{source}.com", "aliaslist": [], "ipaddrlist": ips,
+                      "ttl": 3600, "resolved_at": START_UTC}
+            fout.write(f"{json.dumps(record)}\n")
+
+
+def _articles(rng, sources, start, n, days, content_words):
+    """
+    Draw `n` synthetic articles as tuples in `newsdata` column order.
+    """
+    src = rng.integers(0, len(sources), size=n)
+    published = START_UTC + np.sort(rng.integers(0, days * 86400, size=n))
+    words = np.asarray(_WORDS, dtype=object)
+    title_words = words[rng.integers(0, len(words), size=(n, 6))]
+    content = words[rng.integers(0, len(words), size=(n, content_words))] if content_words else None
+    timestamps = published.astype("datetime64[s]")
+    dates = np.datetime_as_string(timestamps.astype("datetime64[D]")).tolist()
+    stamps = np.char.replace(np.datetime_as_string(timestamps), "T", " ").tolist()
+    rows = list()
+    for i, t in enumerate(published.tolist()):
+        source, _, network = sources[src[i]]
+        rows.append((f"{source}--{start + i}",
+                     dates[i],
+                     source,
+                     " ".join(title_words[i]).capitalize(),
+                     " ".join(content[i]) if content is not None else None,
+                     None,
+                     f"https://{source}.com/stories/{start + i}",
+                     stamps[i],
+                     t,
+                     t + 3600,
+                     network))
+    return rows
+
+
+def make_database(path, sources, rows=10000, days=730, content_words=20, batch_size=100000, seed=0):
+    """
+    Create a synthetic `nela_ps_final.db` with a `newsdata` table. An existing file is replaced.
+
+    Args:
+        path (str or Path) : Output path.
+        sources (list[tuple]) : Sources from `make_sources`.
+        rows (int) : Number of articles.
+        days (int) : Articles are spread over this many days from 2020-01-01.
+        content_words (int) : Words of content per article (0 for NULL content, to keep large databases small).
+        batch_size (int) : Rows inserted per transaction.
+        seed (int) : Random seed.
+    """
+    path = Path(path)
+    path.unlink(missing_ok=True)
+    rng = np.random.default_rng(seed + 3)
+    con = sqlite3.connect(path)
+    con.execute("PRAGMA journal_mode=OFF")
+    con.execute("PRAGMA synchronous=OFF")
+    con.execute(NEWSDATA_SCHEMA)
+    for start in range(0, rows, batch_size):
+        n = min(batch_size, rows - start)
+        with con:
+            con.executemany("INSERT INTO newsdata VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                            _articles(rng, sources, start, n, days, content_words))
+        logger.debug(f"Inserted {start + n}/{rows} rows into {path}")
+    con.close()
+
+
+def write_json_files(directory, sources, articles_per_source=200, n_files=20, days=730, seed=0):
+    """
+    Write NELA-GT style JSON files (one list of articles per source) for the first `n_files` sources.
+    """
+    rng = np.random.default_rng(seed + 4)
+    directory = Path(directory)
+    directory.mkdir(exist_ok=True, parents=True)
+    fields = ("id", "date", "source", "title", "content", "author", "url", "published", "published_utc",
+              "collection_utc")
+    for k, source in enumerate(sources[:n_files]):
+        rows = _articles(rng, [source], k * articles_per_source, articles_per_source, days, content_words=100)
+        with open(directory.joinpath(f"{source[0]}.json"), "w") as fout:
+            json.dump([dict(zip(fields, row)) for row in rows], fout)
+
+
+def dataset_paths(output_dir):
+    """
+    Returns the paths of the `db`, `sources`, `network_lists`, `source_ips` and `json` of a dataset in `output_dir`.
+    """
+    output_dir = Path(output_dir)
+    return {
+        "db": output_dir.joinpath("nela_ps_final.db"),
+        "sources": output_dir.joinpath("ps_sources.txt"),
+        "network_lists": output_dir.joinpath("media_network_lists"),
+        "source_ips": output_dir.joinpath("ipaddrs", "source_IPs.jsonl"),
+        "json": output_dir.joinpath("json"),
+    }
+
+
+def generate(output_dir, rows=10000, n_sources=500, network_fraction=0.6, content_words=20, json_files=20,
+             seed=0):
+    """
+    Generate a complete synthetic dataset in `output_dir`.
+
+    Returns:
+        paths (dict[str,Path]) : Paths of the generated files (see `dataset_paths`).
+    """
+    Path(output_dir).mkdir(exist_ok=True, parents=True)
+    paths = dataset_paths(output_dir)
+    sources = make_sources(n_sources, network_fraction, seed)
+    write_source_list(paths["sources"], sources)
+    write_network_lists(paths["network_lists"], sources, seed)
+    write_source_ips(paths["source_ips"], sources, seed)
+    write_json_files(paths["json"], sources, n_files=json_files, seed=seed)
+    make_database(paths["db"], sources, rows=rows, content_words=content_words, seed=seed)
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic NELA Pink Slime dataset")
+    parser.add_argument("output_dir", type=str)
+    parser.add_argument("--rows", type=int, default=10000, help="Number of articles in the database")
+    parser.add_argument("--sources", type=int, default=500, help="Number of sources")
+    parser.add_argument("--content-words", type=int, default=20, help="Words of content per article (0 for none)")
+    parser.add_argument("--json-files", type=int, default=20, help="Number of per-source JSON files")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    t0 = time.perf_counter()
+    paths = generate(args.output_dir, rows=args.rows, n_sources=args.sources, content_words=args.content_words,
+                     json_files=args.json_files, seed=args.seed)
+    logger.info(f"Generated {args.rows} rows in {time.perf_counter() - t0:.1f}s: {paths['db']}")
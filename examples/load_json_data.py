@@ -1,30 +1,60 @@
 import argparse
-import json
-import os
+from pathlib import Path
 
-# This script shows how to load NELA-GT-2019 JSON files
-
-
-# Start here
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("path", type=str, help="Path to NELA JSON file")
+from utils.nela_json import iter_articles, map_files, list_json_files, FileStats
 
-    args = parser.parse_args()
+# This script shows how to load NELA-GT-2019 JSON files
+# Files are streamed one article at a time, so memory use does not grow with file size.
+# Run from the repository root: python -m examples.load_json_data <path>
+
+
+# Count the articles in a stream (used by the process pool, so it must be a module-level function)
+def count_articles(articles):
+    return sum(1 for _ in articles)
+
+
+# Load a NELA JSON file, or a directory of files in parallel
+def load(path, workers=None):
+    if Path(path).is_dir():
+        # Loading a directory of files in parallel
+        paths = list_json_files(path)
+        print("- Loading %d files from" % len(paths), path)
+        total = 0
+        for file, n_articles, stats in map_files(count_articles, paths, workers=workers):
+            print("    + %s: %d articles (%.1f articles/s, %.1f MB/s)"
+                  % (file, n_articles, stats.articles_per_sec, stats.mb_per_sec))
+            total += n_articles
+        print("-> Loaded %d articles" % total)
+        print("ALL DONE.")
+        return
 
     # Loading a single file
-    print("- Loading file", args.path)
-    with open(args.path) as fin:
-        data = json.load(fin)
+    print("- Loading file", path)
+    stats = FileStats(path)
+    fields = None
+    for article in iter_articles(path, stats=stats):
+        if fields is None:
+            fields = list(article)
 
     # Display fields
-    print("-> Loaded %d articles" % len(data))
+    print("-> Loaded %d articles (%.1f articles/s, %.1f MB/s)"
+          % (stats.articles, stats.articles_per_sec, stats.mb_per_sec))
     print("- Data fields:")
-    for field in data[0]:
+    for field in fields or []:
         print("    +", field)
 
     print("ALL DONE.")
 
 
+# Start here
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="Path to NELA JSON file, or a directory of per-source JSON files")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes used to load a directory")
+
+    args = parser.parse_args()
+    load(args.path, args.workers)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,48 +1,60 @@
 import argparse
-import sqlite3
-import pandas as pd
+
+from utils.db import iter_query, query_pandas
+from utils.fts import has_fts, search, phrase
 # This script shows an example of how to use NELA-GT-2019 with sqlite3
 # For more info, see: https://github.com/mgruppi/nela-gt
+# Run from the repository root: python -m examples.load_sqlite3_data <path>
 
 
-# Execute a given SQL query on the database and return values
-def execute_query(path, query):
-    conn = sqlite3.connect(path)
-    # execute query on database and retrieve them with fetchall
-    results = conn.cursor().execute(query).fetchall()
-    return results
+# Execute a given SQL query on the database and stream the results
+def execute_query(path, query, params=()):
+    # Connections are read-only and reused; rows are fetched in batches with fetchmany
+    return iter_query(path, query, params)
 
 
 # Execute query and load results into pandas dataframe
-def execute_query_pandas(path, query):
-    conn = sqlite3.connect(path)
-    df = pd.read_sql_query(query, conn)
-    return df
+def execute_query_pandas(path, query, params=()):
+    return query_pandas(path, query, params)
 
 
-# Start here
-def main():
-    # Make input command line arguments
-    parser = argparse.ArgumentParser()
-    parser.add_argument("path", type=str, help="Path to NELA database file.")
-    args = parser.parse_args()
-
+# Query a NELA database
+def load(path):
     # Query 1: select the title, source and url from 10 articles
-    query = "SELECT title, source, url FROM newsdata LIMIT 10"
+    # Values are passed as parameters, never formatted into the query string
+    query = "SELECT title, source, url FROM newsdata LIMIT ?"
 
-    data = execute_query(args.path, query)
+    data = execute_query(path, query, (10,))
 
     for result in data:
         print(result)
 
     # Alternatively, one can fetch queries into a pandas dataframe:
-    df = execute_query_pandas(args.path, query)
+    df = execute_query_pandas(path, query, (10,))
 
     print("-- Same results but in a Pandas dataframe.")
     print(df)
 
+    # Query 2: full-text search, best matches first
+    # Loading never writes to the database: the search runs only if the full-text index already exists.
+    # `python nela_ps.py search <query>` builds the index and keeps it up to date.
+    if has_fts(path):
+        print("-- Articles mentioning a school board.")
+        print(search(path, phrase("school board"), page_size=10))
+    else:
+        print("-- No full-text index, skipping the search example (see `python nela_ps.py search`).")
+
     print("- ALL DONE.")
 
 
+# Start here
+def main():
+    # Make input command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument("path", type=str, help="Path to NELA database file.")
+    args = parser.parse_args()
+    load(args.path)
+
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
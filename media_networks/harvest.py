@@ -0,0 +1,566 @@
+"""
+Concurrent liveness check and sitemap/feed harvest of the NELA PS sources.
+
+For each source of `ps_sources.txt`, the harvester fetches `robots.txt`, the sitemaps it lists (or `/sitemap.xml`),
+and the source's RSS or Atom feed, and streams every article URL found, with its last modification or publication
+date, to a JSONL file. A per-site summary tells which outlets are still up and how much they publish.
+
+Everything runs on one asyncio event loop, over a small HTTP/1.1 client built on `asyncio` streams:
+
+    - connections are kept alive and reused across the requests to a host,
+    - a global limit bounds the open connections, and a per-host limit the connections to each host,
+    - every connection and request has a timeout,
+    - responses are cached with their validators, so unchanged sitemaps and feeds cost a 304 on the next run.
+
+`HttpClient(connect_to={host: (address, port)})` sends the requests for some hosts to another address, e.g. a local
+HTTP server standing in for the sites.
+"""
+import asyncio
+import gzip
+import io
+import logging
+import ssl
+import time
+import xml.etree.ElementTree as ET
+import zlib
+from collections import defaultdict, namedtuple
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from urllib.parse import urljoin, urlsplit
+from urllib.robotparser import RobotFileParser
+
+from media_networks.scrape_sites import ResponseCache
+from utils.config import init_workspace
+from utils.data import load_source_list
+from utils.fileio import CsvWriter, JsonlWriter
+from utils.instrument import span
+
+
+logger = logging.getLogger(__name__)
+
+USER_AGENT = "nela-ps-harvest/1.0"
+
+REDIRECTS = (301, 302, 303, 307, 308)
+
+SITE_FIELDS = ("source", "feed_url", "host", "live", "robots_status", "feed_status", "sitemaps", "feed_entries",
+               "sitemap_entries", "distinct_urls", "latest", "recent_entries", "errors")
+
+Response = namedtuple("Response", ["url", "status", "headers", "body", "not_modified"])
+
+
+class HttpError(Exception):
+    """
+    Raised when a response cannot be read (e.g. a malformed response or a body over the size limit).
+    """
+
+
+class Connection:
+    """
+    HTTP/1.1 connection to one host, reusable for several requests while the server keeps it alive.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    @classmethod
+    async def open(cls, scheme, host, port, timeout, connect_to=None):
+        address, port = (connect_to or dict()).get(host, (host, port))
+        context = ssl.create_default_context() if scheme == "https" else None
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(address, port, ssl=context, server_hostname=host if context else None),
+            timeout)
+        return cls(reader, writer)
+
+    async def request(self, method, target, headers, max_body):
+        """
+        Send a request and read the whole response.
+
+        Returns:
+            status (int) : Status code.
+            headers (dict[str,str]) : Response headers, with lowercase names.
+            body (bytes) : Response body, without its transfer encoding.
+        """
+        lines = [f"{method} {target} HTTP/1.1"] + [f"{name}: {value}" for name, value in headers.items()]
+        self.writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await self.writer.drain()
+
+        while True:
+            status_line = await self.reader.readline()
+            if not status_line:
+                raise ConnectionResetError("Connection closed by the server")
+            version, status, *_ = status_line.decode("latin-1").split(" ", 2)
+            status = int(status)
+            headers = await self._read_headers()
+            if status >= 200 or status == 101:
+                break  # 1xx responses (e.g. 100 Continue) are followed by the actual response
+
+        connection = headers.get("connection", "").lower()
+        self.reusable = (version == "HTTP/1.1" and connection != "close") or connection == "keep-alive"
+        if method == "HEAD" or status in (204, 304) or status < 200:
+            body = b""
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            body = await self._read_chunked(max_body)
+        elif "content-length" in headers:
+            length = int(headers["content-length"])
+            if length > max_body:
+                raise HttpError(f"Response body of {length} bytes is over the limit of {max_body}")
+            body = await self.reader.readexactly(length)
+        else:
+            # The body ends when the server closes the connection
+            body = await self.reader.read(max_body + 1)
+            while body and len(body) <= max_body and not self.reader.at_eof():
+                chunk = await self.reader.read(max_body + 1 - len(body))
+                if not chunk:
+                    break
+                body += chunk
+            if len(body) > max_body:
+                raise HttpError(f"Response body is over the limit of {max_body} bytes")
+            self.reusable = False
+        return status, headers, body
+
+    async def _read_headers(self):
+        headers = dict()
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            name, _, value = line.decode("latin-1").partition(":")
+            name, value = name.strip().lower(), value.strip()
+            headers[name] = f"{headers[name]}, {value}" if name in headers else value
+
+    async def _read_chunked(self, max_body):
+        chunks, size = list(), 0
+        while True:
+            length = int((await self.reader.readline()).split(b";", 1)[0].strip() or b"0", 16)
+            if length == 0:
+                await self._read_headers()  # Trailers
+                return b"".join(chunks)
+            size += length
+            if size > max_body:
+                raise HttpError(f"Response body is over the limit of {max_body} bytes")
+            chunks.append(await self.reader.readexactly(length))
+            await self.reader.readline()
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+
+class ConnectionPool:
+    """
+    Keep-alive connections, with a limit on the connections in use overall and per host.
+
+    Args:
+        max_connections (int) : Connections in use at once, overall.
+        per_host (int) : Connections in use at once to each host.
+        max_idle (int) : Idle connections kept open for reuse, overall.
+        timeout (float) : Seconds allowed to open a connection.
+        connect_to (dict[str,tuple(str,int)]) : Address and port to connect to instead of some hosts.
+    """
+
+    def __init__(self, max_connections=64, per_host=2, max_idle=256, timeout=10.0, connect_to=None):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.connect_to = connect_to
+        self._slots = asyncio.Semaphore(max_connections)
+        self._host_slots = defaultdict(lambda: asyncio.Semaphore(per_host))
+        self._idle = defaultdict(list)  # (scheme, host, port) -> idle connections
+        self._n_idle = 0
+        self.opened = 0
+        self.reused = 0
+
+    async def acquire(self, key):
+        """
+        Returns an idle connection to `key` (scheme, host, port), or a new one, and whether it was reused. Hold a
+        slot of the host and a global slot first (see `slot`).
+        """
+        while self._idle[key]:
+            connection = self._idle[key].pop()
+            self._n_idle -= 1
+            if not connection.reader.at_eof():
+                self.reused += 1
+                return connection, True
+            connection.close()
+        self.opened += 1
+        return await Connection.open(*key, timeout=self.timeout, connect_to=self.connect_to), False
+
+    def release(self, key, connection):
+        """
+        Keep `connection` for later requests to `key` if it can be reused, or else close it.
+        """
+        if connection.reusable and self._n_idle < self.max_idle:
+            self._idle[key].append(connection)
+            self._n_idle += 1
+        else:
+            connection.close()
+
+    def slot(self, host):
+        """
+        Returns the host and global semaphores to hold while a connection to `host` is in use, in acquisition order.
+        """
+        return self._host_slots[host], self._slots
+
+    def close_host(self, host=None):
+        """
+        Close the idle connections to `host` (e.g. once a site is done), or to every host.
+        """
+        for key in [key for key in self._idle if host is None or key[1] == host]:
+            for connection in self._idle.pop(key):
+                connection.close()
+                self._n_idle -= 1
+
+
+class HttpClient:
+    """
+    Minimal asynchronous HTTP/1.1 client (GET only) with keep-alive, connection limits, timeouts, redirects, gzip and
+    conditional requests.
+
+    Args:
+        max_connections (int) : Connections in use at once, overall.
+        per_host (int) : Connections in use at once to each host.
+        max_idle (int) : Idle connections kept open for reuse, overall.
+        timeout (float) : Seconds allowed to connect, and then to get each response.
+        max_body (int) : Largest response body read, in bytes.
+        max_redirects (int) : Redirects followed per request.
+        user_agent (str) : User-Agent header.
+        cache (ResponseCache) : Cache of the responses and their validators. If `None`, requests are unconditional.
+        connect_to (dict[str,tuple(str,int)]) : Address and port to connect to instead of some hosts.
+    """
+
+    def __init__(self, max_connections=64, per_host=2, max_idle=256, timeout=15.0, max_body=50 << 20,
+                 max_redirects=5, user_agent=USER_AGENT, cache=None, connect_to=None):
+        self.pool = ConnectionPool(max_connections, per_host, max_idle, timeout, connect_to)
+        self.timeout = timeout
+        self.max_body = max_body
+        self.max_redirects = max_redirects
+        self.user_agent = user_agent
+        self.cache = cache
+
+    async def _request(self, url, headers):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise HttpError(f"Unsupported URL {url!r}")
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        key = (parts.scheme, parts.hostname, port)
+        host = parts.netloc.rsplit("@", 1)[-1]
+        target = parts.path or "/"
+        if parts.query:
+            target += f"?{parts.query}"
+        headers = {"Host": host, "User-Agent": self.user_agent, "Accept-Encoding": "gzip",
+                   "Connection": "keep-alive", **headers}
+
+        host_slot, slot = self.pool.slot(parts.hostname)
+        async with host_slot, slot:
+            # A reused connection may have been closed by the server in the meantime: retry once on a new one
+            for attempt in range(2):
+                connection, reused = await self.pool.acquire(key)
+                try:
+                    status, response_headers, body = await asyncio.wait_for(
+                        connection.request("GET", target, headers, self.max_body), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    connection.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise ConnectionError(f"{url}: {e}") from e
+                except BaseException:
+                    connection.close()
+                    raise
+                self.pool.release(key, connection)
+                break
+
+        if response_headers.get("content-encoding", "").lower() == "gzip":
+            try:
+                body = gzip.decompress(body)
+            except (OSError, EOFError, zlib.error) as e:
+                raise HttpError(f"{url}: corrupt gzip body: {e}") from e
+        return status, response_headers, body
+
+    async def get(self, url, headers=None):
+        """
+        GET `url`, following redirects. If the cache has a copy of the response, the request is conditional, and a
+        304 response gets the cached body.
+
+        Returns:
+            response (Response) : Final `url`, `status`, `headers`, `body` and `not_modified` flag.
+        """
+        headers = dict(headers or dict())
+        cached = self.cache.get(url) if self.cache is not None else None
+        if cached is not None:
+            meta, _ = cached
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+
+        location = url
+        for _ in range(self.max_redirects + 1):
+            status, response_headers, body = await self._request(location, headers)
+            if status not in REDIRECTS or "location" not in response_headers:
+                break
+            location = urljoin(location, response_headers["location"])
+        else:
+            raise HttpError(f"{url}: more than {self.max_redirects} redirects")
+
+        if status == 304 and cached is not None:
+            return Response(location, status, response_headers, cached[1], True)
+        if status == 200 and self.cache is not None:
+            self.cache.put(url, {"url": url, "etag": response_headers.get("etag"),
+                                 "last_modified": response_headers.get("last-modified")}, body)
+        return Response(location, status, response_headers, body, False)
+
+    def close(self):
+        self.pool.close_host()
+
+
+def _local(tag):
+    # '{namespace}name' -> 'name'
+    return tag.rsplit("}", 1)[-1]
+
+
+def normalize_date(value):
+    """
+    Returns a W3C (sitemap) or RFC 822 (RSS) date as an ISO 8601 UTC timestamp, or `value` stripped if it cannot be
+    parsed. Dates without a time zone are taken as UTC.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        try:
+            date = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return value
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.astimezone(timezone.utc).isoformat()
+
+
+def parse_sitemap(body):
+    """
+    Parse a sitemap or sitemap index (possibly gzipped).
+
+    Returns:
+        urls (list[tuple(str,str)]) : (url, lastmod) of the pages listed in a sitemap.
+        sitemaps (list[tuple(str,str)]) : (url, lastmod) of the sitemaps listed in a sitemap index.
+    """
+    if body[:2] == b"\x1f\x8b":
+        body = gzip.decompress(body)
+    urls, sitemaps = list(), list()
+    for _, elem in ET.iterparse(io.BytesIO(body), events=("end",)):
+        tag = _local(elem.tag)
+        if tag not in ("url", "sitemap"):
+            continue
+        fields = {_local(child.tag): (child.text or "").strip() for child in elem}
+        if fields.get("loc"):
+            (urls if tag == "url" else sitemaps).append((fields["loc"], normalize_date(fields.get("lastmod"))))
+        elem.clear()
+    return urls, sitemaps
+
+
+def parse_feed(body):
+    """
+    Parse an RSS (0.9x, 1.0 or 2.0) or Atom feed.
+
+    Returns:
+        entries (list[tuple(str,str)]) : (link, publication or update date) of each item.
+    """
+    entries = list()
+    for _, elem in ET.iterparse(io.BytesIO(body), events=("end",)):
+        tag = _local(elem.tag)
+        if tag not in ("item", "entry"):
+            continue
+        link, date = None, None
+        for child in elem:
+            name = _local(child.tag)
+            if name == "link" and child.get("rel", "alternate") == "alternate":
+                link = link or child.get("href") or (child.text or "").strip()
+            elif name in ("pubDate", "date", "updated", "published") and date is None:
+                date = child.text
+        if link:
+            entries.append((link, normalize_date(date)))
+        elem.clear()
+    return entries
+
+
+class SiteHarvest:
+    """
+    Harvest of one source: robots.txt, then its feed and sitemaps, one request at a time.
+
+    Args:
+        client (HttpClient) : The shared client.
+        source (str) : Source name.
+        feed_url (str) : URL of the source's feed, also used to locate the site.
+        emit (callable) : Called with each entry (dict).
+        max_sitemaps (int) : Sitemaps read per site. Sitemap indexes are followed most recent first.
+        recent_days (int) : Entries dated less than this many days ago count as recent.
+    """
+
+    def __init__(self, client, source, feed_url, emit, max_sitemaps=20, recent_days=30):
+        self.client = client
+        self.source = source
+        self.feed_url = feed_url
+        parts = urlsplit(feed_url)
+        self.base = f"{parts.scheme}://{parts.netloc}"
+        self.emit = emit
+        self.max_sitemaps = max_sitemaps
+        self.recent_after = datetime.fromtimestamp(time.time() - recent_days * 86400, timezone.utc).isoformat()
+        self.robots = RobotFileParser()
+        self.urls = set()
+        self.summary = {"source": source, "feed_url": feed_url, "host": parts.hostname, "live": False,
+                        "robots_status": None, "feed_status": None, "sitemaps": 0, "feed_entries": 0,
+                        "sitemap_entries": 0, "distinct_urls": 0, "latest": None, "recent_entries": 0,
+                        "errors": ""}
+
+    async def _get(self, url):
+        try:
+            response = await self.client.get(url)
+        except (OSError, asyncio.TimeoutError, HttpError, ValueError, EOFError) as e:
+            message = str(e) or type(e).__name__
+            logger.debug(f"{self.source}: {url}: {message}")
+            self.summary["errors"] += f"{url}: {message}; "
+            return None
+        # Any response, even an error status, means that the site is up
+        self.summary["live"] = True
+        return response
+
+    def _add(self, url, lastmod, via, origin):
+        self.urls.add(url)
+        if lastmod is not None and lastmod[:1].isdigit():
+            if self.summary["latest"] is None or lastmod > self.summary["latest"]:
+                self.summary["latest"] = lastmod
+            if lastmod >= self.recent_after:
+                self.summary["recent_entries"] += 1
+        self.emit({"source": self.source, "url": url, "lastmod": lastmod, "via": via, "from": origin})
+
+    async def run(self):
+        robots = await self._get(f"{self.base}/robots.txt")
+        if robots is None:
+            return self.summary  # The site is down
+        self.summary["robots_status"] = robots.status
+        if robots.status in (401, 403) or robots.status >= 500:
+            self.robots.disallow_all = True
+        elif robots.status >= 400:
+            self.robots.allow_all = True
+        else:
+            self.robots.parse(robots.body.decode("utf-8", errors="replace").splitlines())
+
+        await self._harvest_feed()
+        await self._harvest_sitemaps(self.robots.site_maps() or [f"{self.base}/sitemap.xml"])
+        self.summary["distinct_urls"] = len(self.urls)
+        return self.summary
+
+    def _allowed(self, url):
+        return self.robots.can_fetch(self.client.user_agent, url)
+
+    async def _harvest_feed(self):
+        if not self._allowed(self.feed_url):
+            self.summary["errors"] += f"{self.feed_url}: disallowed by robots.txt; "
+            return
+        response = await self._get(self.feed_url)
+        if response is None:
+            return
+        self.summary["feed_status"] = response.status
+        if response.status not in (200, 304):
+            return
+        try:
+            entries = parse_feed(response.body)
+        except ET.ParseError as e:
+            self.summary["errors"] += f"{self.feed_url}: {e}; "
+            return
+        for link, date in entries:
+            self._add(link, date, "feed", self.feed_url)
+        self.summary["feed_entries"] = len(entries)
+
+    async def _harvest_sitemaps(self, sitemaps):
+        todo, seen = [(url, None) for url in sitemaps], set()
+        while todo and self.summary["sitemaps"] < self.max_sitemaps:
+            url, _ = todo.pop(0)
+            if url in seen or not self._allowed(url):
+                continue
+            seen.add(url)
+            response = await self._get(url)
+            if response is None or response.status not in (200, 304):
+                continue
+            self.summary["sitemaps"] += 1
+            try:
+                urls, children = parse_sitemap(response.body)
+            except (ET.ParseError, OSError, EOFError, zlib.error) as e:
+                self.summary["errors"] += f"{url}: {e}; "
+                continue
+            for loc, lastmod in urls:
+                self._add(loc, lastmod, "sitemap", url)
+            self.summary["sitemap_entries"] += len(urls)
+            # Most recently modified sitemaps first (undated ones last)
+            todo += sorted(children, key=lambda c: c[1] or "", reverse=True)
+
+
+async def harvest(sources, output_path, max_sites=32, max_sitemaps=20, recent_days=30, **client_args):
+    """
+    Harvest the sitemaps and feeds of `sources`, streaming the entries to `output_path`.
+
+    Args:
+        sources (list[tuple(str,str)]) : (source, feed_url) pairs, as in `ps_sources.txt`.
+        output_path (str or Path) : JSONL output (e.g. `harvest/entries.jsonl.gz`). Each line has the `source`,
+            the `url` and `lastmod` date of an entry, `via` ('feed' or 'sitemap') and the document it came `from`.
+        max_sites (int) : Sites harvested at once.
+        max_sitemaps (int) : Sitemaps read per site.
+        recent_days (int) : Entries dated less than this many days ago count as recent.
+        client_args : Arguments of `HttpClient`.
+
+    Returns:
+        sites (list[dict]) : Summary of each source, with the fields in `SITE_FIELDS`.
+    """
+    client = HttpClient(**client_args)
+    sites_in_flight = asyncio.Semaphore(max_sites)
+    summaries = list()
+    with span("harvest", sites=len(sources)) as s, JsonlWriter(output_path) as writer:
+        async def run(source, feed_url):
+            site = SiteHarvest(client, source, feed_url, writer.write, max_sitemaps, recent_days)
+            async with sites_in_flight:
+                try:
+                    summary = await site.run()
+                except Exception as e:
+                    # One misbehaving site must not end the harvest of the others
+                    logger.error(f"{source}: harvest failed: {e!r}")
+                    summary = site.summary
+                    summary["errors"] += f"{type(e).__name__}: {e}; "
+            client.pool.close_host(summary["host"])
+            s.count("sites")
+            s.count("live", int(summary["live"]))
+            s.count("entries", summary["feed_entries"] + summary["sitemap_entries"])
+            summaries.append(summary)
+            logger.info(f"{source}: {'live' if summary['live'] else 'down'}, {summary['feed_entries']} feed and "
+                        f"{summary['sitemap_entries']} sitemap entries")
+
+        try:
+            await asyncio.gather(*(run(source, feed_url) for source, feed_url in sources))
+        finally:
+            client.close()
+        s.count("connections_opened", client.pool.opened)
+        s.count("connections_reused", client.pool.reused)
+    order = {source: i for i, (source, _) in enumerate(sources)}
+    return sorted(summaries, key=lambda summary: order[summary["source"]])
+
+
+def main(config):
+    """
+    Harvest the sitemaps and feeds of the NELA PS sources into `harvest/entries.jsonl`, with a summary of each site
+    in `harvest/sites.csv`.
+    """
+    sources = load_source_list(Path(config.path.data).joinpath("ps_sources.txt"))
+    output_dir = Path("harvest")
+    cache = ResponseCache(Path("cache").joinpath("harvest"))
+    sites = asyncio.run(harvest(sources, output_dir.joinpath("entries.jsonl"), cache=cache,
+                                **config.get("harvest", {})))
+    with CsvWriter(output_dir.joinpath("sites.csv"), fieldnames=SITE_FIELDS) as writer:
+        writer.write_all(sites)
+    logger.info(f"{sum(site['live'] for site in sites)} of {len(sites)} sites are live")
+
+
+if __name__ == "__main__":
+    main(init_workspace(config_path="config/config.yaml"))
@@ -0,0 +1,208 @@
+"""
+Fuzzy matching of source names against the media network lists.
+
+Names are normalized the same way as in the original exact cross-referencing, then indexed by their character
+n-grams in an inverted index. A batch of queries is scored at once with numpy, using the Dice coefficient of the
+n-gram sets, and only (query, name) pairs that share an n-gram are ever scored, so the cost grows with the number of
+shared n-grams rather than with (queries x names). N-grams found in a large fraction of the names (e.g. those of
+'businessdaily') say little about which outlet a name refers to and would dominate that cost, so they are not used to
+find candidates. They still count in the score, which is the Dice coefficient of the full n-gram sets: leaving them
+out would inflate the score of names that only share such n-grams with the query.
+"""
+import logging
+import re
+from pathlib import Path
+
+import numpy as np
+
+from utils.fileio import iter_lines, strip_compression
+
+
+logger = logging.getLogger(__name__)
+
+
+_NAME_JUNK = re.compile(r'(\.com|\W+)')
+
+
+def normalize_name(s):
+    """
+    Lowercase `s` and strip '.com' and non-word characters (e.g. 'Alabama Business Daily' -> 'alabamabusinessdaily').
+    """
+    return _NAME_JUNK.sub('', s.strip().lower())
+
+
+def _unique_counts(a):
+    # Sort-based equivalent of np.unique(a, return_counts=True)
+    a = np.sort(a)
+    first = np.flatnonzero(np.r_[True, a[1:] != a[:-1]])
+    return a[first], np.diff(np.r_[first, len(a)])
+
+
+# Number of set bits of each byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+
+def load_network_lists(directory):
+    """
+    Read the network lists in `directory` (one `<network>.txt` file per network, one source name per line, possibly
+    compressed as `<network>.txt.gz` and so on).
+
+    Returns:
+        network_sources (dict[str,list[str]]) : Normalized, non-empty source names of each network.
+    """
+    network_sources = dict()
+    for file in sorted(Path(directory).glob("*.txt*")):
+        plain = strip_compression(file)
+        if plain.suffix != ".txt":
+            continue
+        names = (normalize_name(line) for line in iter_lines(file))
+        network_sources[plain.stem] = [n for n in names if len(n) > 0]
+    return network_sources
+
+
+def _ngram_codes(strings, n):
+    """
+    Extract the distinct byte n-grams of each string (padded with '^' and '$') as integer codes.
+
+    Returns:
+        owner (np.ndarray) : Index of the string each n-gram belongs to.
+        codes (np.ndarray) : The n-gram codes, unique per string.
+    """
+    padded = [f"^{s}$".encode("utf-8") for s in strings]
+    lengths = np.fromiter(map(len, padded), dtype=np.int64, count=len(padded))
+    buf = np.frombuffer(b"".join(padded), dtype=np.uint8).astype(np.int64)
+    starts = np.cumsum(lengths) - lengths
+    pos = np.arange(len(buf)) - np.repeat(starts, lengths)
+    owner = np.repeat(np.arange(len(padded)), lengths)
+    valid = pos <= np.repeat(lengths, lengths) - n
+    idx = np.flatnonzero(valid)
+    codes = np.zeros(len(idx), dtype=np.int64)
+    for k in range(n):
+        codes = (codes << 8) | buf[idx + k]
+    keys, _ = _unique_counts((owner[idx] << (8 * n)) | codes)
+    return keys >> (8 * n), keys & ((1 << (8 * n)) - 1)
+
+
+class NetworkMatcher:
+    """
+    Character n-gram index over the source names of each network.
+
+    Args:
+        network_sources (dict[str,list[str]]) : Normalized source names of each network (see `load_network_lists`).
+        n (int) : Length of the n-grams (of UTF-8 bytes), at most 4.
+        max_df (float) : N-grams found in more than this fraction of the names are not used to find candidates.
+        chunk_size (int) : Number of queries scored at once, to cap memory use.
+    """
+
+    def __init__(self, network_sources, n=3, max_df=0.02, chunk_size=65536):
+        if not 1 <= n <= 4:
+            raise ValueError(f"n-gram length must be between 1 and 4, got {n}")
+        self.n = n
+        self.chunk_size = chunk_size
+        # A name listed by several networks is assigned to the last one, as in the original exact lookup
+        name_network = dict()
+        for network, names in network_sources.items():
+            for name in names:
+                name_network[name] = network
+        self.names = list(name_network)
+        self.networks = [name_network[name] for name in self.names]
+        self.exact = {name: i for i, name in enumerate(self.names)}
+
+        owner, codes = _ngram_codes(self.names, n)
+        self.vocab, gid, df = np.unique(codes, return_inverse=True, return_counts=True)
+        self.stop = df > max(1, int(max_df * len(self.names)))
+        keep = ~self.stop[gid]
+        self.name_sizes = np.bincount(owner, minlength=len(self.names))
+
+        # Stop n-grams of each name, as a bitset over the (few) stop n-grams, to count those shared by a candidate
+        self.stop_bit = np.cumsum(self.stop) - 1
+        self.name_stop = self._stop_bitsets(owner[~keep], gid[~keep], len(self.names))
+
+        # Inverted index in CSR form: names containing n-gram `g` are postings[indptr[g]:indptr[g + 1]]
+        order = np.argsort(gid[keep], kind="stable")
+        self.postings = owner[keep][order]
+        self.indptr = np.concatenate([[0], np.cumsum(np.bincount(gid[keep], minlength=len(self.vocab)))])
+
+    def _stop_bitsets(self, owner, gid, size):
+        # Packed bitsets (one row per string) of the stop n-grams `gid` of each string `owner`
+        bits = np.zeros((size, int(self.stop.sum())), dtype=bool)
+        bits[owner, self.stop_bit[gid]] = True
+        return np.packbits(bits, axis=1)
+
+    @classmethod
+    def from_directory(cls, directory, **kwargs):
+        """
+        Build the index from the network lists in `directory` (e.g. `results/media_network_lists`).
+        """
+        return cls(load_network_lists(directory), **kwargs)
+
+    def _score_chunk(self, queries):
+        n_names = len(self.names)
+        best = np.full(len(queries), -1, dtype=np.int64)
+        best_scores = np.zeros(len(queries))
+        if n_names == 0 or len(self.vocab) == 0:
+            return best, best_scores
+
+        owner, codes = _ngram_codes(queries, self.n)
+        pos = np.minimum(np.searchsorted(self.vocab, codes), len(self.vocab) - 1)
+        found = self.vocab[pos] == codes
+        stop = found & self.stop[pos]
+        q_sizes = np.bincount(owner, minlength=len(queries))
+        q_stop = self._stop_bitsets(owner[stop], pos[stop], len(queries))
+        keep = found & ~stop
+        qi, gid = owner[keep], pos[keep]
+
+        # Expand every (query, n-gram) pair into the names that contain the n-gram
+        starts = self.indptr[gid]
+        lengths = self.indptr[gid + 1] - starts
+        total = int(lengths.sum())
+        if total == 0:
+            return best, best_scores
+        offsets = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+        keys = np.repeat(qi, lengths) * n_names + self.postings[offsets]
+
+        # Score only the (query, name) cells that share at least one n-gram
+        cells, overlap = _unique_counts(keys)
+        q, name = cells // n_names, cells % n_names
+        overlap = overlap + _POPCOUNT[q_stop[q] & self.name_stop[name]].sum(axis=1)
+        scores = 2 * overlap / (q_sizes[q] + self.name_sizes[name])
+        # Cells are sorted by query, so each query's candidates form a contiguous segment
+        seg_starts = np.flatnonzero(np.r_[True, q[1:] != q[:-1]])
+        seg_max = np.maximum.reduceat(scores, seg_starts)
+        seg_lengths = np.diff(np.r_[seg_starts, len(q)])
+        is_max = np.flatnonzero(scores == np.repeat(seg_max, seg_lengths))
+        first = is_max[np.r_[True, q[is_max][1:] != q[is_max][:-1]]]
+        best[q[first]] = name[first]
+        best_scores[q[first]] = scores[first]
+        return best, best_scores
+
+    def match(self, queries):
+        """
+        Find the best matching network source for each query.
+
+        Args:
+            queries (list[str]) : Source names (normalized with `normalize_name` internally).
+
+        Returns:
+            matches (list[tuple(str,str,float)]) : (network, matched name, score) for each query. `score` is 1.0 for
+                exact matches and the n-gram Dice similarity otherwise. Network and name are `None` without a candidate.
+        """
+        normalized = [normalize_name(q) for q in queries]
+        results = [None] * len(normalized)
+        fuzzy = list()
+        for i, q in enumerate(normalized):
+            j = self.exact.get(q)
+            if j is not None:
+                results[i] = (self.networks[j], self.names[j], 1.0)
+            else:
+                fuzzy.append(i)
+
+        for start in range(0, len(fuzzy), self.chunk_size):
+            idx = fuzzy[start:start + self.chunk_size]
+            best, scores = self._score_chunk([normalized[i] for i in idx])
+            for i, j, score in zip(idx, best, scores):
+                if j < 0 or score <= 0:
+                    results[i] = (None, None, 0.0)
+                else:
+                    results[i] = (self.networks[j], self.names[j], float(score))
+        return results
@@ -1,83 +1,285 @@
 import requests
-from bs4 import BeautifulSoup
+from bs4.dammit import UnicodeDammit
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
 from pathlib import Path
+import hashlib
+import json
 import logging
+import os
+import threading
 
 from utils.config import init_workspace
+from utils.fileio import LineWriter
+from utils.instrument import span, count
 
 logger = logging.getLogger(__name__)
 
-def get_metric_media():
+# Registry of network scrapers: name -> {"url", "headers", "extract"}
+SCRAPERS = dict()
+
+
+def register_scraper(name, url, headers=None):
     """
-    Fetch the list of sites from Metric Media News
+    Register a function that extracts the list of sources of a network from its page.
+
+    Args:
+        name (str) : Name of the network. Also used as the name of the output list.
+        url (str) : URL of the page listing the network's sources.
+        headers (dict) : Extra request headers.
 
     Returns:
-        sources (list[str]) : The list of source names.
+        decorator (callable) : Decorator that registers a function `extract(html) -> list[str]`.
+    """
+    def decorator(extract):
+        SCRAPERS[name] = {"url": url, "headers": headers or dict(), "extract": extract}
+        return extract
+    return decorator
+
+
+class AnchorTextParser(HTMLParser):
+    """
+    Streaming parser that collects the text of every `<a>` element, without building a document tree.
     """
-    url = "https://metricmedianews.com/"
 
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, features="html.parser")
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.texts = list()
+        self._depth = 0
+        self._parts = list()
 
-    sources = list()
-    links = soup.find_all("a")
-    for item in links:
-        sources.append(item.text)
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            if self._depth == 0:
+                self._parts = list()
+            self._depth += 1
 
-    return sources
+    def handle_endtag(self, tag):
+        if tag == "a" and self._depth > 0:
+            self._depth -= 1
+            if self._depth == 0:
+                self.texts.append("".join(self._parts))
 
+    def handle_data(self, data):
+        if self._depth > 0:
+            self._parts.append(data)
 
-def get_franklin_archer():
-    url = "https://web.archive.org/web/20200501201541/https://franklinarcher.com/our_publications"
-    r = requests.get(url)
-    soup = BeautifulSoup(r.content, features="html.parser")
 
-    sources = list()
-    links = soup.find_all("a")
-    for item in links:
-        sources.append(item.text)
+def extract_anchor_text(html):
+    """
+    Returns the text of every `<a>` element in `html`, in document order.
+    """
+    parser = AnchorTextParser()
+    parser.feed(html)
+    parser.close()
+    return parser.texts
 
-    return sources
 
+class ResponseCache:
+    """
+    On-disk cache of HTTP responses with their validators (ETag and Last-Modified).
 
-def get_lgis():
-    url = "https://lgis.co/our_publications"
-    r = requests.get(url, headers={"User-Agent": "Mozilla/5.0"})
-    soup = BeautifulSoup(r.content, features="html.parser")
-    print(soup)
-    sources = list()
-    links = soup.find_all("a")
-    for item in links:
-        if len(item.text.strip()) > 0:
-            sources.append(item.text.strip())
+    Args:
+        path (str or Path) : Cache directory.
+    """
 
-    return sources
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(exist_ok=True, parents=True)
 
+    def _key(self, url):
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def get(self, url):
+        """
+        Returns the cached (metadata, body) for `url`, or `None` if it is not cached.
+        """
+        key = self._key(url)
+        meta_path = self.path.joinpath(f"{key}.json")
+        body_path = self.path.joinpath(f"{key}.body")
+        try:
+            meta = meta_path.read_text()
+            body = body_path.read_bytes()
+            if meta_path.read_text() != meta:
+                return None  # Replaced while it was read
+            return json.loads(meta), body
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, url, meta, body):
+        """
+        Store the response to `url`. Each file is written to a temporary file and moved in place, the body first and
+        the metadata last, so an interrupted write never pairs a body with the validators of another.
+        """
+        key = self._key(url)
+        meta_path = self.path.joinpath(f"{key}.json")
+        # Unique temporary names, as concurrent runs may share the cache
+        suffix = f"{os.getpid()}.{threading.get_ident()}.tmp"
+        body_tmp = self.path.joinpath(f"{key}.body.{suffix}")
+        meta_tmp = self.path.joinpath(f"{key}.json.{suffix}")
+        try:
+            # Invalidate the old metadata first, so its validators are never sent with a new body
+            meta_path.unlink(missing_ok=True)
+            body_tmp.write_bytes(body)
+            os.replace(body_tmp, self.path.joinpath(f"{key}.body"))
+            with open(meta_tmp, "w") as fout:
+                json.dump(meta, fout)
+            os.replace(meta_tmp, meta_path)
+        finally:
+            body_tmp.unlink(missing_ok=True)
+            meta_tmp.unlink(missing_ok=True)
+
+
+def make_session(pool_size=10):
+    """
+    Create a `requests.Session` with a connection pool shared by all scrapers.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def declared_charset(content_type):
+    """
+    Returns the charset parameter of a Content-Type header, or `None` if it has none.
+    """
+    for param in (content_type or "").split(";")[1:]:
+        name, _, value = param.partition("=")
+        if name.strip().lower() == "charset":
+            return value.strip().strip("'\"") or None
+    return None
+
+
+def decode_html(body, charset=None):
+    """
+    Decode a page with the charset declared by the server or, without one, the encoding detected from its bytes
+    (byte order mark, `<meta charset>` or content), as BeautifulSoup does.
+    """
+    if charset is not None:
+        try:
+            return body.decode(charset, errors="replace")
+        except LookupError:
+            logger.warning(f"Unknown charset {charset!r}, detecting the encoding instead")
+    return UnicodeDammit(body, is_html=True).unicode_markup or ""
+
+
+def fetch(session, url, cache=None, headers=None, timeout=30):
+    """
+    Fetch `url`, using a conditional request if a cached copy exists.
+    An unchanged page costs a 304 response, and its body is served from `cache`. The raw body is cached, and decoded
+    with `decode_html`.
+
+    Args:
+        session (requests.Session) : The session to send the request with.
+        url (str) : Target URL.
+        cache (ResponseCache) : Response cache. If `None`, requests are unconditional.
+        headers (dict) : Extra request headers.
+        timeout (float) : Request timeout in seconds.
+
+    Returns:
+        html (str) : The decoded page.
+    """
+    headers = dict(headers or dict())
+    cached = cache.get(url) if cache is not None else None
+    if cached is not None:
+        meta, body = cached
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    r = session.get(url, headers=headers, timeout=timeout)
+    if r.status_code == 304 and cached is not None:
+        logger.info(f"Not modified: {url}")
+        count("not_modified")
+    else:
+        r.raise_for_status()
+        meta = {"url": url, "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified"),
+                "charset": declared_charset(r.headers.get("Content-Type"))}
+        body = r.content
+        if cache is not None:
+            cache.put(url, meta, body)
+    return decode_html(body, meta.get("charset"))
+
+
+@register_scraper("metric_media", "https://metricmedianews.com/")
+def get_metric_media(html):
+    """
+    Extract the list of sites from Metric Media News
+
+    Returns:
+        sources (list[str]) : The list of source names.
+    """
+    return extract_anchor_text(html)
 
-if __name__ == "__main__":
-    config = init_workspace(config_path="config/config.yaml")
-    mm_sources = get_metric_media() 
-    logger.info(f"Got {len(mm_sources)} sources from Metric Media News")
 
-    path_mm = Path("media_network_lists").joinpath("metric_media.txt")
-    path_mm.parent.mkdir(exist_ok=True, parents=True)
+@register_scraper("franklin_archer",
+                  "https://web.archive.org/web/20200501201541/https://franklinarcher.com/our_publications")
+def get_franklin_archer(html):
+    return extract_anchor_text(html)
 
-    with open(path_mm, "w") as fout:
-        for s in mm_sources:
-            fout.write(f"{s}\n")
 
-    fa_sources = get_franklin_archer()
-    path_fa = Path("media_network_lists").joinpath("franklin_archer.txt")
-    with open(path_fa, "w") as fout:
-        for s in fa_sources:
-            fout.write(f"{s}\n")
-    lgis_sources = get_lgis()
-    logger.info(f"Got {len(lgis_sources)} sources from LGIS")
-    path_fa = Path("media_network_lists").joinpath("lgis.txt")
-    with open(path_fa, "w") as fout:
-        for s in lgis_sources:
-            fout.write(f"{s}\n")
+@register_scraper("lgis", "https://lgis.co/our_publications", headers={"User-Agent": "Mozilla/5.0"})
+def get_lgis(html):
+    return [text.strip() for text in extract_anchor_text(html) if len(text.strip()) > 0]
 
-    
 
+def run_scrapers(names=None, session=None, cache=None, workers=4, timeout=30, urls=None):
+    """
+    Run the registered scrapers concurrently.
+
+    Args:
+        names (list[str]) : Scrapers to run. If `None`, run all registered scrapers.
+        session (requests.Session) : Shared session. A pooled session is created if `None`.
+        cache (ResponseCache) : Response cache for conditional requests.
+        workers (int) : Number of threads.
+        timeout (float) : Request timeout in seconds.
+        urls (dict) : Optional overrides of the scraper URLs (name -> url), e.g. to point at a local server.
+
+    Returns:
+        results (dict[str,list[str]]) : Sources of each network that was scraped successfully.
+    """
+    names = list(SCRAPERS) if names is None else names
+    urls = urls or dict()
+    session = session if session is not None else make_session(pool_size=workers)
+
+    def run(name, parent):
+        scraper = SCRAPERS[name]
+        with span("scrape", parent=parent, network=name) as s:
+            html = fetch(session, urls.get(name, scraper["url"]), cache=cache, headers=scraper["headers"],
+                         timeout=timeout)
+            s.count("chars", len(html))
+            sources = scraper["extract"](html)
+            s.count("sources", len(sources))
+        return sources
+
+    results = dict()
+    with span("scrape_sites", networks=len(names)) as outer, ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(run, name, outer) for name in names}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+                logger.info(f"Got {len(results[name])} sources from {name}")
+            except Exception as e:
+                logger.error(f"Failed to scrape {name}: {e}")
+    return results
 
+
+def main(config):
+    """
+    Scrape the source lists of the media networks into `media_network_lists/`.
+    """
+    output_dir = Path("media_network_lists")
+    output_dir.mkdir(exist_ok=True, parents=True)
+
+    results = run_scrapers(cache=ResponseCache(Path("cache").joinpath("http")))
+    for name, sources in results.items():
+        with LineWriter(output_dir.joinpath(f"{name}.txt")) as writer:
+            writer.write_all(sources)
+
+
+if __name__ == "__main__":
+    main(init_workspace(config_path="config/config.yaml"))
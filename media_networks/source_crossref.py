@@ -2,8 +2,6 @@
 Perform the cross-referencing of news sources from each network with the sources in our dataset.
 """
 import logging
-import re
-import json
 
 
 from pathlib import Path
@@ -12,48 +10,96 @@ import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+from analysis.asn import index_from_config
 from utils.config import init_workspace
+from utils.data import get_url_domain, load_source_list
+from utils.fileio import find_file, iter_jsonl
+from utils.registry import SourceRegistry, ip_observations_from_snapshot
+from utils.resolution_cache import ResolutionCache
+from utils.instrument import span
+from media_networks.matching import NetworkMatcher, load_network_lists
 
 
-if __name__ == "__main__":
-    config = init_workspace(config_path="config/config.yaml")
-    
-    # Read NELA PS sources
-    with open(config.path.data.joinpath("ps_sources.txt")) as fin:
-        ps_sources = list()
-        for line in fin:
-            src, feed = line.strip().split(',', 1)
-            ps_sources.append((src, feed))
-    
-    # Read media networks sources
-    media_network_dir = Path("media_network_lists")
-    network_sources = dict()
-    sources_network = dict()
-
-    for file in media_network_dir.iterdir():
-        network = file.stem
-        logger.info(f"{network}")
-        with open(file) as fin:
-            n_sources = [line.strip().lower() for line in fin.readlines() if len(line) > 0]
-        n_sources = list(map(lambda s: re.sub('(\.com|\W+)', '', s), n_sources))
-        network_sources[network] = set(n_sources)
-        for s in n_sources:
-            logger.info(f"{s=} {network=}")
-            sources_network[s] = network
-    
-    # Read IP addr data
-    source_ips = dict()
-    with open("ipaddrs/source_IPs.jsonl") as fin:
-        for line in fin:
-            d = json.loads(line)
-            source_ips[d['source']] = d["ipaddrlist"][0]
-
-
-    cross_data = list()
-    for src, feed in ps_sources:
-        src_network = sources_network[src] if src in sources_network else 'UNKNOWN'
-        src_ip = source_ips[src] if src in source_ips else 'UNKNOWN'
-        cross_data.append((src, src_network, src_ip))
+def load_source_ips(path):
+    """
+    Returns the first IP address of each source of a `source_IPs.jsonl` file.
+    """
+    return {d['source']: d["ipaddrlist"][0] for d in iter_jsonl(path)}
+
+
+def crossref(ps_sources, network_sources, source_ips, min_score=0.8, asn_index=None):
+    """
+    Match the NELA PS sources to the media networks.
+
+    Args:
+        ps_sources (list[tuple(str,str)]) : (source, feed_url) pairs (see `utils.data.load_source_list`).
+        network_sources (dict[str,list[str]]) : Source names of each network (see `load_network_lists`).
+        source_ips (dict[str,str]) : IP address of each source (see `load_source_ips`).
+        min_score (float) : Minimum n-gram similarity for a source to be assigned to a network.
+        asn_index (AsnIndex) : If not `None`, the ASN and organization of each address are added.
+
+    Returns:
+        df (DataFrame) : Columns `source`, `network` ('UNKNOWN' if not matched), `ipaddr` ('UNKNOWN' if not
+            resolved) and `match_score` (and `asn` and `as_org`), one row per source, in the order of `ps_sources`.
+    """
+    with span("crossref.index") as s:
+        matcher = NetworkMatcher(network_sources)
+        s.count("network_sources", len(matcher.names))
+    logger.info(f"Indexed {len(matcher.names)} network sources")
+
+    with span("crossref.match") as s:
+        matches = matcher.match([src for src, feed in ps_sources])
+        cross_data = list()
+        for (src, feed), (network, name, score) in zip(ps_sources, matches):
+            src_network = network if network is not None and score >= min_score else 'UNKNOWN'
+            src_ip = source_ips[src] if src in source_ips else 'UNKNOWN'
+            cross_data.append((src, src_network, src_ip, score))
+        s.count("matched", sum(1 for row in cross_data if row[1] != 'UNKNOWN'))
+
+    df = pd.DataFrame(cross_data, columns=['source', 'network', 'ipaddr', 'match_score'])
+    if asn_index is not None:
+        df = df.join(asn_index.annotate(df['ipaddr'].to_numpy()))
+    logger.info(f"Matched {(df['network'] != 'UNKNOWN').sum()} of {len(df)} sources to a network")
+    return df
+
+
+def main(config):
+    """
+    Match the NELA PS sources to the media networks, write `source_network.csv` and fill the registry.
+    """
     
-    df = pd.DataFrame(cross_data, columns=['source', 'network', 'ipaddr'])
+    with span("crossref.load") as s:
+        # Read NELA PS sources
+        ps_sources = load_source_list(config.path.data.joinpath("ps_sources.txt"))
+        s.count("sources", len(ps_sources))
+
+        # Read IP addr data
+        snapshot_path = find_file("ipaddrs/source_IPs.jsonl")
+        source_ips = load_source_ips(snapshot_path)
+        s.count("ip_records", len(source_ips))
+
+        # Read media networks sources
+        network_sources = load_network_lists(Path("media_network_lists"))
+
+    df = crossref(ps_sources, network_sources, source_ips, min_score=config.get("crossref", {}).get("min_score", 0.8),
+                  asn_index=index_from_config(config))
     df.to_csv("source_network.csv", index=None)
+
+    # Store the join in the registry, with every IP each domain resolved to over time
+    with span("crossref.registry"):
+        domains = {src: get_url_domain(feed) for src, feed in ps_sources}
+        registry = SourceRegistry(config.get("registry", {}).get("path", "registry.db"))
+        registry.upsert_networks(network_sources)
+        registry.upsert_sources((src, feed, domains[src], network, score)
+                                for (src, feed), network, score in zip(ps_sources, df['network'], df['match_score']))
+        cache_path = Path(config.get("resolution_cache", {}).get("path", "ipaddrs/resolution_cache.db"))
+        if cache_path.exists():
+            with ResolutionCache(cache_path) as cache:
+                registry.upsert_ips(cache.history())
+        else:
+            registry.upsert_ips(ip_observations_from_snapshot(iter_jsonl(snapshot_path), domains))
+        registry.close()
+
+
+if __name__ == "__main__":
+    main(init_workspace(config_path="config/config.yaml"))
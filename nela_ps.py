@@ -0,0 +1,180 @@
+"""
+Command line entry point of the NELA Pink Slime pipeline.
+
+    python nela_ps.py <command> [--config config/config.yaml]
+
+Each command lives in its own module, which is only imported when the command runs, so `--help` and light commands
+do not pay for matplotlib, pandas or requests. Keep the imports at the top of this file to the standard library.
+"""
+import argparse
+import importlib
+import sys
+
+
+DEFAULT_CONFIG = "config/config.yaml"
+
+# Command -> (module exposing `main(config)`, help)
+COMMANDS = {
+    "resolve": ("ping_source_ips", "Resolve the IP addresses of the sources"),
+    "scrape": ("media_networks.scrape_sites", "Scrape the source lists of the media networks"),
+    "harvest": ("media_networks.harvest", "Check which sources are live and harvest their sitemaps and feeds"),
+    "crossref": ("media_networks.source_crossref", "Match the sources to the media networks"),
+    "distributions": ("analysis.source_distributions", "Count the distinct IP addresses of each network"),
+    "infrastructure": ("analysis.infrastructure", "Cluster the sources by shared hosting"),
+    "stats": ("analysis.source_stats", "Compute per-source and per-network publishing statistics"),
+    "templates": ("analysis.templates", "Find templated, near-duplicate articles across sources"),
+    "plot": ("plot.over_time", "Plot the number of articles of each network over time"),
+}
+
+
+def run_command(args):
+    from utils.config import init_workspace
+    module_name, _ = COMMANDS[args.command]
+    module = importlib.import_module(module_name)
+    module.main(init_workspace(config_path=args.config))
+
+
+def make_stages(config):
+    """
+    Returns the stages of the end-to-end workflow, with the files each one reads and writes (see utils/pipeline.py).
+    """
+    from utils.pipeline import Stage
+    registry = config.get("registry", {}).get("path", "registry.db")
+    resolution_cache = config.get("resolution_cache", {}).get("path", "ipaddrs/resolution_cache.db")
+    asn_prefixes = config.get("asn", {}).get("prefixes", None)
+    asn_inputs = [f"{{data}}/{asn_prefixes}"] if asn_prefixes else []
+    return [
+        # Remote state (network pages, DNS records, live sites) changes without any input changing, so these stages run
+        # every time: `scrape` revalidates its cached pages and `resolve` only looks up the expired domains
+        Stage("scrape", COMMANDS["scrape"][0], outputs=["media_network_lists"], always=True),
+        Stage("resolve", COMMANDS["resolve"][0], inputs=["{data}/ps_sources.txt"] + asn_inputs,
+              outputs=["ipaddrs/source_IPs.jsonl", resolution_cache], params=["resolver", "resolution_cache", "asn"],
+              always=True),
+        Stage("crossref", COMMANDS["crossref"][0],
+              inputs=["{data}/ps_sources.txt", "media_network_lists", "ipaddrs/source_IPs.jsonl", resolution_cache]
+              + asn_inputs,
+              outputs=["source_network.csv", registry], params=["crossref", "registry", "asn"]),
+        Stage("harvest", COMMANDS["harvest"][0], inputs=["{data}/ps_sources.txt"], outputs=["harvest"],
+              params=["harvest"], always=True),
+        Stage("distributions", COMMANDS["distributions"][0], inputs=[registry]),
+        Stage("infrastructure", COMMANDS["infrastructure"][0], inputs=[registry] + asn_inputs,
+              outputs=["infrastructure"], params=["asn"]),
+        Stage("stats", COMMANDS["stats"][0], inputs=["{data}/nela_ps_final.db"], outputs=["stats"], params=["stats"]),
+        Stage("templates", COMMANDS["templates"][0], inputs=["{data}/nela_ps_final.db"], outputs=["templates"],
+              params=["templates"]),
+        Stage("plot", COMMANDS["plot"][0], inputs=["{data}/nela_ps_final.db"], outputs=["plots/stack_plot.pdf"],
+              params=["plot"]),
+    ]
+
+
+def run_pipeline(args):
+    from utils.config import load_conf_and_merge
+    from utils.logging import get_logging_config, set_logging_conf
+    from utils.pipeline import Pipeline
+    # The runner stays in the current directory; each stage sets up its workspace in its own process
+    config = load_conf_and_merge(args.config)
+    set_logging_conf(get_logging_config(config.path.logging_conf))
+    pipeline = Pipeline(make_stages(config), config, args.config)
+    if args.until is not None and args.until not in pipeline.stages:
+        raise SystemExit(f"Unknown stage {args.until!r}. Expected one of {list(pipeline.stages)}.")
+    force = True if args.force == [] else args.force
+    status = pipeline.run(force=force, until=args.until, workers=args.workers, dry_run=args.dry_run)
+    for name, s in status.items():
+        print(f"{name:<16}{s}")
+    return 1 if any(s in ("failed", "blocked") for s in status.values()) else 0
+
+
+def run_load(args):
+    # SQLite databases are queried, anything else is read as NELA JSON
+    if args.path.endswith(".db"):
+        from examples.load_sqlite3_data import load
+        load(args.path)
+    else:
+        from examples.load_json_data import load
+        load(args.path, args.workers)
+
+
+def run_search(args):
+    from utils.fts import update_fts, search, count_matches
+    if args.db is None:
+        from utils.config import load_conf_and_merge
+        args.db = f"{load_conf_and_merge(args.config).path.data}/nela_ps_final.db"
+    # Index the rows added since the last search (a no-op if there are none)
+    update_fts(args.db)
+    filters = dict(networks=args.network, sources=args.source, start=args.start, end=args.end)
+    results = search(args.db, args.query, page=args.page, page_size=args.page_size, **filters).fillna("-")
+    print(f"{count_matches(args.db, args.query, **filters)} matches, page {args.page}")
+    for r in results.itertuples():
+        print(f"{r.score:9.3f}  {r.date}  {r.source} ({r.network})  {r.title}\n{' ' * 11}{r.snippet}")
+
+
+def run_ingest(args):
+    from utils.config import load_conf_and_merge
+    from utils.ingest import ingest, load_networks
+    from utils.logging import get_logging_config, set_logging_conf
+    config = load_conf_and_merge(args.config)
+    set_logging_conf(get_logging_config(config.path.logging_conf))
+    db_path = args.db or f"{config.path.data}/nela_ps_final.db"
+    networks = load_networks(f"{config.path.output_dir}/source_network.csv")
+    summary = ingest(db_path, args.paths, networks=networks, batch_size=args.batch_size, force=args.force)
+    print(f"{summary['inserted'].sum()} new articles of {summary['articles'].sum()} from {len(summary)} files")
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(prog="nela_ps", description="NELA Pink Slime pipeline")
+    subparsers = parser.add_subparsers(dest="command", metavar="command", required=True)
+    for name, (_, description) in COMMANDS.items():
+        p = subparsers.add_parser(name, help=description, description=description)
+        p.add_argument("--config", type=str, default=DEFAULT_CONFIG, help="Path to the config file")
+        p.set_defaults(func=run_command)
+
+    p = subparsers.add_parser("run", help="Run the stages of the workflow that are out of date",
+                              description="Run the stages of the workflow that are out of date, in parallel where "
+                                          "they do not depend on each other")
+    p.add_argument("--config", type=str, default=DEFAULT_CONFIG, help="Path to the config file")
+    p.add_argument("--force", type=str, nargs="*", default=None, metavar="STAGE",
+                   help="Run these stages (all stages if none is given) even if they are up to date")
+    p.add_argument("--until", type=str, default=None, metavar="STAGE",
+                   help="Only run this stage and the stages it depends on")
+    p.add_argument("--workers", type=int, default=None, help="Max stages run at once")
+    p.add_argument("--dry-run", action="store_true", help="Only report which stages would run")
+    p.set_defaults(func=run_pipeline)
+
+    p = subparsers.add_parser("search", help="Full-text search of the titles and contents of the articles",
+                              description="Full-text search of the titles and contents of the articles, best match "
+                                          "first. The index is brought up to date with new articles first.")
+    p.add_argument("query", type=str, help="FTS5 query, e.g. '\"school board\" AND tax*'")
+    p.add_argument("--config", type=str, default=DEFAULT_CONFIG, help="Path to the config file")
+    p.add_argument("--db", type=str, default=None, help="NELA database (default: nela_ps_final.db in the data path)")
+    p.add_argument("--network", type=str, action="append", default=None, help="Only articles of this network")
+    p.add_argument("--source", type=str, action="append", default=None, help="Only articles of this source")
+    p.add_argument("--start", type=str, default=None, help="Only articles published on or after this date (UTC)")
+    p.add_argument("--end", type=str, default=None, help="Only articles published before this date (UTC)")
+    p.add_argument("--page", type=int, default=0, help="Page of results, from 0")
+    p.add_argument("--page-size", type=int, default=20, help="Results per page")
+    p.set_defaults(func=run_search)
+
+    p = subparsers.add_parser("ingest", help="Add the articles of NELA JSON files to the database",
+                              description="Add the articles of NELA JSON files to the database, skipping files that "
+                                          "were already ingested and articles already in the database")
+    p.add_argument("paths", type=str, nargs="+", help="NELA JSON files, or directories of them")
+    p.add_argument("--config", type=str, default=DEFAULT_CONFIG, help="Path to the config file")
+    p.add_argument("--db", type=str, default=None, help="NELA database (default: nela_ps_final.db in the data path)")
+    p.add_argument("--batch-size", type=int, default=50000, help="Articles inserted per transaction")
+    p.add_argument("--force", action="store_true", help="Read files even if they were already ingested")
+    p.set_defaults(func=run_ingest)
+
+    p = subparsers.add_parser("load", help="Load a NELA database or JSON dump and print a summary")
+    p.add_argument("path", type=str, help="Path to a NELA database (.db), a JSON file or a directory of JSON files")
+    p.add_argument("--workers", type=int, default=None, help="Worker processes used to load a directory")
+    p.set_defaults(func=run_load)
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,32 +1,22 @@
-import socket
-from urllib.parse import urlparse, urljoin
 from pathlib import Path
-import json
-import time
 
 import logging
+from analysis.asn import index_from_config
 from utils.config import init_workspace
-from utils.data import load_source_list
+from utils.data import load_source_list, get_url_domain
+from utils.resolver import Resolver
+from utils.resolution_cache import ResolutionCache
+from utils.instrument import span
 
 
 logger = logging.getLogger(__name__)
 
 
-def get_url_domain(url):
+def main(config):
     """
-    Returns the domain of a given `url`
-
-    Args:
-        url (str) : Input url
-    
-    Returns:
-        domain_url (str) : Domain URL
+    Resolve the domains of the sources that are missing from the resolution cache or expired, and write
+    `ipaddrs/source_IPs.jsonl`.
     """
-    parsed_url = urlparse(url)
-    return urljoin(parsed_url.scheme, parsed_url.netloc)
-
-if __name__ == "__main__":
-    config = init_workspace(config_path='config/config.yaml', do_chdir=True)
     logger.info(f"Starting pings")
 
     sources_path = Path(config.path.data).joinpath("ps_sources.txt")
@@ -35,15 +25,34 @@ if __name__ == "__main__":
     output_file = Path("ipaddrs").joinpath("source_IPs.jsonl")
     output_file.parent.mkdir(exist_ok=True, parents=True)
 
-    with open(f"{output_file}", "w") as fout:
-        for src, url in sources:
-            domain = get_url_domain(url)
-            logger.info(f"Pinging: {domain=}")
-            try:
-                time.sleep(0.5)  # Sleep before next ping to avoid exceeding rate limits
-                hostname, aliaslist, ipaddrlist = socket.gethostbyname_ex(domain)
-                obj = {"source": src, "hostname": hostname, "aliaslist": aliaslist, "ipaddrlist": ipaddrlist}
-                logger.info(f"Response: {obj=}")
-                fout.write(f"{json.dumps(obj)}\n")
-            except Exception as e:
-                logger.error(f"Failed to get host {src=}, {domain=}")
\ No newline at end of file
+    cache_conf = config.get("resolution_cache", {})
+    cache = ResolutionCache(cache_conf.get("path", "ipaddrs/resolution_cache.db"),
+                            default_ttl=cache_conf.get("default_ttl", 86400),
+                            min_ttl=cache_conf.get("min_ttl", 0))
+    removed = cache.register_sources((src, get_url_domain(url)) for src, url in sources)
+    if removed:
+        logger.info(f"Removed {removed} sources no longer in {sources_path} from the resolution cache")
+    stale = cache.stale_domains()
+    logger.info(f"Resolving {len(stale)} missing, expired or failed domains")
+
+    # Each result is committed to the cache as it arrives, so an interrupted run resumes where it stopped
+    resolver = Resolver(**config.get("resolver", {}))
+    with span("resolve", domains=len(stale)) as s:
+        for _, domain, result, error in resolver.resolve_many((d, d) for d in stale):
+            s.count("lookups")
+            if error is not None:
+                logger.error(f"Failed to get host {domain=}: {error}")
+                cache.record_failure(domain, error)
+                s.count("failures")
+                continue
+            logger.info(f"Response: {domain=} {result=}")
+            cache.record_success(domain, result)
+
+    with span("resolve.write_snapshot"):
+        cache.write_snapshot(output_file, asn_index=index_from_config(config))
+    logger.info(f"Resolution cache status: {cache.status_counts()}")
+    cache.close()
+
+
+if __name__ == "__main__":
+    main(init_workspace(config_path='config/config.yaml', do_chdir=True))
@@ -0,0 +1,221 @@
+"""
+Batch rendering of stacked time-series plots.
+
+A batch is a list of `PlotSpec`s (e.g. one plot per network, per bucket size, in linear and log scale). The data of
+each spec is read from the daily rollups in this process, and the figures are drawn in a pool of worker processes
+using the non-interactive Agg backend. Each worker reuses one figure for all of its plots.
+
+A spec is skipped if its output exists and neither its data nor its parameters changed since it was last rendered.
+Fingerprints are kept in `render_state.json`, next to the plots.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pandas as pd
+
+from utils.rollups import get_timeseries
+from utils.instrument import span
+
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = "render_state.json"
+
+# Changes to these files invalidate every rendered plot
+_CODE = [Path(__file__).with_name("over_time.py"), Path(__file__).with_name("stack_matrix.py")]
+
+
+class PlotSpec:
+    """
+    A stacked plot of the number of articles over time.
+
+    Args:
+        path (str or Path) : Output file (PDF). The legend is saved next to it.
+        db_path (str or Path) : Path to the NELA database (with up to date rollups, see `utils.rollups`).
+        days (int) : Size of the buckets (in days).
+        group_by (str) : Stack by 'network' or 'source'.
+        categories (list[str]) : Categories to plot, in stack order (after `labels`). If `None`, all of them by
+            decreasing total.
+        networks (list[str]) : Only plot these networks (needs `group_by='network'`).
+        sources (list[str]) : Only plot these sources, e.g. the sources of one state or network (needs
+            `group_by='source'`).
+        top (int) : Only keep the `top` largest categories; the rest are summed into 'Other'.
+        labels (dict[str,str]) : Category renames.
+        month_labels (bool) : Label the buckets by month (YYYY-MM) instead of day.
+        yscale (str) : 'linear' or 'log'.
+        options (dict) : Other keyword arguments of `plot.over_time.generate_stack_plot` (e.g. `fontsize`).
+    """
+
+    def __init__(self, path, db_path, days=7, group_by="network", categories=None, networks=None, sources=None,
+                 top=None, labels=None, month_labels=False, yscale="linear", options=None):
+        self.path = str(path)
+        self.db_path = str(db_path)
+        self.days = days
+        self.group_by = group_by
+        self.categories = list(categories) if categories is not None else None
+        self.networks = list(networks) if networks is not None else None
+        self.sources = list(sources) if sources is not None else None
+        self.top = top
+        self.labels = dict(labels or {})
+        self.month_labels = month_labels
+        self.yscale = yscale
+        self.options = dict(options or {})
+
+    def params(self):
+        """
+        Returns the parameters of the spec, as a JSON-serializable dict.
+        """
+        params = dict(vars(self))
+        params["db_path"] = str(Path(self.db_path).absolute())
+        return params
+
+    def __repr__(self):
+        return f"PlotSpec({self.path!r})"
+
+
+def load_data(spec):
+    """
+    Returns the long-format time series plotted by `spec` (columns `published_utc`, `date`, `articles` and the
+    category column).
+    """
+    t = get_timeseries(spec.db_path, days=spec.days, group_by=spec.group_by)
+    column = spec.group_by
+    if spec.networks is not None:
+        if column != "network":
+            raise ValueError(f"Filtering by network needs group_by='network', got {column!r}. "
+                             f"Use `sources` to plot the sources of a network.")
+        t = t[t[column].isin(spec.networks)]
+    if spec.sources is not None:
+        if column != "source":
+            raise ValueError(f"Filtering by source needs group_by='source', got {column!r}.")
+        t = t[t[column].isin(spec.sources)]
+    if spec.labels:
+        t = t.assign(**{column: t[column].replace(spec.labels)})
+    if spec.top is not None:
+        totals = t.groupby(column)["articles"].sum().sort_values(ascending=False)
+        others = ~t[column].isin(totals.index[:spec.top])
+        if others.any():
+            t = t.assign(**{column: t[column].where(~others, "Other")})
+            t = t.groupby(["published_utc", column], as_index=False).agg(date=("date", "min"),
+                                                                       articles=("articles", "sum"))
+    if spec.month_labels:
+        t = t.assign(date=t["date"].str.rsplit("-", n=1).str[0])
+    return t.reset_index(drop=True)
+
+
+def _fingerprint(spec, t, code):
+    data = hashlib.sha256(pd.util.hash_pandas_object(t, index=False).to_numpy().tobytes()).hexdigest()
+    payload = {"params": spec.params(), "data": data, "code": code}
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def _code_hash():
+    h = hashlib.sha256()
+    for path in _CODE:
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def _init_worker():
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+def _render_chunk(jobs):
+    # Runs in a worker process: draw every plot of the chunk on the same pair of figures
+    import matplotlib.pyplot as plt
+    from plot.over_time import generate_stack_plot, colors
+    fig = plt.figure(figsize=(14, 8))
+    figleg = plt.figure(figsize=(10, 0.5))
+    done = dict()
+    try:
+        for spec, t in jobs:
+            try:
+                Path(spec.path).parent.mkdir(exist_ok=True, parents=True)
+                kwargs = {"colors": colors, **spec.options}
+                generate_stack_plot(spec.path, t, spec.group_by, spec.categories, yscale=spec.yscale,
+                                    fig=fig, figleg=figleg, **kwargs)
+                done[spec.path] = None
+            except Exception as e:
+                done[spec.path] = repr(e)
+    finally:
+        plt.close(fig)
+        plt.close(figleg)
+    return done
+
+
+def _load_state(path):
+    try:
+        with open(path) as fin:
+            return json.load(fin)
+    except (OSError, ValueError):
+        return dict()
+
+
+def _save_state(path, state):
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with open(tmp_path, "w") as fout:
+        json.dump(state, fout, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def render_batch(specs, workers=None, force=False, state_dir="plots"):
+    """
+    Render the plots of `specs` whose data or parameters changed since they were last rendered.
+
+    Args:
+        specs (list[PlotSpec]) : The plots.
+        workers (int) : Number of worker processes (default: CPU count, at most one per plot to render).
+        force (bool) : Render every plot, even if it is up to date.
+        state_dir (str or Path) : Directory of the state file.
+
+    Returns:
+        status (dict[str,str]) : 'skipped', 'rendered' or 'failed' per output path.
+    """
+    state_path = Path(state_dir).joinpath(STATE_FILE)
+    state_path.parent.mkdir(exist_ok=True, parents=True)
+    state = _load_state(state_path)
+    code = _code_hash()
+    status = dict()
+    todo = list()  # (spec, data, fingerprint)
+
+    with span("plot.batch") as s:
+        for spec in specs:
+            t = load_data(spec)
+            fingerprint = _fingerprint(spec, t, code)
+            if not force and state.get(spec.path) == fingerprint and Path(spec.path).exists():
+                status[spec.path] = "skipped"
+            else:
+                todo.append((spec, t, fingerprint))
+        s.count("skipped", len(status))
+        logger.info(f"Rendering {len(todo)} of {len(specs)} plots")
+        if not todo:
+            return status
+
+        workers = max(1, min(workers or os.cpu_count() or 1, len(todo)))
+        # A few chunks per worker, so that a slow plot does not hold up the rest of its chunk for long
+        n_chunks = min(len(todo), workers * 4)
+        chunks = [todo[i::n_chunks] for i in range(n_chunks)]
+        fingerprints = {spec.path: fingerprint for spec, _, fingerprint in todo}
+
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=_init_worker) as executor:
+            futures = [executor.submit(_render_chunk, [(spec, t) for spec, t, _ in chunk]) for chunk in chunks]
+            for future in as_completed(futures):
+                for path, error in future.result().items():
+                    if error is None:
+                        status[path] = "rendered"
+                        state[path] = fingerprints[path]
+                    else:
+                        status[path] = "failed"
+                        state.pop(path, None)
+                        logger.error(f"Could not render {path}: {error}")
+                _save_state(state_path, state)
+        s.count("rendered", sum(v == "rendered" for v in status.values()))
+        s.count("failed", sum(v == "failed" for v in status.values()))
+    return status
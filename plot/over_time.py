@@ -4,11 +4,13 @@ import seaborn as sns
 from pathlib import Path
 import logging
 import pandas as pd
-import sqlite3
 import numpy as np
 
 
 from utils.config import init_workspace
+from utils.rollups import update_rollups, get_timeseries
+from plot.stack_matrix import build_stack_matrix, interpolate_gaps
+from utils.instrument import span, instrument
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +41,9 @@ colors = [
             ]
 
 
+GROUP_BY_COLUMNS = ("source", "network", None)
+
+
 # Get articles per source as multiple time series
 def get_article_timeseries(con, days=7, group_by="source"):
     """
@@ -54,15 +59,31 @@ def get_article_timeseries(con, days=7, group_by="source"):
     # the created_utc timestamp to work with
     # Multiply days by seconds*minutes*hours to get seconds
     seconds = 60*60*24*days
-    query = f"SELECT published_utc/{seconds} as published_utc, date(published_utc, 'unixepoch') as date, count(id) as articles, \
-           {group_by} FROM newsdata " \
-            f"GROUP BY published_utc/({seconds})"
+    if group_by not in GROUP_BY_COLUMNS:
+        raise ValueError(f"Cannot group by {group_by!r}. Expected one of {GROUP_BY_COLUMNS}.")
+    # Column names cannot be bound as parameters, hence the check above
+    query = "SELECT published_utc/:seconds as published_utc, date(published_utc, 'unixepoch') as date, " \
+            "count(id) as articles"
     if group_by is not None:
         query += f", {group_by}"
-    r = pd.read_sql_query(query, con)
+    query += " FROM newsdata GROUP BY published_utc/:seconds"
+    if group_by is not None:
+        query += f", {group_by}"
+    r = pd.read_sql_query(query, con, params={"seconds": seconds})
     return r
 
 
+def category_colors(colors, n):
+    """
+    Returns `n` colors: the given `colors` first, then colors from the 'tab20' colormap.
+    """
+    if n <= len(colors):
+        return list(colors[:n])
+    cmap = plt.get_cmap("tab20")
+    return list(colors) + [cmap(i % cmap.N) for i in range(n - len(colors))]
+
+
+@instrument("plot.stack_plot")
 def generate_stack_plot(path, t, category_column, categories, colors,
                         fontsize=22,
                         x_label="Month",
@@ -70,75 +91,88 @@ def generate_stack_plot(path, t, category_column, categories, colors,
                         x_interpolate=[],
                         col_interpolate=None,
                         hatch="//",
-                        baseline="zero"):
+                        baseline="zero",
+                        yscale="linear",
+                        rasterize_above=1000,
+                        dpi=200,
+                        fig=None,
+                        figleg=None):
     """
     Create a stacked plot. Saves image to `path` and creates the legend separately, saving it to legend_`path`.
+    Figures created here are closed before returning; figures passed in are cleared and reused, and left open.
     :param path: Path to save figure (PDF) to.
     :param t: Dataframe with time series.
-    :param category_group: The name of the column to group by.
-    :param colors: List of colors for each category.
+    :param category_column: The name of the column to group by.
+    :param categories: Categories to plot, in stack order. If None, all categories by decreasing total.
+    :param colors: List of colors for each category. Extended with a colormap if there are more categories.
     :param labels_to_sources: dict{label, source}.
     :param fontsize: int, fontsize of the plotted image.
     :param x_label: Label for the x axis.
     :param y_label: Label for the y axis.
-    :param x_interpolate: List of points (a,b) to interpolate. Area in (a,b) is filled with the average y in (a,b).
+    :param x_interpolate: List of points (a,b) to interpolate. Area in (a,b) is filled by linear interpolation from a to b.
     :param col_interpolate: Color of interpolated area as color name or RGB hex string (str).
     :param hatch: (str) Hatch pattern.
+    :param yscale: (str) Scale of the y axis, e.g. 'linear' or 'log'.
+    :param rasterize_above: (int) Draw the stacks as an image (at `dpi`) if there are more buckets than this, so that
+        long series do not produce huge vector files.
+    :param dpi: (int) Resolution of rasterized areas.
+    :param fig: Figure to draw the plot on (e.g. reused across calls). If None, a new figure is created and closed.
+    :param figleg: Figure to draw the legend on. If None, a new figure is created and closed.
     :return:
     """
-    x_indices = np.array(list(range(0,len(t["published_utc"].unique()))))
-    x_dates = np.array(list(t['date'].unique()))
     path = Path(path)
-    stacks = np.zeros((len(categories),
-                       len(x_indices)))
-    labels = list()
-    fig, ax = plt.subplots(figsize=(14, 8))
+    matrix, dates = build_stack_matrix(t, category_column, categories)
+    categories = list(matrix.columns)
+    x_indices = np.arange(len(matrix))
+    x_dates = dates.to_numpy()
+    stacks = matrix.to_numpy().T
+    colors = category_colors(colors, len(categories))
+    own_fig, own_figleg = fig is None, figleg is None
+    if own_fig:
+        fig = plt.figure(figsize=(14, 8))
+    fig.clear()
+    ax = fig.add_subplot()
     fig.set_tight_layout(True)
-    for i, category in enumerate(categories):
-        print(category)
-        t_cat = t[t[category_column] == category]
-
-        for j, row in enumerate(t_cat.itertuples()):
-            stacks[i][j] = row.articles
-
-        # spl = make_interp_spline(x_indices, x_cat, k=3)
-        # x_smooth = spl(x_indices)
-        labels.append(category)
-
-    i_stack = np.zeros(stacks[0].shape)
-    for a, b in x_interpolate:
-        for j in range(a, b + 1):
-            y_interpolated = 0
-            for i in range(len(stacks)):
-                y_interpolated += (stacks[i][b] + stacks[i][a] + stacks[i][j]) / 3
-            i_stack[j] = y_interpolated
-        st = ax.stackplot(x_indices, i_stack, baseline=baseline, color=col_interpolate, alpha=0.60, labels=["Missing data"])
+    rasterized = len(x_indices) > rasterize_above
+
+    if len(x_interpolate) > 0:
+        # Total of the interpolated values, drawn behind the stacks inside the missing-data ranges
+        filled, mask = interpolate_gaps(matrix, x_interpolate)
+        i_stack = np.where(mask, filled.to_numpy().sum(axis=1), 0)
+        st = ax.stackplot(x_indices, i_stack, baseline=baseline, colors=[col_interpolate], alpha=0.60, labels=["Missing data"])
         st[0].set_hatch(hatch)
+        st[0].set_rasterized(rasterized)
     plots = ax.stackplot(x_indices, stacks, baseline=baseline, alpha=0.9,
-                         colors=colors[:len(stacks)])
+                         colors=colors)
+    for p in plots:
+        p.set_rasterized(rasterized)
 
     #  TICKS AND GRID
     # major_ticks = np.arange(0, len(x_indices)+1, 4)
     # minor_ticks = np.arange(0, len(x_indices), 2)
-    major_ticks = np.arange(0, len(x_dates)+1, 3)
+    major_ticks = np.arange(0, len(x_dates), 3)
     minor_ticks = np.arange(0, len(x_indices)+1, 1.5)
 
     ax.set_xticks(major_ticks)
     ax.set_xticks(minor_ticks, minor=True)
     ax.set_xticklabels(x_dates[major_ticks], rotation=30, ha="right")
-    # ax.set_yscale('log')
-    plt.xticks(fontsize=fontsize)
-    plt.yticks(fontsize=fontsize)
+    ax.set_yscale(yscale)
+    ax.tick_params(axis="both", which="major", labelsize=fontsize)
 
     ax.xaxis.grid(which="major")
     ax.xaxis.grid(which="minor", alpha=0.5, linestyle="--")
 
-    plt.xlabel(x_label, fontsize=fontsize)
-    plt.ylabel(y_label, fontsize=fontsize)
-    fig.savefig(path, format="pdf")
+    ax.set_xlabel(x_label, fontsize=fontsize)
+    ax.set_ylabel(y_label, fontsize=fontsize)
+    fig.savefig(path, format="pdf", dpi=dpi)
+    if own_fig:
+        plt.close(fig)
 
     # Manually make legend
-    figleg, axleg = plt.subplots(figsize=(10, 0.5))
+    if own_figleg:
+        figleg = plt.figure(figsize=(10, 0.5))
+    figleg.clear()
+    axleg = figleg.add_subplot()
     legend_elem = list()
     for i, c in enumerate(categories):
         p = Patch(facecolor=colors[i], label=categories[i])
@@ -155,24 +189,23 @@ def generate_stack_plot(path, t, category_column, categories, colors,
     axleg.axis("off")
     # plt.tight_layout()
     figleg.savefig(path.parent.joinpath(f"{path.stem}_legend{path.suffix}"), format="pdf", bbox_inches="tight")
+    if own_figleg:
+        plt.close(figleg)
 
 
-if __name__ == "__main__":
-    config = init_workspace(config_path='config/config.yaml')
+def main(config):
+    """
+    Plot the monthly number of articles of each network to `plots/stack_plot.pdf`, with variants in log scale, by
+    week, and per network to `plots/networks/`. Plots whose data did not change are not rendered again.
+    """
+    from plot.batch import PlotSpec, render_batch
     output_dir = Path("plots")
     output_dir.mkdir(exist_ok=True, parents=True)
 
-    if not Path("articles_over_time.csv").exists():
-        con = sqlite3.connect(config.path.data.joinpath("nela_ps_final.db"))
-        # Get article timeseries
-        a_ts = get_article_timeseries(con, days=30, group_by='network')
-        # Shift timestamps to 0 (in weeks)
-        shift = a_ts["published_utc"].min()
-        a_ts["published_utc"] = a_ts["published_utc"] - a_ts["published_utc"].min() + 1
-        a_ts.to_csv("articles_over_time.csv", index=None)
-
-    a_ts = pd.read_csv("articles_over_time.csv")
-    print(a_ts)
+    db_path = config.path.data.joinpath("nela_ps_final.db")
+    # Bring the daily rollups up to date with any new rows, then derive the buckets from them
+    with span("plot.timeseries") as s:
+        s.count("rows_aggregated", update_rollups(db_path))
 
     network_labels = {
         'metric_media': 'Metric Media News',
@@ -182,12 +215,6 @@ if __name__ == "__main__":
         'lgis': "LGIS",
         "local_labs": "Local Labs"
     }
-    for n in network_labels:
-        a_ts['network'] = a_ts['network'].str.replace(n, network_labels[n])
-    a_ts['date'] = a_ts['date'].apply(lambda s: s.rsplit('-', 1)[0])
-
-    print(a_ts)
-    category_column = 'network'
     category_groups = ['Metric Media', 
                        'Franklin Archer',  
                        'Record', 
@@ -195,4 +222,21 @@ if __name__ == "__main__":
                        'LGIS', 
                        'American Catholic Tribune Media Network', 
                        'Locality Labs']
-    generate_stack_plot('plots/stack_plot.pdf', a_ts, category_column, category_groups, colors)
+    monthly = dict(days=30, group_by='network', categories=category_groups, labels=network_labels, month_labels=True)
+    specs = [
+        PlotSpec('plots/stack_plot.pdf', db_path, **monthly),
+        PlotSpec('plots/stack_plot_log.pdf', db_path, yscale='log', **monthly),
+        PlotSpec('plots/stack_plot_weekly.pdf', db_path, days=7, group_by='network', labels=network_labels),
+    ]
+    networks = get_timeseries(db_path, days=30, group_by='network')['network'].dropna().unique()
+    specs += [PlotSpec(f'plots/networks/{network}.pdf', db_path, days=7, group_by='network', networks=[network],
+                       labels=network_labels)
+              for network in sorted(networks)]
+    status = render_batch(specs, workers=config.get("plot", {}).get("workers", None))
+    logger.info(f"Plots: {sum(s == 'rendered' for s in status.values())} rendered, "
+                f"{sum(s == 'skipped' for s in status.values())} up to date, "
+                f"{sum(s == 'failed' for s in status.values())} failed")
+
+
+if __name__ == "__main__":
+    main(init_workspace(config_path='config/config.yaml'))
@@ -0,0 +1,71 @@
+"""
+Vectorized assembly of stacked time series.
+
+Turns a long-format time series (one row per bucket and category, as returned by `get_article_timeseries`) into an
+aligned bucket-by-category matrix, and fills missing-data ranges with linear interpolation.
+"""
+import numpy as np
+import pandas as pd
+
+
+def build_stack_matrix(t, category_column, categories=None,
+                       bucket_column="published_utc",
+                       value_column="articles",
+                       date_column="date",
+                       complete=True):
+    """
+    Pivot a long-format time series into a matrix with one row per bucket and one column per category.
+    Categories without a row in a bucket get 0 in that bucket.
+
+    Args:
+        t (DataFrame) : Time series with columns `bucket_column`, `category_column`, `value_column` and `date_column`.
+        category_column (str) : The column holding the categories (e.g. 'network' or 'source').
+        categories (list[str]) : Categories to keep, in stack order. If `None`, all categories by decreasing total.
+        bucket_column (str) : Column holding the (integer) bucket of each row.
+        value_column (str) : Column holding the values to stack.
+        date_column (str) : Column holding the date label of each row. Ignored if missing.
+        complete (bool) : If `True`, include every bucket between the first and the last, even if it has no rows.
+
+    Returns:
+        matrix (DataFrame) : Values indexed by bucket, with one column per category.
+        dates (Series) : Date label of each bucket (forward-filled for empty buckets).
+    """
+    matrix = t.pivot_table(index=bucket_column, columns=category_column, values=value_column,
+                           aggfunc="sum", fill_value=0, observed=True)
+    if categories is None:
+        categories = list(matrix.sum(axis=0).sort_values(ascending=False).index)
+    buckets = matrix.index
+    if complete and len(buckets) > 0:
+        buckets = pd.RangeIndex(int(buckets.min()), int(buckets.max()) + 1, name=bucket_column)
+    matrix = matrix.reindex(index=buckets, columns=categories, fill_value=0)
+
+    if date_column in t.columns:
+        dates = t.groupby(bucket_column)[date_column].min().reindex(buckets).ffill()
+    else:
+        dates = pd.Series(buckets, index=buckets)
+    return matrix, dates
+
+
+def interpolate_gaps(matrix, ranges):
+    """
+    Replace the values strictly inside each range of rows with a linear interpolation between its end points.
+
+    Args:
+        matrix (DataFrame) : Bucket-by-category matrix from `build_stack_matrix`.
+        ranges (list[tuple(int,int)]) : Pairs (a, b) of row positions. Rows a < j < b are interpolated
+            from rows a and b.
+
+    Returns:
+        filled (DataFrame) : Copy of `matrix` with the gaps filled.
+        mask (np.ndarray) : Boolean array marking the rows in any range (end points included).
+    """
+    values = matrix.to_numpy(dtype=float, copy=True)
+    mask = np.zeros(len(values), dtype=bool)
+    for a, b in ranges:
+        if not 0 <= a < b < len(values):
+            raise ValueError(f"Invalid interpolation range {(a, b)} for {len(values)} buckets")
+        w = (np.arange(a, b + 1) - a) / (b - a)
+        values[a:b + 1] = np.outer(1 - w, values[a]) + np.outer(w, values[b])
+        mask[a:b + 1] = True
+    filled = pd.DataFrame(values, index=matrix.index, columns=matrix.columns)
+    return filled, mask
@@ -0,0 +1,116 @@
+"""
+Shared fixtures: a local HTTP server standing in for remote sites.
+"""
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+
+FIXTURES_DIR = Path(__file__).parent.joinpath("fixtures")
+
+CONTENT_TYPES = {".html": "text/html", ".xml": "application/xml", ".txt": "text/plain"}
+
+
+class FixtureServer(ThreadingHTTPServer):
+    """
+    HTTP/1.1 server with keep-alive, serving the files of a directory.
+
+    A request for `http://<host>/<path>` is served from `<root>/<host>/<path>` if `<root>/<host>` is a directory
+    (several sites behind one server, told apart by their Host header), and from `<root>/<path>` otherwise. A file
+    `<path>.gz` is served as `<path>` with `Content-Encoding: gzip`, as is. Every response has an ETag, and a request
+    whose If-None-Match matches it gets a 304.
+
+    Args:
+        root (str or Path) : Directory of the served files.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, root):
+        super().__init__(("127.0.0.1", 0), FixtureHandler)
+        self.root = Path(root)
+        self.requests = list()  # (host, path, status, client address) of each request
+        self.lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def url(self, path=""):
+        return f"http://127.0.0.1:{self.port}/{path.lstrip('/')}"
+
+    def log(self, host, path, status, client):
+        with self.lock:
+            self.requests.append((host, path, status, client))
+
+    def statuses(self, host=None):
+        """
+        Returns the status of each request (to `host`, if not `None`), in order.
+        """
+        with self.lock:
+            return [status for h, _, status, _ in self.requests if host is None or h == host]
+
+    def connections(self):
+        """
+        Returns the number of distinct client connections seen.
+        """
+        with self.lock:
+            return len({client for *_, client in self.requests})
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        host = self.headers.get("Host", "").rsplit(":", 1)[0]
+        path = self.path.split("?", 1)[0].lstrip("/") or "index.html"
+        site = self.server.root.joinpath(host)
+        file = (site if site.is_dir() else self.server.root).joinpath(path)
+        encoding = None
+        if not file.is_file() and file.with_name(f"{file.name}.gz").is_file():
+            file, encoding = file.with_name(f"{file.name}.gz"), "gzip"
+        if not file.resolve().is_relative_to(self.server.root.resolve()) or not file.is_file():
+            return self._reply(host, 404, b"not found", "text/plain")
+        body = file.read_bytes()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            return self._reply(host, 304, b"", None, etag=etag)
+        content_type = CONTENT_TYPES.get(Path(path).suffix, "application/octet-stream")
+        self._reply(host, 200, body, content_type, etag=etag, encoding=encoding)
+
+    def _reply(self, host, status, body, content_type, etag=None, encoding=None):
+        self.server.log(host, self.path, status, self.client_address)
+        self.send_response(status)
+        if content_type is not None:
+            self.send_header("Content-Type", content_type)
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", formatdate(0, usegmt=True))
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        if status != 304:
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def fixture_server(request):
+    """
+    Start a `FixtureServer` over `tests/fixtures/<name>`, where `name` is given with
+    `@pytest.mark.fixture_dir(name)`.
+    """
+    marker = request.node.get_closest_marker("fixture_dir")
+    server = FixtureServer(FIXTURES_DIR.joinpath(marker.args[0]))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
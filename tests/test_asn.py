@@ -0,0 +1,66 @@
+"""
+Tests of the offline ASN lookup (`analysis/asn.py`).
+"""
+import gzip
+
+import pytest
+
+from analysis.asn import AsnIndex, load_asn_index
+
+
+ADDRESSES = ["1.0.0.5", "1.0.5.1", "1.0.1.1", "UNKNOWN"]
+EXPECTED = [[13335, "CLOUDFLARENET"], [38803, "WPL-AS-AP"], [0, ""], [0, ""]]
+
+
+def _lookup(index):
+    return index.annotate(ADDRESSES).values.tolist()
+
+
+def test_prefixes(tmp_path):
+    path = tmp_path.joinpath("prefixes.csv")
+    path.write_text("prefix,asn,org\n1.0.0.0/24,AS13335,CLOUDFLARENET\n1.0.4.0/22,38803,WPL-AS-AP\n"
+                    "1.0.5.0/24,999,MORE-SPECIFIC\nbad/24,1,BAD\n")
+    index = AsnIndex.from_csv(path)
+    assert index.annotate(ADDRESSES).values.tolist() == [[13335, "CLOUDFLARENET"], [999, "MORE-SPECIFIC"], [0, ""],
+                                                         [0, ""]]
+
+
+@pytest.mark.parametrize("start, end", [("1.0.0.0", "1.0.0.255"), ("16777216", "16777471")])
+def test_ranges_dotted_or_integers(tmp_path, start, end):
+    path = tmp_path.joinpath("ranges.csv")
+    path.write_text(f"start,end,asn,org\n{start},{end},13335,CLOUDFLARENET\n16778240,16779263,38803,WPL-AS-AP\n")
+    assert _lookup(AsnIndex.from_csv(path)) == EXPECTED
+
+
+@pytest.mark.parametrize("rows", [
+    ["1.0.0.0\t1.0.0.255\t13335\tUS\tCLOUDFLARENET", "1.0.4.0\t1.0.7.255\t38803\tAU\tWPL-AS-AP"],
+    ["16777216\t16777471\t13335\tUS\tCLOUDFLARENET", "16777472\t16778239\t0\tNone\tNot routed",
+     "16778240\t16779263\t38803\tAU\tWPL-AS-AP"],
+])
+def test_headerless_ip2asn_dump(tmp_path, rows):
+    path = tmp_path.joinpath("ip2asn-v4.tsv.gz")
+    with gzip.open(path, "wt") as fout:
+        fout.write("\n".join(rows) + "\n")
+    index_path = tmp_path.joinpath("asn_index.npz")
+    assert _lookup(load_asn_index(path, index_path)) == EXPECTED
+    # The second load reads the saved index
+    assert _lookup(load_asn_index(path, index_path)) == EXPECTED
+
+
+def test_empty_index(tmp_path):
+    path = tmp_path.joinpath("prefixes.csv")
+    path.write_text("prefix,asn,org\nbad/24,1,BAD\n1.0.0.0/24,AS0,NONE\n")
+    index = AsnIndex.from_csv(path)
+    assert len(index) == 0
+    assert _lookup(index) == [[0, ""]] * len(ADDRESSES)
+
+
+def test_index_rebuilt_when_read_differently(tmp_path):
+    path = tmp_path.joinpath("ip2asn-v4.tsv")
+    path.write_text("1.0.0.0\t1.0.0.255\t13335\tUS\tCLOUDFLARENET\n1.0.4.0\t1.0.7.255\t38803\tAU\tWPL-AS-AP\n")
+    index_path = tmp_path.joinpath("asn_index.npz")
+    assert _lookup(load_asn_index(path, index_path)) == EXPECTED
+    # Same dump, other columns: the saved index must not be reused
+    names = ["start", "end", "asn", "org", "country"]
+    assert load_asn_index(path, index_path, names=names).annotate(["1.0.0.5"]).values.tolist() == [[13335, "US"]]
+    assert _lookup(load_asn_index(path, index_path)) == EXPECTED
@@ -0,0 +1,25 @@
+"""
+Tests of the read-only SQLite access layer (`utils/db.py`).
+"""
+import sqlite3
+
+import pytest
+
+from utils.db import close_connections, get_connection, query_pandas
+
+
+@pytest.mark.parametrize("name", ["plain.db", "what?.db", "hash#1.db", "100%.db", "with space.db"])
+def test_special_characters_in_path(tmp_path, name):
+    path = tmp_path.joinpath(name)
+    with sqlite3.connect(path) as con:
+        con.execute("CREATE TABLE newsdata (source TEXT)")
+        con.execute("INSERT INTO newsdata VALUES ('a')")
+    con.close()
+    try:
+        assert query_pandas(path, "SELECT source FROM newsdata")["source"].tolist() == ["a"]
+        with pytest.raises(sqlite3.OperationalError):
+            get_connection(path).execute("INSERT INTO newsdata VALUES ('b')")
+    finally:
+        close_connections()
+    # Nothing was created next to the database
+    assert sorted(p.name for p in tmp_path.iterdir()) == [name]
@@ -0,0 +1,155 @@
+"""
+Tests of the sitemap and feed harvester (`media_networks/harvest.py`) against a local server standing in for the
+fixture sites in `tests/fixtures/sites`.
+"""
+import asyncio
+import csv
+import json
+import socket
+
+import pytest
+
+from media_networks.harvest import SiteHarvest, harvest, main, normalize_date
+from media_networks.scrape_sites import ResponseCache
+from utils.config import ConfigNode
+
+
+pytestmark = pytest.mark.fixture_dir("sites")
+
+SOURCES = [("news", "http://news.example/feed.xml"), ("blog", "http://blog.example/atom.xml"),
+           ("private", "http://private.example/atom.xml"), ("down", "http://down.example/feed.xml")]
+
+
+def _closed_port():
+    # A port nothing listens on, standing in for a site that is down
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _connect_to(server):
+    hosts = {"news.example", "blog.example", "private.example", "gzip.example", "badmap.example"}
+    return {**{host: ("127.0.0.1", server.port) for host in hosts}, "down.example": ("127.0.0.1", _closed_port())}
+
+
+def _harvest(server, output_path, cache):
+    return asyncio.run(harvest(SOURCES, output_path, cache=cache, connect_to=_connect_to(server), timeout=5.0,
+                               recent_days=36500))
+
+
+def _entries(path):
+    with open(path) as fin:
+        return [json.loads(line) for line in fin]
+
+
+def test_harvest(fixture_server, tmp_path):
+    output_path = tmp_path.joinpath("entries.jsonl")
+    sites = {site["source"]: site for site in _harvest(fixture_server, output_path, ResponseCache(tmp_path / "c"))}
+    assert list(sites) == [source for source, _ in SOURCES]
+
+    news = sites["news"]
+    assert (news["live"], news["robots_status"], news["feed_status"]) == (True, 200, 200)
+    # The index and its two allowed sitemaps; the one under /private/ is disallowed by robots.txt
+    assert (news["sitemaps"], news["feed_entries"], news["sitemap_entries"], news["distinct_urls"]) == (3, 2, 3, 4)
+    assert news["latest"] == "2024-03-02T14:30:00+00:00"
+    # Sitemaps of the index are read most recent first
+    paths = [path for host, path, _, _ in fixture_server.requests
+             if host == "news.example" and path.startswith("/sitemap")]
+    assert paths == ["/sitemap_index.xml", "/sitemap-2024.xml", "/sitemap-2023.xml"]
+
+    blog = sites["blog"]
+    # Without a Sitemap line in robots.txt, /sitemap.xml is read
+    assert (blog["live"], blog["feed_entries"], blog["sitemaps"], blog["sitemap_entries"]) == (True, 1, 1, 2)
+
+    private = sites["private"]
+    assert private["live"] and private["feed_status"] is None and private["sitemaps"] == 0
+    assert "disallowed by robots.txt" in private["errors"]
+    assert fixture_server.statuses("private.example") == [200]  # Only robots.txt
+
+    down = sites["down"]
+    assert not down["live"] and down["robots_status"] is None and down["errors"]
+
+    entries = _entries(output_path)
+    assert {e["source"] for e in entries} == {"news", "blog"}
+    assert {"source": "blog", "url": "http://blog.example/first-post", "lastmod": "2024-02-10T08:00:00+00:00",
+            "via": "feed", "from": "http://blog.example/atom.xml"} in entries
+    assert len(entries) == news["feed_entries"] + news["sitemap_entries"] + blog["feed_entries"] + \
+        blog["sitemap_entries"]
+
+
+def test_not_modified(fixture_server, tmp_path):
+    cache = ResponseCache(tmp_path.joinpath("cache"))
+    first = _harvest(fixture_server, tmp_path.joinpath("first.jsonl"), cache)
+    n_requests = len(fixture_server.requests)
+    second = _harvest(fixture_server, tmp_path.joinpath("second.jsonl"), cache)
+    # Every document is revalidated, and the cached bodies give the same entries (sites run concurrently, so their
+    # entries may interleave differently)
+    assert fixture_server.statuses()[n_requests:] == [304] * n_requests
+    counts = lambda sites: [(site["live"], site["sitemaps"], site["feed_entries"], site["sitemap_entries"])
+                            for site in sites]
+    assert counts(first) == counts(second)
+    assert [site["feed_status"] for site in second] == [304, 304, None, None]
+    key = lambda e: (e["source"], e["url"], e["via"], e["from"])
+    assert sorted(_entries(tmp_path.joinpath("first.jsonl")), key=key) == \
+        sorted(_entries(tmp_path.joinpath("second.jsonl")), key=key)
+
+
+def test_connections_reused(fixture_server, tmp_path):
+    _harvest(fixture_server, tmp_path.joinpath("entries.jsonl"), None)
+    # One keep-alive connection per live site
+    assert fixture_server.connections() == 3
+
+
+def test_main(fixture_server, tmp_path, monkeypatch):
+    data_dir = tmp_path.joinpath("data")
+    data_dir.mkdir()
+    data_dir.joinpath("ps_sources.txt").write_text("".join(f"{source},{feed}\n" for source, feed in SOURCES))
+    connect_to = {host: list(address) for host, address in _connect_to(fixture_server).items()}
+    config = ConfigNode({"path": {"data": data_dir}, "harvest": {"connect_to": connect_to, "timeout": 5.0}})
+    monkeypatch.chdir(tmp_path)
+    main(config)
+
+    with open(tmp_path.joinpath("harvest", "sites.csv")) as fin:
+        sites = list(csv.DictReader(fin))
+    assert [(site["source"], site["live"]) for site in sites] == [("news", "True"), ("blog", "True"),
+                                                                  ("private", "True"), ("down", "False")]
+    assert len(_entries(tmp_path.joinpath("harvest", "entries.jsonl"))) == 8
+
+
+def test_corrupt_gzip(fixture_server, tmp_path):
+    sources = SOURCES[:1] + [("gzip", "http://gzip.example/feed.xml"), ("badmap", "http://badmap.example/atom.xml")]
+    sites = asyncio.run(harvest(sources, tmp_path.joinpath("entries.jsonl"), connect_to=_connect_to(fixture_server),
+                                timeout=5.0))
+    news, gzip_site, badmap = sites
+    assert news["feed_entries"] == 2 and news["sitemap_entries"] == 3
+    # robots.txt sent with a corrupt gzip Content-Encoding
+    assert gzip_site["robots_status"] is None and "corrupt gzip body" in gzip_site["errors"]
+    # A valid gzip-encoded feed, and a gzipped sitemap with corrupt data
+    assert badmap["feed_entries"] == 1 and badmap["sitemap_entries"] == 0
+    assert "http://badmap.example/sitemap.xml" in badmap["errors"]
+
+
+def test_failed_site_is_recorded(fixture_server, tmp_path, monkeypatch):
+    harvest_feed = SiteHarvest._harvest_feed
+
+    async def fail_for_blog(self):
+        if self.source == "blog":
+            raise RuntimeError("unexpected")
+        await harvest_feed(self)
+
+    monkeypatch.setattr(SiteHarvest, "_harvest_feed", fail_for_blog)
+    sites = _harvest(fixture_server, tmp_path.joinpath("entries.jsonl"), None)
+    assert [site["source"] for site in sites] == [source for source, _ in SOURCES]
+    assert "RuntimeError: unexpected" in sites[1]["errors"]
+    assert sites[0]["feed_entries"] == 2
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2024-03-02T09:30:00-05:00", "2024-03-02T14:30:00+00:00"),
+    ("2024-01-15", "2024-01-15T00:00:00+00:00"),
+    ("Sat, 02 Mar 2024 14:30:00 GMT", "2024-03-02T14:30:00+00:00"),
+    (" not a date ", "not a date"),
+    (None, None),
+])
+def test_normalize_date(value, expected):
+    assert normalize_date(value) == expected
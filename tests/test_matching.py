@@ -0,0 +1,52 @@
+"""
+Tests of the matching of source names against the media network lists (`media_networks/matching.py`).
+"""
+from pathlib import Path
+
+import pytest
+
+from media_networks.matching import NetworkMatcher
+
+LISTS_DIR = Path(__file__).parent.parent.joinpath("results", "media_network_lists")
+MIN_SCORE = 0.8  # `crossref.min_score` in config/config.yaml
+
+
+def _grams(s, n=3):
+    s = f"^{s}$".encode("utf-8")
+    return {s[i:i + n] for i in range(len(s) - n + 1)}
+
+
+def _dice(a, b):
+    a, b = _grams(a), _grams(b)
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+@pytest.fixture(scope="module")
+def matcher():
+    return NetworkMatcher.from_directory(LISTS_DIR)
+
+
+@pytest.mark.parametrize("name", ["alabamatimes", "nebraskatoday", "michigannews"])
+def test_unlisted_sources_stay_unknown(matcher, name):
+    # These share mostly common n-grams (e.g. 'news', 'alabama') with listed outlets, which must not push them over
+    # the threshold
+    (network, match, score), = matcher.match([name])
+    assert score < MIN_SCORE
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("Alabama Business Daily", "alabamabusinessdaily"),
+    ("alabamabusinesdaily", "alabamabusinessdaily"),
+    ("michiganbusinesdaily", "michiganbusinessdaily"),
+])
+def test_listed_sources_match(matcher, query, expected):
+    (network, match, score), = matcher.match([query])
+    assert match == expected
+    assert score >= MIN_SCORE
+
+
+def test_score_is_dice_of_full_ngram_sets(matcher):
+    queries = ["alabamatimes", "nebraskatoday", "michigannews", "eastmichigannew", "nenebraskanew"]
+    for query, (network, match, score) in zip(queries, matcher.match(queries)):
+        assert score == pytest.approx(_dice(query, match))
+        assert score == pytest.approx(max(_dice(query, name) for name in matcher.names))
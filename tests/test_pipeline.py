@@ -0,0 +1,48 @@
+"""
+Tests of the stage runner (`utils/pipeline.py`).
+"""
+import sys
+
+import pytest
+
+from utils.config import ConfigNode
+from utils.pipeline import Pipeline, Stage
+
+
+STAGE_MODULES = {
+    "stage_exit": "def main(config):\n    exit(1)\n",
+    "stage_ok": "from pathlib import Path\n\ndef main(config):\n    Path('ok.txt').write_text('ok')\n",
+}
+
+
+@pytest.fixture
+def workspace(tmp_path, monkeypatch):
+    for name, code in STAGE_MODULES.items():
+        tmp_path.joinpath(f"{name}.py").write_text(code)
+    monkeypatch.syspath_prepend(str(tmp_path))  # Worker processes are spawned with the same sys.path
+    output_dir = tmp_path.joinpath("output")
+    config_path = tmp_path.joinpath("config.yaml")
+    config_path.write_text(f"path:\n  data: '{tmp_path}'\n  output_dir: '{output_dir}'\n"
+                           f"  logging_conf: '{tmp_path.joinpath('missing.yaml')}'\n")
+    yield ConfigNode({"path": {"data": tmp_path, "output_dir": output_dir}}), config_path
+    for name in STAGE_MODULES:
+        sys.modules.pop(name, None)
+
+
+def test_exiting_stage_fails(workspace):
+    config, config_path = workspace
+    stages = [Stage("exits", "stage_exit", outputs=["exits.txt"]),
+              Stage("after", "stage_ok", inputs=["exits.txt"], outputs=["after.txt"]),
+              Stage("other", "stage_ok", outputs=["ok.txt"])]
+    status = Pipeline(stages, config, config_path).run(workers=2)
+    assert status == {"exits": "failed", "after": "blocked", "other": "done"}
+
+
+def test_always_stage_reruns(workspace):
+    config, config_path = workspace
+    stages = [Stage("always", "stage_ok", outputs=["ok.txt"], always=True)]
+    assert Pipeline(stages, config, config_path).run() == {"always": "done"}
+    assert Pipeline(stages, config, config_path).run() == {"always": "done"}
+    stages = [Stage("once", "stage_ok", outputs=["ok.txt"])]
+    assert Pipeline(stages, config, config_path).run() == {"once": "done"}
+    assert Pipeline(stages, config, config_path).run() == {"once": "skipped"}
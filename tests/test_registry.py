@@ -0,0 +1,28 @@
+"""
+Tests of the source registry (`utils/registry.py`).
+"""
+from utils.registry import SourceRegistry
+
+
+def _members(registry):
+    return sorted(tuple(row) for row in registry.con.execute(
+        "SELECT n.name, m.name FROM network_members m JOIN networks n ON n.id = m.network_id"))
+
+
+def test_removed_sources_and_members_are_dropped(tmp_path):
+    with SourceRegistry(tmp_path.joinpath("registry.db")) as registry:
+        registry.upsert_networks({"metric_media": ["a", "b"], "lgis": ["c"]})
+        assert registry.upsert_sources([("a", "https://a.com/feed", "a.com", "metric_media", 1.0),
+                                        ("b", "https://b.com/feed", "b.com", "metric_media", 1.0),
+                                        ("x", "https://x.com/feed", "x.com", "UNKNOWN", 0.2)]) == 0
+        registry.upsert_ips([("b.com", "10.0.0.2", 0, 0)])
+
+        # On the next crossref, 'b' left the list of its network and was dropped from the source list
+        registry.upsert_networks({"metric_media": ["a"], "lgis": ["c", "d"]})
+        assert registry.upsert_sources([("a", "https://a.com/feed", "a.com", "metric_media", 1.0),
+                                        ("x", "https://x.com/feed", "x.com", "UNKNOWN", 0.2)]) == 1
+        assert _members(registry) == [("lgis", "c"), ("lgis", "d"), ("metric_media", "a")]
+        assert [row["source"] for row in registry.by_network("metric_media")] == ["a"]
+        assert registry.by_source("b") is None
+        assert registry.by_ip("10.0.0.2") == []
+        assert sorted(registry.source_ips()["source"]) == ["a", "x"]
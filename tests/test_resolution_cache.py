@@ -0,0 +1,28 @@
+"""
+Tests of the resolution cache (`utils/resolution_cache.py`).
+"""
+from utils.resolution_cache import ResolutionCache
+
+
+def _result(*ipaddrs):
+    return {"hostname": "host", "aliaslist": [], "ipaddrlist": list(ipaddrs), "ttl": 3600}
+
+
+def test_removed_sources_are_dropped(tmp_path):
+    with ResolutionCache(tmp_path.joinpath("cache.db")) as cache:
+        assert cache.register_sources([("a", "a.com"), ("b", "b.com"), ("c", "c.com")]) == 0
+        assert sorted(cache.stale_domains(now=0)) == ["a.com", "b.com", "c.com"]
+        for domain, ip in [("a.com", "10.0.0.1"), ("b.com", "10.0.0.2"), ("c.com", "10.0.0.3")]:
+            cache.record_success(domain, _result(ip), now=0)
+
+        # 'b' was dropped from the source list
+        assert cache.register_sources([("c", "c.com"), ("a", "a.com")]) == 1
+        assert [r["source"] for r in cache.iter_snapshot()] == ["a", "c"]
+        assert sorted(cache.stale_domains(now=10**9)) == ["a.com", "c.com"]
+        # The history of its domain is kept
+        assert cache.history("b.com") == [("b.com", "10.0.0.2", 0, 0)]
+
+        # Listed again, it is served from the cache
+        cache.register_sources([("a", "a.com"), ("b", "b.com"), ("c", "c.com")])
+        assert sorted(r["source"] for r in cache.iter_snapshot()) == ["a", "b", "c"]
+        assert cache.stale_domains(now=0) == []
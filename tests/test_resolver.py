@@ -0,0 +1,20 @@
+"""
+Tests of the concurrent domain resolver (`utils/resolver.py`).
+"""
+import pytest
+
+from utils.resolver import SYSTEM_RESOLVER, ResolutionError, Resolver
+
+
+MALFORMED = ["a..b.com", f"{'x' * 70}.com", ".leading.com"]
+
+
+@pytest.mark.parametrize("nameserver", [SYSTEM_RESOLVER, "127.0.0.1"])
+def test_malformed_domains_fail_without_stopping(nameserver):
+    # The names are rejected before any query is sent
+    resolver = Resolver(nameservers=[nameserver], retries=2, timeout=0.5, workers=2)
+    results = list(resolver.resolve_many(enumerate(MALFORMED)))
+    assert sorted(key for key, *_ in results) == list(range(len(MALFORMED)))
+    for key, domain, result, error in results:
+        assert result is None
+        assert isinstance(error, ResolutionError) and error.permanent
@@ -0,0 +1,87 @@
+"""
+Tests of the network scrapers (`media_networks/scrape_sites.py`) against a local server serving fixture pages.
+"""
+import pytest
+
+from media_networks.scrape_sites import ResponseCache, declared_charset, fetch, make_session, run_scrapers
+
+
+pytestmark = pytest.mark.fixture_dir("networks")
+
+EXPECTED = {
+    "metric_media": ["Alabama News Desk", "Española News", "Café Times"],
+    "franklin_archer": ["Alabama Business Daily", "Michigan Business Daily"],
+    "lgis": ["Côte d'Azur Times", "Chicago City Wire"],
+}
+
+
+def _urls(server):
+    return {name: server.url(f"{name}.html") for name in EXPECTED}
+
+
+def test_scrapers_output(fixture_server, tmp_path):
+    # Pages are served as text/html without a charset: UTF-8 pages and pages declaring their charset in a <meta>
+    # must both be decoded right
+    results = run_scrapers(cache=ResponseCache(tmp_path), urls=_urls(fixture_server))
+    assert results == EXPECTED
+
+
+def test_pooled_connection(fixture_server):
+    session = make_session(pool_size=1)
+    results = run_scrapers(session=session, workers=1, urls=_urls(fixture_server))
+    assert results == EXPECTED
+    fetch(session, fixture_server.url("lgis.html"))
+    assert fixture_server.statuses() == [200] * 4
+    assert fixture_server.connections() == 1
+
+
+def test_not_modified(fixture_server, tmp_path):
+    cache = ResponseCache(tmp_path)
+    first = run_scrapers(cache=cache, urls=_urls(fixture_server))
+    second = run_scrapers(cache=cache, urls=_urls(fixture_server))
+    assert first == second == EXPECTED
+    # The second run revalidates every page and serves the cached bodies
+    assert fixture_server.statuses() == [200] * 3 + [304] * 3
+
+
+def test_failed_scraper_is_skipped(fixture_server):
+    urls = {**_urls(fixture_server), "lgis": fixture_server.url("missing.html")}
+    results = run_scrapers(urls=urls)
+    assert set(results) == {"metric_media", "franklin_archer"}
+
+
+@pytest.mark.parametrize("content_type, charset", [
+    ("text/html", None),
+    ("text/html; charset=UTF-8", "UTF-8"),
+    ('text/html; Charset="iso-8859-1"', "iso-8859-1"),
+    (None, None),
+])
+def test_declared_charset(content_type, charset):
+    assert declared_charset(content_type) == charset
+
+
+def test_cache_put_replaces_entries(tmp_path):
+    cache = ResponseCache(tmp_path)
+    url = "http://example.com/"
+    assert cache.get(url) is None
+    cache.put(url, {"etag": '"1"'}, b"first")
+    cache.put(url, {"etag": '"2"'}, b"second")
+    assert cache.get(url) == ({"etag": '"2"'}, b"second")
+    # Only the entry's two files are left
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_cache_interrupted_put(tmp_path, monkeypatch):
+    cache = ResponseCache(tmp_path)
+    url = "http://example.com/"
+    cache.put(url, {"etag": '"1"'}, b"first")
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    # Interrupted after the new body is in place: the old validators must not be served with it
+    monkeypatch.setattr("media_networks.scrape_sites.json.dump", fail)
+    with pytest.raises(OSError):
+        cache.put(url, {"etag": '"2"'}, b"second")
+    assert cache.get(url) is None
+    assert not [p for p in tmp_path.iterdir() if p.name.endswith(".tmp")]
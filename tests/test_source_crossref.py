@@ -0,0 +1,22 @@
+"""
+Tests of the cross-referencing of the sources with the media networks (`media_networks/source_crossref.py`).
+"""
+from pathlib import Path
+
+from media_networks.matching import load_network_lists
+from media_networks.source_crossref import crossref
+
+
+LISTS_DIR = Path(__file__).parent.parent.joinpath("results", "media_network_lists")
+
+
+def test_crossref():
+    ps_sources = [("alabamabusinessdaily", "https://alabamabusinessdaily.com/feed"),
+                  ("alabamatimes", "https://alabamatimes.com/feed"),
+                  ("nebraskatoday", "https://nebraskatoday.com/feed"),
+                  ("michigannews", "https://michigannews.com/feed")]
+    df = crossref(ps_sources, load_network_lists(LISTS_DIR), {"alabamabusinessdaily": "10.0.0.1"}, min_score=0.8)
+    assert df["source"].tolist() == [src for src, _ in ps_sources]
+    assert df["network"].tolist() == ["franklin_archer", "UNKNOWN", "UNKNOWN", "UNKNOWN"]
+    assert df["ipaddr"].tolist() == ["10.0.0.1", "UNKNOWN", "UNKNOWN", "UNKNOWN"]
+    assert df["match_score"].iloc[0] == 1.0
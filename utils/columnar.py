@@ -0,0 +1,323 @@
+"""
+Columnar, memory-mapped copy of the `newsdata` table.
+
+The converter writes the numeric and categorical columns of `newsdata` into a directory partitioned by month and
+network:
+
+    <root>/meta.json
+    <root>/month=2020-01/network=3/published_utc.bin
+    <root>/month=2020-01/network=3/source.bin
+    ...
+
+Every column file is a raw little-endian array opened with `np.memmap`, so loading is zero-copy and only the
+partitions and columns that a query needs are touched. `source` and `network` are stored as dictionary-encoded codes
+whose categories are listed in `meta.json`.
+"""
+import json
+import logging
+import shutil
+from itertools import islice
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils.config import init_workspace
+from utils.db import iter_query
+
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = {"rowid": "<i8", "published_utc": "<i8", "source": "<i4", "network": "<i4"}
+CATEGORICAL = ("source", "network")
+
+
+def _partition_dir(month, network_code):
+    return f"month={month}/network={network_code}"
+
+
+def convert(db_path, output_dir, batch_size=200000, flush_rows=1000000):
+    """
+    Convert the `newsdata` table of `db_path` into a partitioned columnar store at `output_dir`.
+    Rows are streamed in batches and buffered per partition, so memory use is bounded by `flush_rows`.
+    The store is built in a temporary directory and moved into place when complete.
+
+    Args:
+        db_path (str or Path) : Path to the NELA database.
+        output_dir (str or Path) : Output directory. Replaced if it exists.
+        batch_size (int) : Rows fetched from SQLite at a time.
+        flush_rows (int) : Buffered rows after which partition buffers are appended to disk.
+
+    Returns:
+        store (ColumnarStore) : The converted store.
+    """
+    output_dir = Path(output_dir)
+    tmp_dir = output_dir.with_name(f"{output_dir.name}.tmp")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    dictionaries = {c: dict() for c in CATEGORICAL}
+    buffers = dict()  # (month, network_code) -> {column: list[np.ndarray]}
+    partitions = dict()
+    n_buffered = 0
+    n_skipped = 0
+
+    def encode(column, values):
+        codes = dictionaries[column]
+        return np.fromiter((-1 if v is None else codes.setdefault(v, len(codes)) for v in values),
+                           dtype=COLUMNS[column], count=len(values))
+
+    def flush():
+        for (month, network_code), columns in buffers.items():
+            part_dir = tmp_dir.joinpath(_partition_dir(month, network_code))
+            part_dir.mkdir(parents=True, exist_ok=True)
+            for column, arrays in columns.items():
+                with open(part_dir.joinpath(f"{column}.bin"), "ab") as fout:
+                    for a in arrays:
+                        fout.write(a.tobytes())
+            utc = np.concatenate(columns["published_utc"])
+            part = partitions.setdefault((month, network_code),
+                                         {"month": month, "network": network_code,
+                                          "path": _partition_dir(month, network_code),
+                                          "rows": 0, "min_utc": int(utc.min()), "max_utc": int(utc.max())})
+            part["rows"] += len(utc)
+            part["min_utc"] = min(part["min_utc"], int(utc.min()))
+            part["max_utc"] = max(part["max_utc"], int(utc.max()))
+        buffers.clear()
+
+    rows_iter = iter_query(db_path, "SELECT rowid, published_utc, source, network FROM newsdata",
+                           batch_size=batch_size)
+    while True:
+        rows = list(islice(rows_iter, batch_size))
+        if not rows:
+            break
+        rowid, utc, source, network = zip(*rows)
+        utc = np.array([-1 if t is None else t for t in utc], dtype=np.float64)
+        valid = utc >= 0
+        n_skipped += int((~valid).sum())
+        batch = {"rowid": np.array(rowid, dtype=COLUMNS["rowid"])[valid],
+                 "published_utc": utc[valid].astype(COLUMNS["published_utc"]),
+                 "source": encode("source", source)[valid],
+                 "network": encode("network", network)[valid]}
+        months = batch["published_utc"].astype("datetime64[s]").astype("datetime64[M]")
+
+        # Split the batch by (month, network)
+        keys = months.astype(np.int64) * (1 << 32) + (batch["network"].astype(np.int64) + 1)
+        order = np.argsort(keys, kind="stable")
+        unique_keys, starts = np.unique(keys[order], return_index=True)
+        bounds = list(starts[1:]) + [len(order)]
+        for key, start, end in zip(unique_keys, starts, bounds):
+            idx = order[start:end]
+            month = str(np.datetime64(int(key >> 32), "M"))
+            network_code = int(key & 0xFFFFFFFF) - 1
+            columns = buffers.setdefault((month, network_code), {c: list() for c in COLUMNS})
+            for c in COLUMNS:
+                columns[c].append(batch[c][idx])
+        n_buffered += int(valid.sum())
+        if n_buffered >= flush_rows:
+            flush()
+            n_buffered = 0
+    flush()
+
+    if n_skipped:
+        logger.warning(f"Skipped {n_skipped} rows without `published_utc`")
+
+    meta = {"columns": COLUMNS,
+            "dictionaries": {c: list(dictionaries[c]) for c in CATEGORICAL},
+            "partitions": sorted(partitions.values(), key=lambda p: (p["month"], p["network"]))}
+    with open(tmp_dir.joinpath("meta.json"), "w") as fout:
+        json.dump(meta, fout)
+
+    if output_dir.exists():
+        shutil.rmtree(output_dir)
+    tmp_dir.rename(output_dir)
+    return ColumnarStore(output_dir)
+
+
+class ColumnarStore:
+    """
+    Read-only access to a store written by `convert`.
+
+    Args:
+        path (str or Path) : Root directory of the store.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path.joinpath("meta.json")) as fin:
+            self.meta = json.load(fin)
+        self.dictionaries = self.meta["dictionaries"]
+        self._codes = {c: {v: i for i, v in enumerate(values)} for c, values in self.dictionaries.items()}
+
+    def __len__(self):
+        return sum(p["rows"] for p in self.meta["partitions"])
+
+    def partitions(self, start=None, end=None, networks=None):
+        """
+        Returns the partitions that may hold rows in [`start`, `end`) from the given `networks`.
+
+        Args:
+            start (int) : Minimum `published_utc` (inclusive).
+            end (int) : Maximum `published_utc` (exclusive).
+            networks (list[str]) : Network names to keep. If `None`, keep all.
+        """
+        codes = None
+        if networks is not None:
+            codes = {self._codes["network"][n] for n in networks if n in self._codes["network"]}
+        parts = list()
+        for p in self.meta["partitions"]:
+            if codes is not None and p["network"] not in codes:
+                continue
+            if start is not None and p["max_utc"] < start:
+                continue
+            if end is not None and p["min_utc"] >= end:
+                continue
+            parts.append(p)
+        return parts
+
+    def _open(self, part, column):
+        path = self.path.joinpath(part["path"], f"{column}.bin")
+        return np.memmap(path, dtype=self.meta["columns"][column], mode="r", shape=(part["rows"],))
+
+    def iter_partitions(self, columns=None, start=None, end=None, networks=None):
+        """
+        Iterate over the pruned partitions, yielding a dict of memory-mapped (zero-copy) arrays for each one.
+        Rows outside [`start`, `end`) are not filtered out here; see `load`.
+
+        Args:
+            columns (list[str]) : Columns to open. Defaults to all columns.
+            start (int) : Minimum `published_utc` (inclusive) used for partition pruning.
+            end (int) : Maximum `published_utc` (exclusive) used for partition pruning.
+            networks (list[str]) : Networks to keep.
+
+        Returns:
+            partitions (generator[tuple(dict,dict[str,np.memmap])]) : Tuples of (partition metadata, arrays).
+        """
+        columns = list(self.meta["columns"]) if columns is None else columns
+        for part in self.partitions(start=start, end=end, networks=networks):
+            yield part, {c: self._open(part, c) for c in columns}
+
+    def load(self, columns=None, start=None, end=None, networks=None):
+        """
+        Load columns from the pruned partitions, keeping only rows with `published_utc` in [`start`, `end`).
+        A single unfiltered partition is returned as a memmap; otherwise partitions are concatenated.
+
+        Returns:
+            arrays (dict[str,np.ndarray]) : Column arrays. Categorical columns hold codes.
+        """
+        columns = list(self.meta["columns"]) if columns is None else list(columns)
+        need_utc = start is not None or end is not None
+        read_columns = columns + (["published_utc"] if need_utc and "published_utc" not in columns else [])
+        chunks = {c: list() for c in columns}
+        for part, arrays in self.iter_partitions(read_columns, start=start, end=end, networks=networks):
+            mask = None
+            # Partitions that lie entirely inside the range are used as-is
+            if (start is not None and part["min_utc"] < start) or (end is not None and part["max_utc"] >= end):
+                utc = arrays["published_utc"]
+                mask = np.ones(len(utc), dtype=bool)
+                if start is not None:
+                    mask &= utc >= start
+                if end is not None:
+                    mask &= utc < end
+            for c in columns:
+                chunks[c].append(arrays[c] if mask is None else arrays[c][mask])
+        out = dict()
+        for c in columns:
+            if len(chunks[c]) == 1:
+                out[c] = chunks[c][0]
+            elif chunks[c]:
+                out[c] = np.concatenate(chunks[c])
+            else:
+                out[c] = np.empty(0, dtype=self.meta["columns"][c])
+        return out
+
+    def categories(self, column):
+        """
+        Returns the list of values of a dictionary-encoded column, indexed by code.
+        """
+        return self.dictionaries[column]
+
+    def to_dataframe(self, columns=None, start=None, end=None, networks=None):
+        """
+        Load columns into a DataFrame, turning dictionary-encoded columns into `pd.Categorical` without decoding.
+        """
+        arrays = self.load(columns, start=start, end=end, networks=networks)
+        data = dict()
+        for c, values in arrays.items():
+            if c in CATEGORICAL:
+                data[c] = pd.Categorical.from_codes(values, categories=self.dictionaries[c])
+            else:
+                data[c] = values
+        return pd.DataFrame(data)
+
+
+def get_article_timeseries(store, days=7, group_by="source", start=None, end=None, networks=None):
+    """
+    Vectorized equivalent of `plot.over_time.get_article_timeseries` over a columnar store.
+
+    Args:
+        store (ColumnarStore) : The store.
+        days (int) : Size of the bucket (in days).
+        group_by (str) : `source`, `network` or `None`.
+        start (int) : Minimum `published_utc` (inclusive).
+        end (int) : Maximum `published_utc` (exclusive).
+        networks (list[str]) : Only count articles from these networks.
+
+    Returns:
+        r (DataFrame) : Columns `published_utc` (bucket index), `date` (bucket start), `articles` and `group_by`.
+    """
+    seconds = 60*60*24*days
+    columns = ["published_utc"] + ([group_by] if group_by is not None else [])
+    keys = list()
+    n_groups = len(store.categories(group_by)) + 1 if group_by is not None else 1
+    for part, arrays in store.iter_partitions(columns, start=start, end=end, networks=networks):
+        utc = arrays["published_utc"]
+        mask = None
+        if start is not None or end is not None:
+            mask = np.ones(len(utc), dtype=bool)
+            if start is not None:
+                mask &= utc >= start
+            if end is not None:
+                mask &= utc < end
+            utc = utc[mask]
+        key = (utc // seconds) * n_groups
+        if group_by is not None:
+            codes = arrays[group_by] if mask is None else arrays[group_by][mask]
+            key += codes.astype(np.int64) + 1
+        keys.append(key)
+
+    if keys:
+        unique_keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+    else:
+        unique_keys, counts = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    buckets = unique_keys // n_groups
+    r = pd.DataFrame({"published_utc": buckets,
+                      "date": (buckets * seconds).astype("datetime64[s]").astype("datetime64[D]").astype(str),
+                      "articles": counts})
+    if group_by is not None:
+        r[group_by] = pd.Categorical.from_codes(unique_keys % n_groups - 1, categories=store.categories(group_by))
+    return r
+
+
+def count_by(store, column, start=None, end=None, networks=None):
+    """
+    Count articles per value of a dictionary-encoded `column` (e.g. per source) with `np.bincount`.
+
+    Returns:
+        counts (Series) : Article counts indexed by category, in descending order.
+    """
+    categories = store.categories(column)
+    counts = np.zeros(len(categories), dtype=np.int64)
+    codes = store.load([column], start=start, end=end, networks=networks)[column]
+    codes = codes[codes >= 0]
+    counts += np.bincount(codes, minlength=len(categories))
+    return pd.Series(counts, index=categories, name="articles").sort_values(ascending=False)
+
+
+if __name__ == "__main__":
+    config = init_workspace(config_path="config/config.yaml")
+    db_path = config.path.data.joinpath("nela_ps_final.db")
+    output_dir = config.path.data.joinpath("newsdata_columnar")
+    store = convert(db_path, output_dir)
+    logger.info(f"Wrote {len(store)} rows in {len(store.meta['partitions'])} partitions to {output_dir}")
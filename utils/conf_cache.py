@@ -0,0 +1,58 @@
+"""
+Cache of parsed YAML config files, keyed by file modification time.
+
+Parsing needs `yaml` (and, for configs, `omegaconf`), whose imports dominate the start-up time of short commands.
+The parsed content of each file is kept as JSON in `~/.cache/nela_ps/conf` (or `$XDG_CACHE_HOME/nela_ps/conf`), and
+reused as long as the file's size and modification time are unchanged.
+"""
+import copy
+import hashlib
+import json
+import os
+from pathlib import Path
+
+
+_memory = dict()
+
+
+def cache_dir():
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home().joinpath(".cache")
+    return Path(base).joinpath("nela_ps", "conf")
+
+
+def load_yaml(path):
+    """
+    Returns the parsed content of the YAML file at `path`, from the cache if the file did not change.
+    Content that does not survive a JSON round trip (e.g. dates or integer keys) is parsed every time.
+    """
+    path = Path(path).absolute()
+    stat = path.stat()
+    key = [str(path), stat.st_mtime_ns, stat.st_size]
+    if _memory.get(str(path), (None,))[0] == key:
+        return copy.deepcopy(_memory[str(path)][1])
+
+    cache_file = cache_dir().joinpath(f"{hashlib.sha1(str(path).encode('utf-8')).hexdigest()}.json")
+    try:
+        with open(cache_file) as fin:
+            cached = json.load(fin)
+        if cached["key"] == key:
+            _memory[str(path)] = (key, cached["data"])
+            return copy.deepcopy(cached["data"])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    import yaml
+    with open(path) as fin:
+        data = yaml.load(fin, yaml.Loader)
+    try:
+        serialized = json.dumps({"key": key, "data": data})
+        if json.loads(serialized)["data"] == data:
+            cache_file.parent.mkdir(exist_ok=True, parents=True)
+            tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+            with open(tmp_file, "w") as fout:
+                fout.write(serialized)
+            os.replace(tmp_file, cache_file)
+    except (OSError, TypeError, ValueError):
+        pass  # Not representable as JSON, or the cache directory is not writable: parse again next time
+    _memory[str(path)] = (key, data)
+    return copy.deepcopy(data)
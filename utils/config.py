@@ -1,14 +1,64 @@
-from omegaconf import OmegaConf
 from os import chdir
 from pathlib import Path
 import logging
 import json
 
+from utils.conf_cache import load_yaml
 from utils.logging import get_logging_config, set_logging_conf
+from utils import instrument
 
 logger = logging.getLogger(__name__)
 
 
+class ConfigNode(dict):
+    """
+    Dict with attribute access to its keys (e.g. `config.path.data`), nested dicts included.
+    Used instead of an OmegaConf config when a config file needs none of its features, because importing omegaconf
+    takes longer than most short commands.
+    """
+
+    def __init__(self, data=()):
+        super().__init__({k: self._wrap(v) for k, v in dict(data).items()})
+
+    @classmethod
+    def _wrap(cls, value):
+        if isinstance(value, dict) and not isinstance(value, ConfigNode):
+            return cls(value)
+        if isinstance(value, list):
+            return [cls._wrap(v) for v in value]
+        return value
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def __setattr__(self, name, value):
+        self[name] = self._wrap(value)
+
+    def to_container(self):
+        """
+        Returns the config as plain dicts and lists (paths as strings).
+        """
+        def unwrap(value):
+            if isinstance(value, dict):
+                return {k: unwrap(v) for k, v in value.items()}
+            if isinstance(value, list):
+                return [unwrap(v) for v in value]
+            return str(value) if isinstance(value, Path) else value
+        return unwrap(self)
+
+
+def _needs_omegaconf(data):
+    # Interpolations (`${...}`) and mandatory values (`???`) are resolved by OmegaConf
+    if isinstance(data, dict):
+        return any(_needs_omegaconf(v) for v in data.values())
+    if isinstance(data, list):
+        return any(_needs_omegaconf(v) for v in data)
+    return isinstance(data, str) and (data == "???" or "${" in data)
+
+
 def load_conf_and_merge(path=None, args=None):
     """
     Load config file and merge it with current args (if any)
@@ -18,21 +68,28 @@ def load_conf_and_merge(path=None, args=None):
         args (Namespace) : argparse arguments to marge with config
 
     Returns:
-        conf (omegaconf.Config) : Merged config
+        conf (omegaconf.Config or ConfigNode) : Merged config. A `ConfigNode` if the file uses no interpolations or
+            mandatory values and there are no `args` to merge.
     """
 
     if path is None and args is None:
         raise ValueError("Cannot pass both `path` and `args` as None.")
 
     if path is not None:
-        with open(path) as fin:
-            conf = OmegaConf.load(fin)
+        # Parsed once per file version, see utils/conf_cache.py
+        data = load_yaml(path) or dict()
+        if args is None and not _needs_omegaconf(data):
+            return ConfigNode(data)
+
+        from omegaconf import OmegaConf
+        conf = OmegaConf.create(data)
         
         # Merge `args` and loaded `conf`
         # NOTE: Duplicate parameters in `conf` will override those in `args`
         if args is not None:
             conf = OmegaConf.merge(vars(args), conf)
     elif args is not None:
+        from omegaconf import OmegaConf
         conf = OmegaConf.create(vars(args))  # Otherwise, just initialize OmegaConf
     
     return conf
@@ -73,6 +130,10 @@ def init_workspace(config=None, config_path=None,
         if load_logging_conf:
             loggingConf = get_logging_config(config.path.logging_conf)
             set_logging_conf(loggingConf)
+        # Spans are written relative to the working directory, next to the logs
+        instrumentation = config.get("instrumentation", None) or dict()
+        if instrumentation.get("enabled", False):
+            instrument.configure(**instrumentation)
             
     except Exception as e:
         logger.critical(f"Failed to initialize configs! {e}")
@@ -94,4 +155,9 @@ def save_config(conf, path):
     Save config to path
     """
     with open(path, "w") as fout:
-        OmegaConf.save(config=conf, f=fout)
\ No newline at end of file
+        if isinstance(conf, ConfigNode):
+            import yaml
+            yaml.safe_dump(conf.to_container(), fout, sort_keys=False)
+        else:
+            from omegaconf import OmegaConf
+            OmegaConf.save(config=conf, f=fout)
\ No newline at end of file
@@ -1,18 +1,32 @@
-from pathlib import Path
+from urllib.parse import urlparse, urljoin
+
+from utils.fileio import find_file, iter_source_list
 
 
 def load_source_list(path):
     """
     Loads the text file containing the list of sources and feeds.
+    Invalid and duplicate lines are skipped (see `utils.fileio.iter_source_list`).
 
     Args:
-        path (str or Path) : Path to input file.
+        path (str or Path) : Path to input file. If it does not exist, a compressed version of it (e.g. `path`.gz)
+            is read instead.
 
     Returns:
         sources (list[tuple(str,str)]) : List of tuples containing (source_name, feed_url).
     """
+    return list(iter_source_list(find_file(path)))
+
+
+def get_url_domain(url):
+    """
+    Returns the domain of a given `url`
 
-    with open(path) as fin:
-        lines = list(map(lambda s: s.strip(), fin.readlines()))
-    sources = list(map(lambda s: tuple(s.split(',', 1)), lines))
-    return sources
\ No newline at end of file
+    Args:
+        url (str) : Input url
+    
+    Returns:
+        domain_url (str) : Domain URL
+    """
+    parsed_url = urlparse(url)
+    return urljoin(parsed_url.scheme, parsed_url.netloc)
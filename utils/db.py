@@ -0,0 +1,132 @@
+"""
+Shared read-only access to NELA SQLite databases.
+
+Connections are opened once per thread (and per process) with a `mode=ro` URI and tuned pragmas, then reused by every
+query. Results are streamed in `fetchmany` batches (or pandas chunks) instead of being materialized at once.
+"""
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+from utils.instrument import count
+
+
+_local = threading.local()
+
+PRAGMAS = {
+    "mmap_size": 1 << 30,  # Map up to 1 GB of the database file
+    "cache_size": -1 << 16,  # 64 MB page cache (negative values are KiB)
+    "temp_store": "MEMORY",
+    "query_only": "ON",
+}
+
+
+def get_connection(path, **pragmas):
+    """
+    Returns the read-only connection to `path` owned by the calling thread, opening it on first use.
+
+    Args:
+        path (str or Path) : Path to the database file.
+        pragmas : Overrides of the default `PRAGMAS`.
+
+    Returns:
+        con (sqlite3.Connection) : The connection. It must not be shared with other threads.
+    """
+    path = str(Path(path).absolute())
+    pool = getattr(_local, "connections", None)
+    if pool is None or getattr(_local, "pid", None) != os.getpid():
+        # Connections must not be reused across a fork
+        pool = _local.connections = dict()
+        _local.pid = os.getpid()
+
+    con = pool.get(path)
+    if con is None:
+        if not Path(path).exists():
+            raise FileNotFoundError(path)
+        # The path is percent-encoded, so that '?', '#' or '%' in it are not read as parts of the URI
+        con = sqlite3.connect(f"{Path(path).as_uri()}?mode=ro", uri=True)
+        for name, value in {**PRAGMAS, **pragmas}.items():
+            con.execute(f"PRAGMA {name}={value}")
+        pool[path] = con
+    return con
+
+
+def close_connections():
+    """
+    Close every connection owned by the calling thread.
+    """
+    pool = getattr(_local, "connections", None) or dict()
+    for con in pool.values():
+        con.close()
+    pool.clear()
+
+
+def iter_query(path, query, params=(), batch_size=10000):
+    """
+    Execute a parameterized query and stream its rows.
+
+    Args:
+        path (str or Path) : Path to the database file.
+        query (str) : SQL query, with `?` or `:name` placeholders.
+        params (tuple or dict) : Query parameters.
+        batch_size (int) : Number of rows fetched at a time.
+
+    Returns:
+        rows (generator[tuple]) : The result rows.
+    """
+    cursor = get_connection(path).execute(query, params)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            count("rows_read", len(rows))
+            yield from rows
+    finally:
+        cursor.close()
+
+
+def iter_query_pandas(path, query, params=(), chunksize=100000):
+    """
+    Execute a parameterized query and stream its results as DataFrames of at most `chunksize` rows.
+    """
+    yield from pd.read_sql_query(query, get_connection(path), params=params, chunksize=chunksize)
+
+
+def query_pandas(path, query, params=()):
+    """
+    Execute a parameterized query and load its results into a single DataFrame.
+    """
+    return pd.read_sql_query(query, get_connection(path), params=params)
+
+
+def connect_writable(path):
+    """
+    Open a read-write connection to `path`, for maintenance tasks such as building indexes and derived tables.
+    Unlike `get_connection`, the connection is not pooled and must be closed by the caller.
+    """
+    con = sqlite3.connect(str(path))
+    con.execute(f"PRAGMA cache_size={PRAGMAS['cache_size']}")
+    con.execute(f"PRAGMA temp_store={PRAGMAS['temp_store']}")
+    con.execute("CREATE TABLE IF NOT EXISTS _watermarks (name TEXT PRIMARY KEY, last_rowid INTEGER NOT NULL)")
+    return con
+
+
+def get_watermark(con, name):
+    """
+    Returns the last `newsdata` rowid processed by the derived structure `name`, or 0 if it was never built.
+    """
+    row = con.execute("SELECT last_rowid FROM _watermarks WHERE name = ?", (name,)).fetchone()
+    return row[0] if row is not None else 0
+
+
+def set_watermark(con, name, last_rowid):
+    """
+    Record that the derived structure `name` is up to date with `newsdata` rows up to `last_rowid`.
+    Call inside the transaction that updates the structure, so both are committed together.
+    """
+    con.execute("INSERT INTO _watermarks(name, last_rowid) VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET last_rowid = excluded.last_rowid", (name, last_rowid))
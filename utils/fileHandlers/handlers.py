@@ -1,12 +1,28 @@
 import logging
+import logging.handlers
 import os
 
 
 class MakedirsRotatingFileHandler(logging.handlers.RotatingFileHandler):
     """
     This is a custom RotatingFileHandler that makes a call to create the target logging directory, if needed.
+
+    With `deferred_flush=True`, records are not flushed to disk one by one; call `force_flush` to flush them (the
+    batching queue listener in `utils/logging.py` does so after each batch).
     """
 
-    def __init__(self, **kwargs):
+    def __init__(self, deferred_flush=False, **kwargs):
         os.makedirs(os.path.dirname(kwargs['filename']), exist_ok=True)
-        super().__init__(**kwargs)
\ No newline at end of file
+        self.deferred_flush = deferred_flush
+        super().__init__(**kwargs)
+
+    def flush(self):
+        if not self.deferred_flush:
+            super().flush()
+
+    def force_flush(self):
+        super().flush()
+
+    def close(self):
+        self.force_flush()
+        super().close()
@@ -0,0 +1,242 @@
+"""
+Streaming reads and writes of (optionally compressed) text files.
+
+Files ending in `.gz`, `.bz2`, `.xz` or `.lzma` are compressed and decompressed transparently, so any input or output
+can be kept compressed by adding the extension. Readers are generators that hold one line (or record) at a time.
+Writers buffer records and write them in batches, and replace their target atomically when closed.
+"""
+import bz2
+import csv
+import gzip
+import io
+import json
+import logging
+import lzma
+import os
+from pathlib import Path
+from urllib.parse import urlparse
+
+
+logger = logging.getLogger(__name__)
+
+OPENERS = {
+    ".gz": lambda path, mode, **kwargs: gzip.open(path, mode, compresslevel=6, **kwargs),
+    ".bz2": bz2.open,
+    ".xz": lzma.open,
+    ".lzma": lzma.open,
+}
+
+
+def compression(path):
+    """
+    Returns the compression extension of `path` (e.g. '.gz'), or `None` if it is not compressed.
+    """
+    suffix = Path(path).suffix.lower()
+    return suffix if suffix in OPENERS else None
+
+
+def strip_compression(path):
+    """
+    Returns `path` without its compression extension (e.g. 'sources.txt.gz' -> 'sources.txt').
+    """
+    path = Path(path)
+    return path.with_suffix("") if compression(path) else path
+
+
+def find_file(path):
+    """
+    Returns `path` if it exists, or else the first existing compressed version of it (e.g. `path`.gz). If neither
+    exists, returns `path`, so that opening it raises the usual `FileNotFoundError`.
+    """
+    path = Path(path)
+    if path.exists():
+        return path
+    for suffix in OPENERS:
+        candidate = path.with_name(f"{path.name}{suffix}")
+        if candidate.exists():
+            return candidate
+    return path
+
+
+def open_file(path, mode="rt", encoding="utf-8", **kwargs):
+    """
+    Open a file, compressed or not depending on its extension. Text modes default to UTF-8.
+
+    Args:
+        path (str or Path) : Path to the file.
+        mode (str) : As in `open` ('r' and 'w' are text modes).
+        encoding (str) : Encoding of text modes.
+        kwargs : Other arguments of `open` (e.g. `newline`).
+
+    Returns:
+        f (file object) : The open file.
+    """
+    if "b" in mode:
+        encoding = None
+    elif "t" not in mode:
+        mode += "t"
+    opener = OPENERS.get(compression(path), open)
+    return opener(path, mode, encoding=encoding, **kwargs)
+
+
+def iter_lines(path, skip_empty=True):
+    """
+    Stream the lines of a text file, without their line endings.
+
+    Args:
+        path (str or Path) : Path to the file.
+        skip_empty (bool) : Skip lines that are empty or only hold whitespace.
+
+    Returns:
+        lines (generator[str]) : The lines.
+    """
+    with open_file(path) as fin:
+        for line in fin:
+            line = line.rstrip("\r\n")
+            if skip_empty and not line.strip():
+                continue
+            yield line
+
+
+def iter_jsonl(path):
+    """
+    Stream the records of a JSONL file (one JSON value per line).
+    """
+    for line in iter_lines(path):
+        yield json.loads(line)
+
+
+def iter_csv(path, **kwargs):
+    """
+    Stream the rows of a CSV file with a header, as dicts (see `csv.DictReader`).
+    """
+    with open_file(path, newline="") as fin:
+        yield from csv.DictReader(fin, **kwargs)
+
+
+def iter_source_list(path, validate=True, dedup=True):
+    """
+    Stream the (source, feed_url) pairs of a source list, with one 'source,feed_url' line per source.
+
+    Args:
+        path (str or Path) : Path to the source list.
+        validate (bool) : Skip (and log) lines without a source name or without a URL with a host name.
+        dedup (bool) : Skip pairs that were already seen.
+
+    Returns:
+        sources (generator[tuple(str,str)]) : The (source, feed_url) pairs.
+    """
+    seen = set()
+    for lineno, line in enumerate(iter_lines(path, skip_empty=False), start=1):
+        if not line.strip():
+            continue
+        pair = tuple(s.strip() for s in line.split(",", 1))
+        if validate:
+            if len(pair) != 2 or not pair[0] or not urlparse(pair[1]).netloc:
+                logger.warning(f"{path}:{lineno}: skipping invalid source line {line!r}")
+                continue
+        if dedup:
+            if pair in seen:
+                logger.debug(f"{path}:{lineno}: skipping duplicate source {pair}")
+                continue
+            seen.add(pair)
+        yield pair
+
+
+class LineWriter:
+    """
+    Write lines to a (possibly compressed) text file in batches of `batch_size`.
+
+    The lines go to a temporary file next to `path`, which replaces `path` when the writer is closed without an error,
+    so readers never see a partial file. Use as a context manager.
+
+    Args:
+        path (str or Path) : Output path.
+        batch_size (int) : Lines buffered before a write.
+    """
+
+    def __init__(self, path, batch_size=1000):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.batch_size = batch_size
+        self.count = 0
+        self._buffer = list()
+        # Keep the compression extension last, so that the temporary file is compressed the same way
+        self._tmp_path = self.path.with_name(f".{self.path.name}.{os.getpid()}.tmp{compression(path) or ''}")
+        self._file = open_file(self._tmp_path, "w", newline="")
+
+    def _format(self, record):
+        return f"{record}\n"
+
+    def write(self, record):
+        self._buffer.append(self._format(record))
+        self.count += 1
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+        return self
+
+    def flush(self):
+        self._file.write("".join(self._buffer))
+        self._buffer.clear()
+
+    def close(self):
+        """
+        Write the buffered lines and move the file into place.
+        """
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        """
+        Discard the file, leaving any existing file at `path` untouched.
+        """
+        self._file.close()
+        self._tmp_path.unlink(missing_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class JsonlWriter(LineWriter):
+    """
+    `LineWriter` of JSON records, one per line.
+    """
+
+    def _format(self, record):
+        return f"{json.dumps(record)}\n"
+
+
+class CsvWriter(LineWriter):
+    """
+    `LineWriter` of CSV rows (sequences, or dicts if `fieldnames` is given). The header is written first if
+    `fieldnames` is given.
+    """
+
+    def __init__(self, path, fieldnames=None, batch_size=1000, **kwargs):
+        super().__init__(path, batch_size)
+        self.fieldnames = list(fieldnames) if fieldnames is not None else None
+        self._line = io.StringIO()
+        self._csv = csv.writer(self._line, **kwargs)
+        if self.fieldnames is not None:
+            self._file.write(self._format(self.fieldnames))
+
+    def _format(self, record):
+        if isinstance(record, dict):
+            record = [record.get(name, "") for name in self.fieldnames]
+        self._line.seek(0)
+        self._line.truncate()
+        self._csv.writerow(record)
+        return self._line.getvalue()
@@ -0,0 +1,185 @@
+"""
+Full-text search over the titles and contents of `newsdata`.
+
+`update_fts` maintains an external-content FTS5 index (`newsdata_fts`), whose rowids are those of `newsdata`: the
+index stores only the tokens, and the text is read back from `newsdata`. Like the rollups, only rows added since the
+previous update (by rowid) are indexed. `newsdata` is treated as append-only; after rows are changed or deleted in
+place, rebuild the index with `update_fts(path, rebuild=True)`.
+
+`search` and `iter_search` run FTS5 queries (e.g. `"school board" AND tax*`, see https://sqlite.org/fts5.html), ranked
+by BM25, optionally restricted to networks, sources or a publication date range.
+"""
+import logging
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+
+from utils.db import get_connection, connect_writable, get_watermark, set_watermark, iter_query
+
+
+logger = logging.getLogger(__name__)
+
+WATERMARK = "fts"
+FTS_TABLE = "newsdata_fts"
+
+# BM25 weights of the title and content columns: a match in the title counts more
+WEIGHTS = (4.0, 1.0)
+
+COLUMNS = ("id", "date", "source", "network", "title", "url", "published_utc")
+
+
+def update_fts(path, batch_size=50000, rebuild=False, optimize=True):
+    """
+    Create the full-text index of the database at `path`, or bring it up to date with the new rows of `newsdata`.
+
+    Args:
+        path (str or Path) : Path to the NELA database.
+        batch_size (int) : Rows indexed per transaction.
+        rebuild (bool) : Index every row again (after rows of `newsdata` were changed or deleted).
+        optimize (bool) : Merge the index segments after indexing new rows, which makes queries faster.
+
+    Returns:
+        n_rows (int) : Number of `newsdata` rows indexed by this update.
+    """
+    con = connect_writable(path)
+    try:
+        con.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(title, content, "
+                    f"content='newsdata', content_rowid='rowid', tokenize='unicode61 remove_diacritics 2')")
+
+        last_rowid = get_watermark(con, WATERMARK)
+        max_rowid = con.execute("SELECT coalesce(max(rowid), 0) FROM newsdata").fetchone()[0]
+        if rebuild or max_rowid < last_rowid:
+            if not rebuild:
+                logger.warning(f"newsdata max rowid {max_rowid} is below the index watermark {last_rowid}, "
+                               f"rebuilding")
+            with con:
+                con.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+                set_watermark(con, WATERMARK, max_rowid)
+            logger.info(f"Rebuilt the full-text index of {path}")
+            return max_rowid
+        if max_rowid == last_rowid:
+            return 0
+
+        t0 = time.perf_counter()
+        for start in range(last_rowid, max_rowid, batch_size):
+            end = min(start + batch_size, max_rowid)
+            with con:
+                con.execute(f"INSERT INTO {FTS_TABLE}(rowid, title, content) "
+                            f"SELECT rowid, coalesce(title, ''), coalesce(content, '') FROM newsdata "
+                            f"WHERE rowid > ? AND rowid <= ?", (start, end))
+                set_watermark(con, WATERMARK, end)
+        if optimize:
+            with con:
+                con.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+        logger.info(f"Indexed newsdata rows {last_rowid + 1}..{max_rowid} in {time.perf_counter() - t0:.1f}s")
+        return max_rowid - last_rowid
+    finally:
+        con.close()
+
+
+def has_fts(path):
+    """
+    Returns `True` if the full-text index of the database at `path` exists and is up to date.
+    """
+    con = get_connection(path)
+    tables = {name for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if FTS_TABLE not in tables or "_watermarks" not in tables:
+        return False
+    max_rowid = con.execute("SELECT coalesce(max(rowid), 0) FROM newsdata").fetchone()[0]
+    return get_watermark(con, WATERMARK) == max_rowid
+
+
+def phrase(text):
+    """
+    Returns an FTS5 query matching `text` as a phrase, with any FTS5 syntax in it escaped.
+    """
+    return '"' + text.replace('"', '""') + '"'
+
+
+def _timestamp(value):
+    # Dates ('YYYY-MM-DD', datetime) or UTC timestamps to UTC timestamps
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def _filters(query, networks, sources, start, end):
+    """
+    Returns the FROM and WHERE clauses and the parameters of a search.
+    """
+    where = [f"{FTS_TABLE} MATCH ?"]
+    params = [query]
+    if networks is not None:
+        where.append(f"n.network IN ({', '.join('?' * len(networks))})")
+        params += list(networks)
+    if sources is not None:
+        where.append(f"n.source IN ({', '.join('?' * len(sources))})")
+        params += list(sources)
+    if start is not None:
+        where.append("n.published_utc >= ?")
+        params.append(_timestamp(start))
+    if end is not None:
+        where.append("n.published_utc < ?")
+        params.append(_timestamp(end))
+    return f"FROM {FTS_TABLE} JOIN newsdata AS n ON n.rowid = {FTS_TABLE}.rowid WHERE {' AND '.join(where)}", params
+
+
+def _search_query(query, networks, sources, start, end, snippets):
+    columns = ", ".join(f"n.{c}" for c in COLUMNS)
+    if snippets:
+        columns += f", snippet({FTS_TABLE}, 1, '[', ']', '...', 16) AS snippet"
+    clauses, params = _filters(query, networks, sources, start, end)
+    sql = f"SELECT {columns}, bm25({FTS_TABLE}, {WEIGHTS[0]}, {WEIGHTS[1]}) AS score {clauses} " \
+          f"ORDER BY score, n.rowid"
+    return sql, params
+
+
+def iter_search(path, query, networks=None, sources=None, start=None, end=None, snippets=False, batch_size=1000):
+    """
+    Stream the articles matching a full-text query, best match first. Call `update_fts` first.
+
+    Args:
+        path (str or Path) : Path to the NELA database.
+        query (str) : FTS5 query (use `phrase` to search for a string verbatim).
+        networks (list[str]) : Only return articles of these networks.
+        sources (list[str]) : Only return articles of these sources.
+        start (str, datetime or int) : Only return articles published at or after this date (UTC) or timestamp.
+        end (str, datetime or int) : Only return articles published before this date (UTC) or timestamp.
+        snippets (bool) : Add a `snippet` of the content around the matches, with the matches in brackets.
+        batch_size (int) : Number of rows fetched at a time.
+
+    Returns:
+        rows (generator[tuple]) : `id`, `date`, `source`, `network`, `title`, `url`, `published_utc`, (`snippet`,)
+            and `score` (BM25, lower is better) of each article.
+    """
+    sql, params = _search_query(query, networks, sources, start, end, snippets)
+    yield from iter_query(path, sql, params, batch_size=batch_size)
+
+
+def search(path, query, networks=None, sources=None, start=None, end=None, snippets=True, page=0, page_size=20):
+    """
+    Returns one page of the articles matching a full-text query, best match first (see `iter_search`).
+
+    Args:
+        page (int) : Index of the page, from 0.
+        page_size (int) : Articles per page.
+
+    Returns:
+        r (DataFrame) : One row per article, with the columns listed in `iter_search`.
+    """
+    sql, params = _search_query(query, networks, sources, start, end, snippets)
+    sql += " LIMIT ? OFFSET ?"
+    return pd.read_sql_query(sql, get_connection(path), params=params + [page_size, page * page_size])
+
+
+def count_matches(path, query, networks=None, sources=None, start=None, end=None):
+    """
+    Returns the number of articles matching a full-text query (see `iter_search`).
+    """
+    clauses, params = _filters(query, networks, sources, start, end)
+    return get_connection(path).execute(f"SELECT count(*) {clauses}", params).fetchone()[0]
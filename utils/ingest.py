@@ -0,0 +1,219 @@
+"""
+Incremental bulk ingest of NELA JSON files into the `newsdata` table.
+
+Articles are streamed from the files (see `utils/nela_json.py`) by a reader thread, while the main thread inserts
+them in large `executemany` batches, one transaction per batch, into a database in WAL mode. Articles are deduplicated
+by `id` through a unique index and `INSERT OR IGNORE`, so re-ingesting a file, or an article collected twice, adds
+nothing. Each ingested file is recorded in `ingest_manifest` (by path, size and modification time) in the transaction
+of its last batch, so later runs skip it, and a run that is interrupted resumes at the file it stopped in.
+
+New rows get rowids above those of existing rows, so the rollups, the full-text index and the template signatures
+pick them up on their next update.
+"""
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+
+from utils.db import connect_writable
+from utils.instrument import span
+from utils.nela_json import iter_articles, list_json_files
+
+
+logger = logging.getLogger(__name__)
+
+NEWSDATA_COLUMNS = ("id", "date", "source", "title", "content", "author", "url", "published", "published_utc",
+                    "collection_utc", "network")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS newsdata (id TEXT, date TEXT, source TEXT, title TEXT, content TEXT, author TEXT,
+                                     url TEXT, published TEXT, published_utc INTEGER, collection_utc INTEGER,
+                                     network TEXT);
+CREATE TABLE IF NOT EXISTS ingest_manifest (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    articles INTEGER NOT NULL,
+    inserted INTEGER NOT NULL,
+    ingested_at INTEGER NOT NULL
+);
+"""
+
+ID_INDEX = "idx_newsdata_id"
+
+# New data, relative to the size of the database, above which secondary indexes are dropped and rebuilt at the end
+# instead of being updated row by row
+DEFER_INDEXES_RATIO = 0.2
+
+_INSERT = f"INSERT OR IGNORE INTO newsdata({', '.join(NEWSDATA_COLUMNS)}) " \
+          f"VALUES ({', '.join('?' * len(NEWSDATA_COLUMNS))})"
+
+
+def _file_key(path):
+    stat = Path(path).stat()
+    return str(Path(path).absolute()), stat.st_size, stat.st_mtime_ns
+
+
+def _read_files(paths, networks, batch_size, out, stop):
+    """
+    Put (path, rows, done) batches of the articles of `paths` on `out`, then `None`. Errors are put on `out` too.
+    """
+    try:
+        fields = NEWSDATA_COLUMNS[:-1]
+        for path in paths:
+            rows = list()
+            for article in iter_articles(path):
+                rows.append(tuple(article.get(f) for f in fields) + (networks.get(article.get("source")),))
+                if len(rows) == batch_size:
+                    out.put((path, rows, False))
+                    rows = list()
+                if stop.is_set():
+                    return
+            out.put((path, rows, True))
+        out.put(None)
+    except BaseException as e:
+        out.put(e)
+
+
+def _secondary_indexes(con):
+    # Name and SQL of the indexes of newsdata, except the id index
+    return con.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = 'newsdata' "
+                       "AND sql IS NOT NULL AND name != ?", (ID_INDEX,)).fetchall()
+
+
+def ingest(db_path, paths, networks=None, batch_size=50000, defer_indexes=None, force=False):
+    """
+    Insert the articles of NELA JSON files into `newsdata`, skipping files already ingested and articles whose `id`
+    is already in the table. The database and the table are created if needed.
+
+    Args:
+        db_path (str or Path) : Path to the NELA database.
+        paths (list[str or Path]) : NELA JSON files (possibly compressed), or directories of them.
+        networks (dict[str,str]) : Network of each source, stored in the `network` column (NULL for other sources).
+        batch_size (int) : Rows inserted per transaction.
+        defer_indexes (bool) : Drop the secondary indexes of `newsdata` (e.g. those of the rollups) and rebuild them
+            at the end. If `None`, indexes are deferred when the input is large relative to the database.
+        force (bool) : Read the files even if the manifest says they were ingested (their articles are still
+            deduplicated).
+
+    Returns:
+        summary (DataFrame) : One row per file read, with `articles`, `inserted` (new articles) and `seconds`.
+    """
+    files = list()
+    for path in map(Path, paths):
+        files.extend(list_json_files(path) if path.is_dir() else [path])
+    networks = networks or dict()
+
+    con = connect_writable(db_path)
+    con.isolation_level = None  # Transactions are explicit
+    try:
+        con.execute("PRAGMA journal_mode=WAL")
+        con.execute("PRAGMA synchronous=NORMAL")
+        con.executescript(_SCHEMA)
+        try:
+            con.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {ID_INDEX} ON newsdata(id)")
+        except sqlite3.IntegrityError:
+            raise ValueError(f"{db_path}: newsdata has duplicate ids, remove them before ingesting "
+                             f"(e.g. DELETE FROM newsdata WHERE rowid NOT IN (SELECT min(rowid) FROM newsdata "
+                             f"GROUP BY id))") from None
+
+        ingested = {row[0]: tuple(row) for row in con.execute("SELECT path, size, mtime_ns FROM ingest_manifest")}
+        todo = [path for path in files if force or ingested.get(_file_key(path)[0]) != _file_key(path)]
+        if len(todo) < len(files):
+            logger.info(f"Skipping {len(files) - len(todo)} files already ingested")
+        if not todo:
+            return pd.DataFrame(columns=["path", "articles", "inserted", "seconds"])
+
+        if defer_indexes is None:
+            input_size = sum(path.stat().st_size for path in todo)
+            defer_indexes = input_size > DEFER_INDEXES_RATIO * Path(db_path).stat().st_size
+        indexes = _secondary_indexes(con) if defer_indexes else []
+        for name, _ in indexes:
+            con.execute(f"DROP INDEX {name}")
+
+        try:
+            summary = _insert_files(con, todo, networks, batch_size)
+        finally:
+            if indexes:
+                with span("ingest.indexes", indexes=len(indexes)):
+                    for _, sql in indexes:
+                        con.execute(sql)
+                logger.info(f"Rebuilt {len(indexes)} indexes of newsdata")
+        return summary
+    finally:
+        con.close()
+
+
+def _insert_files(con, paths, networks, batch_size):
+    # Insert the batches read by a reader thread: SQLite releases the GIL while it writes, so parsing and inserting
+    # overlap
+    batches, stop = queue.Queue(maxsize=2), threading.Event()
+    reader = threading.Thread(target=_read_files, args=(paths, networks, batch_size, batches, stop), daemon=True)
+    reader.start()
+
+    summary = list()
+    articles = inserted = 0
+    t0 = t_file = time.perf_counter()
+    try:
+        with span("ingest", files=len(paths)) as s:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                path, rows, done = item
+                con.execute("BEGIN")
+                try:
+                    changes = con.total_changes
+                    con.executemany(_INSERT, rows)
+                    articles += len(rows)
+                    inserted += con.total_changes - changes
+                    if done:
+                        con.execute("INSERT OR REPLACE INTO ingest_manifest VALUES (?, ?, ?, ?, ?, ?)",
+                                    (*_file_key(path), articles, inserted, int(time.time())))
+                    con.execute("COMMIT")
+                except BaseException:
+                    con.execute("ROLLBACK")
+                    raise
+                s.count("rows", len(rows))
+                if done:
+                    seconds = time.perf_counter() - t_file
+                    logger.info(f"Ingested {path}: {inserted} new of {articles} articles "
+                                f"({articles / max(seconds, 1e-9):.0f} articles/s)")
+                    summary.append((str(path), articles, inserted, seconds))
+                    articles = inserted = 0
+                    t_file = time.perf_counter()
+    finally:
+        stop.set()
+        # Unblock the reader if it waits for room in the queue
+        while reader.is_alive():
+            try:
+                batches.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    summary = pd.DataFrame(summary, columns=["path", "articles", "inserted", "seconds"])
+    seconds = time.perf_counter() - t0
+    logger.info(f"Ingested {summary['inserted'].sum()} new of {summary['articles'].sum()} articles from "
+                f"{len(summary)} files in {seconds:.1f}s ({summary['articles'].sum() / max(seconds, 1e-9):.0f} "
+                f"articles/s)")
+    return summary
+
+
+def load_networks(path="source_network.csv"):
+    """
+    Returns the network of each source matched by `crossref` (see `media_networks/source_crossref.py`), or an empty
+    dict if `path` does not exist. Sources without a network ('UNKNOWN') are left out, so their articles get a NULL
+    network.
+    """
+    if not Path(path).exists():
+        logger.warning(f"{path} not found, the network of the ingested articles is left empty")
+        return dict()
+    df = pd.read_csv(path, usecols=["source", "network"], dtype=str)
+    df = df[df["network"].notna() & (df["network"] != "UNKNOWN")]
+    return dict(zip(df["source"], df["network"]))
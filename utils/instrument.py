@@ -0,0 +1,265 @@
+"""
+Timing and memory instrumentation of pipeline stages.
+
+Wrap a stage in `span` (or decorate it with `instrument`) to record its wall and CPU time, peak memory and counters
+(e.g. rows read, lookups done). Finished spans are appended as JSON lines to `logs/spans.jsonl`, next to
+`logs/output.log`. Instrumentation is off until `configure` is called, which `init_workspace` does when the
+`instrumentation` section of `config.yaml` is enabled; while off, spans and counters cost next to nothing.
+
+Example:
+
+    with span("crossref.match", sources=len(sources)) as s:
+        matches = matcher.match(sources)
+        s.count("matched", len(matches))
+
+Memory is measured process-wide, either by sampling the resident set size (`memory: rss`, cheap) or with
+`tracemalloc` (`memory: tracemalloc`, exact for Python allocations, but slows allocation-heavy code down).
+Spans opened in worker threads report memory of the whole process.
+"""
+import functools
+import itertools
+import json
+import logging
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+MEMORY_MODES = ("rss", "tracemalloc", None)
+
+_local = threading.local()
+_lock = threading.Lock()
+_ids = itertools.count(1)
+_state = {"enabled": False, "file": None, "memory": None, "sampler": None, "active": set()}
+
+
+def _current_rss():
+    # Current RSS from /proc on Linux, otherwise the peak RSS reported by getrusage
+    try:
+        with open("/proc/self/statm") as fin:
+            return int(fin.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == "darwin" else rss * 1024
+
+
+class _RSSSampler(threading.Thread):
+    """
+    Daemon thread that samples the RSS every `interval` seconds and raises the peak of every active span.
+    """
+
+    def __init__(self, interval):
+        super().__init__(name="rss-sampler", daemon=True)
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            rss = _current_rss()
+            with _lock:
+                for s in _state["active"]:
+                    s.mem_peak = max(s.mem_peak, rss)
+
+
+class Span:
+    """
+    A timed stage. Created by `span`; use `count` to add to its counters.
+    """
+
+    def __init__(self, name, parent=None, attrs=None):
+        self.name = name
+        self.id = next(_ids)
+        self.parent = parent
+        self.attrs = attrs or dict()
+        self.counters = dict()
+        self.mem_start = self.mem_peak = None
+
+    def count(self, name, n=1):
+        """
+        Add `n` to counter `name`.
+        """
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def _start(self):
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self._cpu0 = time.process_time()
+        if _state["memory"] == "rss":
+            self.mem_start = self.mem_peak = _current_rss()
+            with _lock:
+                _state["active"].add(self)
+        elif _state["memory"] == "tracemalloc":
+            # Spans share the tracemalloc peak: hand the peak so far to the open spans before resetting it
+            with _lock:
+                self.mem_start, peak = tracemalloc.get_traced_memory()
+                self.mem_peak = self.mem_start
+                for s in _state["active"]:
+                    s.mem_peak = max(s.mem_peak, peak)
+                _state["active"].add(self)
+                tracemalloc.reset_peak()
+
+    def _finish(self, error=None):
+        wall = time.perf_counter() - self._t0
+        cpu = time.process_time() - self._cpu0
+        if _state["memory"] is not None:
+            with _lock:
+                current = _current_rss() if _state["memory"] == "rss" else tracemalloc.get_traced_memory()[1]
+                _state["active"].discard(self)
+                self.mem_peak = max(self.mem_peak, current)
+                if _state["memory"] == "tracemalloc":
+                    for s in _state["active"]:
+                        s.mem_peak = max(s.mem_peak, current)
+        record = {"span": self.name, "id": self.id, "parent": None if self.parent is None else self.parent.id,
+                  "pid": os.getpid(), "thread": threading.current_thread().name,
+                  "start": self.started_at, "wall_s": round(wall, 6), "cpu_s": round(cpu, 6),
+                  "status": "ok" if error is None else "error"}
+        if error is not None:
+            record["error"] = f"{type(error).__name__}: {error}"
+        if self.mem_start is not None:
+            record.update({"memory": _state["memory"], "mem_start_bytes": self.mem_start,
+                           "mem_peak_bytes": self.mem_peak})
+        if self.counters:
+            record["counters"] = self.counters
+        if self.attrs:
+            record["attrs"] = self.attrs
+        _write(record)
+
+
+class _NullSpan:
+    # Returned while instrumentation is off
+    def count(self, name, n=1):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def _write(record):
+    line = json.dumps(record, default=str)
+    with _lock:
+        fout = _state["file"]
+        if fout is not None:
+            fout.write(f"{line}\n")
+            fout.flush()
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = list()
+    return stack
+
+
+def configure(enabled=True, path="logs/spans.jsonl", memory="rss", rss_interval=0.05):
+    """
+    Turn instrumentation on (or off).
+
+    Args:
+        enabled (bool) : If `False`, turn instrumentation off.
+        path (str or Path) : JSONL file the spans are appended to.
+        memory (str) : 'rss' to sample the resident set size, 'tracemalloc' to trace Python allocations, or `None`.
+        rss_interval (float) : Seconds between RSS samples.
+    """
+    if memory not in MEMORY_MODES:
+        raise ValueError(f"Unknown memory mode {memory!r}. Expected one of {MEMORY_MODES}.")
+    shutdown()
+    if not enabled:
+        return
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    _state.update(enabled=True, file=open(path, "a", encoding="utf8"), memory=memory)
+    if memory == "tracemalloc" and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif memory == "rss":
+        _state["sampler"] = _RSSSampler(rss_interval)
+        _state["sampler"].start()
+    logger.debug(f"Instrumentation enabled, writing spans to {path} (memory: {memory})")
+
+
+def shutdown():
+    """
+    Turn instrumentation off and close the span file.
+    """
+    if _state["sampler"] is not None:
+        _state["sampler"].stopped.set()
+    with _lock:
+        if _state["file"] is not None:
+            _state["file"].close()
+        _state.update(enabled=False, file=None, memory=None, sampler=None)
+        _state["active"].clear()
+
+
+def is_enabled():
+    return _state["enabled"]
+
+
+@contextmanager
+def span(name, parent=None, **attrs):
+    """
+    Time the enclosed block as span `name`.
+
+    Args:
+        name (str) : Name of the stage (e.g. 'resolve', 'crossref.match').
+        parent (Span) : Parent span. Defaults to the innermost open span of the calling thread; pass it explicitly
+            for spans opened in worker threads.
+        **attrs : Attributes recorded with the span (e.g. `network='lgis'`).
+
+    Returns:
+        span (Span) : The span, whose `count` method adds to its counters.
+    """
+    if not _state["enabled"]:
+        yield _NULL_SPAN
+        return
+    stack = _stack()
+    s = Span(name, parent if parent is not None else (stack[-1] if stack else None), attrs)
+    stack.append(s)
+    s._start()
+    try:
+        yield s
+    except BaseException as e:
+        s._finish(error=e)
+        raise
+    else:
+        s._finish()
+    finally:
+        stack.pop()
+
+
+def instrument(name=None):
+    """
+    Decorator that records every call of the decorated function as a span (named after the function by default).
+    """
+    def decorator(func):
+        span_name = name or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state["enabled"]:
+                return func(*args, **kwargs)
+            with span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current_span():
+    """
+    Returns the innermost open span of the calling thread (a no-op span if there is none).
+    """
+    stack = getattr(_local, "stack", None)
+    return stack[-1] if stack else _NULL_SPAN
+
+
+def count(name, n=1):
+    """
+    Add `n` to counter `name` of the innermost open span of the calling thread.
+    """
+    if _state["enabled"]:
+        current_span().count(name, n)
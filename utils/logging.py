@@ -1,18 +1,184 @@
-import yaml
-from yaml import Loader
+import atexit
+import copy
 import logging
 import logging.config
+import logging.handlers
+import queue
+import threading
+import time
+
+from utils.conf_cache import load_yaml
+
+
+# Listener of the active queue logging mode, if any
+_listener = None
 
 
 def get_logging_config(path_conf="config/logging_conf.yaml"):
-    # Load logging configs
-    with open(path_conf) as fin:
-        loggingConf = yaml.load(fin, Loader)
-    return loggingConf
+    # Load logging configs (parsed once per file version, see utils/conf_cache.py)
+    return load_yaml(path_conf)
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that enqueues records as they are, so that formatting happens on the listener thread.
+    Messages should not hold mutable arguments that change after the call (f-strings are always safe).
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener that drains up to `batch_size` records at a time and flushes its handlers once per batch.
+    """
+
+    def __init__(self, log_queue, *handlers, batch_size=256, respect_handler_level=True):
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.batch_size = batch_size
+
+    def _monitor(self):
+        q = self.queue
+        has_task_done = hasattr(q, "task_done")
+        stop = False
+        while not stop:
+            batch = [self.dequeue(True)]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                else:
+                    self.handle(record)
+                if has_task_done:
+                    q.task_done()
+            for handler in self.handlers:
+                getattr(handler, "force_flush", handler.flush)()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drop records that a single call site emits faster than `rate` per second (after a burst of `burst` records).
+    Only records at or below `level` are limited. The next record that gets through reports how many were dropped.
+
+    The filter can be shared by several handlers: the decision is made once per record.
+
+    Args:
+        rate (float) : Records per second allowed per call site.
+        burst (int) : Records allowed at once before limiting starts.
+        level (int or str) : Highest level that is rate limited (e.g. 'INFO').
+    """
+
+    def __init__(self, rate=20, burst=100, level="INFO"):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.level = logging._checkLevel(level)
+        self._sites = dict()  # (pathname, lineno) -> [tokens, last time, dropped]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        decision = getattr(record, "_rate_limited", None)
+        if decision is not None:
+            return not decision
+        if record.levelno > self.level:
+            record._rate_limited = False
+            return True
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.setdefault((record.pathname, record.lineno), [self.burst, now, 0])
+            site[0] = min(self.burst, site[0] + (now - site[1]) * self.rate)
+            site[1] = now
+            if site[0] < 1:
+                site[2] += 1
+                record._rate_limited = True
+                return False
+            site[0] -= 1
+            dropped, site[2] = site[2], 0
+        if dropped:
+            record.msg = f"{record.msg} [{dropped} similar messages suppressed]"
+        record._rate_limited = False
+        return True
+
+
+def _use_queue(conf, queue_conf):
+    """
+    Move the handlers listed in `queue_conf` behind a queue served by a background listener thread.
+    """
+    global _listener
+    names = set(queue_conf.get("handlers", []))
+    batch_size = queue_conf.get("batch_size", 256)
+    loggers = [logging.getLogger(name) for name in conf.get("loggers", dict())] + [logging.getLogger()]
+
+    queued = list()
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    for logger in loggers:
+        moved = [h for h in logger.handlers if h.name in names]
+        for h in moved:
+            logger.removeHandler(h)
+            if h not in queued:
+                queued.append(h)
+        if moved:
+            logger.addHandler(queue_handler)
+
+    rate_limit = queue_conf.get("rate_limit", None)
+    if rate_limit:
+        # One shared filter, so that the handlers agree on which records are dropped
+        limiter = RateLimitFilter(**rate_limit)
+        queue_handler.addFilter(limiter)
+        for logger in loggers:
+            for h in logger.handlers:
+                if h is not queue_handler:
+                    h.addFilter(limiter)
+
+    if batch_size > 1:
+        for h in queued:
+            if hasattr(h, "deferred_flush"):
+                h.deferred_flush = True
+    _listener = BatchingQueueListener(log_queue, *queued, batch_size=batch_size)
+    _listener.start()
+
+
+def stop_queue_listener():
+    """
+    Write the queued records and stop the listener thread of the queue logging mode.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_queue_listener)
 
 
 def set_logging_conf(conf):
+    """
+    Apply a logging config. Besides the `logging.config.dictConfig` schema, `conf` may have a `queue` section:
+
+        queue:
+          enabled: true
+          handlers: [errors_file, output_file]  # Handlers served by the background listener
+          batch_size: 256  # Records written between flushes
+          rate_limit:  # Optional, per call site
+            rate: 20
+            burst: 100
+            level: INFO
+
+    With the queue enabled, the listed handlers are removed from their loggers and replaced by a `QueueHandler`, so
+    that formatting and disk I/O happen on a background thread.
+    """
+    stop_queue_listener()
+    conf = copy.deepcopy(conf)
+    queue_conf = conf.pop("queue", None) or dict()
     logging.config.dictConfig(conf)
+    if queue_conf.get("enabled", False):
+        _use_queue(conf, queue_conf)
 
 
 def configure_logging(conf=None):
@@ -26,5 +192,4 @@ def configure_logging(conf=None):
         conf = get_logging_config()
     else:
         conf = get_logging_config(conf)
-    logging.config.dictConfig(conf)
-
+    set_logging_conf(conf)
@@ -0,0 +1,164 @@
+"""
+Streaming loader for NELA JSON dumps.
+
+A NELA JSON file is a single top-level array of article objects. `iter_articles` parses that array incrementally and
+yields one article at a time, so memory use depends on the size of an article, not of the file.
+"""
+import codecs
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from utils.fileio import open_file, strip_compression
+
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+
+
+class FileStats:
+    """
+    Throughput counters of one loaded file.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.articles = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def articles_per_sec(self):
+        return self.articles / self.seconds if self.seconds > 0 else 0.0
+
+    @property
+    def mb_per_sec(self):
+        return self.bytes / 1e6 / self.seconds if self.seconds > 0 else 0.0
+
+    def as_dict(self):
+        return {"path": self.path, "articles": self.articles, "bytes": self.bytes, "seconds": self.seconds,
+                "articles_per_sec": self.articles_per_sec, "mb_per_sec": self.mb_per_sec}
+
+    def __repr__(self):
+        return (f"FileStats(path={self.path!r}, articles={self.articles}, bytes={self.bytes}, "
+                f"seconds={self.seconds:.3f})")
+
+
+def iter_articles(path, fields=None, chunk_size=1 << 16, stats=None):
+    """
+    Incrementally parse the top-level array of a NELA JSON file, yielding one article at a time.
+
+    Args:
+        path (str or Path) : Path to the NELA JSON file, possibly compressed (e.g. `.json.gz`).
+        fields (list[str]) : If given, only keep these fields of each article.
+        chunk_size (int) : Number of bytes read at a time.
+        stats (FileStats) : Optional counters, updated as the file is read.
+
+    Returns:
+        articles (generator[dict]) : The articles in the file.
+    """
+    fields = list(fields) if fields is not None else None
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    start_time = time.perf_counter()
+
+    with open_file(path, "rb") as fin:
+        buf = ""
+        pos = 0
+        eof = False
+
+        def read_more(size=chunk_size):
+            nonlocal buf, pos, eof
+            chunk = fin.read(size)
+            if stats is not None:
+                stats.bytes += len(chunk)
+            eof = len(chunk) == 0
+            buf = buf[pos:] + decoder.decode(chunk, final=eof)
+            pos = 0
+
+        def next_token():
+            # Skip whitespace and return the next character, reading more data if needed
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in _WHITESPACE:
+                    pos += 1
+                if pos < len(buf):
+                    return buf[pos]
+                if eof:
+                    return None
+                read_more()
+
+        if next_token() != "[":
+            raise ValueError(f"{path}: expected a top-level JSON array")
+        pos += 1
+        if next_token() == "]":
+            return
+
+        while True:
+            next_token()
+            read_size = chunk_size
+            while True:
+                try:
+                    article, end = _decoder.raw_decode(buf, pos)
+                    # A value that ends exactly at the buffer end may be cut short (e.g. a number)
+                    if end < len(buf) or eof:
+                        break
+                except json.JSONDecodeError:
+                    if eof:
+                        raise
+                # Grow the reads geometrically so that large articles are not re-parsed once per chunk
+                read_more(read_size)
+                read_size *= 2
+            pos = end
+
+            if fields is not None:
+                article = {k: article[k] for k in fields if k in article}
+            if stats is not None:
+                stats.articles += 1
+                stats.seconds = time.perf_counter() - start_time
+            yield article
+
+            token = next_token()
+            if token == ",":
+                pos += 1
+            elif token == "]":
+                break
+            else:
+                raise ValueError(f"{path}: expected ',' or ']' but found {token!r}")
+
+    if stats is not None:
+        stats.seconds = time.perf_counter() - start_time
+
+
+def _process_file(path, func, fields):
+    stats = FileStats(path)
+    result = func(iter_articles(path, fields=fields, stats=stats))
+    return result, stats
+
+
+def map_files(func, paths, fields=None, workers=None):
+    """
+    Apply `func` to the article stream of each file in a process pool.
+
+    Args:
+        func (callable) : Module-level function taking a generator of articles and returning a picklable result.
+        paths (list[str or Path]) : Input files.
+        fields (list[str]) : If given, only keep these fields of each article.
+        workers (int) : Number of worker processes. Defaults to the number of CPUs.
+
+    Returns:
+        results (generator[tuple(str,Any,FileStats)]) : Tuples of (path, result, stats) as files complete.
+    """
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_process_file, path, func, fields): path for path in paths}
+        for future in as_completed(futures):
+            result, stats = future.result()
+            yield str(futures[future]), result, stats
+
+
+def list_json_files(directory, pattern="*.json"):
+    """
+    Returns the sorted list of files in `directory` matching `pattern` (e.g. one file per source), compressed or not
+    (e.g. `.json.gz` files match '*.json').
+    """
+    return sorted(p for p in Path(directory).glob(f"{pattern}*") if strip_compression(p).match(pattern))
@@ -0,0 +1,241 @@
+"""
+Minimal DAG runner for the end-to-end workflow.
+
+Each `Stage` declares the module it runs (a module exposing `main(config)`), the files or directories it reads and
+writes, and the config sections it depends on. Stages that read what another stage writes run after it; the others
+run in parallel, each in its own process.
+
+Before running a stage, its fingerprint is computed from the content hash of its inputs, its config sections and the
+source of its module. The stage is skipped if its outputs exist and the fingerprint matches the one recorded in the
+state file after its last successful run. Content hashes of large files are cached by size and modification time, so
+an unchanged database is not read again.
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from importlib.util import find_spec
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+STATE_FILE = "pipeline_state.json"
+
+
+class Stage:
+    """
+    A step of the pipeline.
+
+    Args:
+        name (str) : Name of the stage.
+        module (str) : Module whose `main(config)` runs the stage (e.g. 'media_networks.source_crossref').
+        inputs (list[str]) : Files or directories read by the stage. Relative paths are relative to the output
+            directory; `{data}` is replaced by the data directory.
+        outputs (list[str]) : Files or directories written by the stage, with the same conventions.
+        params (list[str]) : Config sections the stage depends on.
+        always (bool) : Run the stage on every run, for stages whose results depend on more than their inputs (e.g.
+            on remote sites).
+    """
+
+    def __init__(self, name, module, inputs=(), outputs=(), params=(), always=False):
+        self.name = name
+        self.module = module
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = list(params)
+        self.always = always
+
+    def __repr__(self):
+        return f"Stage({self.name!r})"
+
+
+def _plain(value):
+    # Config (OmegaConf or ConfigNode) to JSON-serializable values
+    if isinstance(value, Mapping):
+        return {str(k): _plain(v) for k, v in value.items()}
+    if isinstance(value, Sequence) and not isinstance(value, str):
+        return [_plain(v) for v in value]
+    return value if isinstance(value, (int, float, bool, type(None))) else str(value)
+
+
+def _hash_file(path, hashes):
+    stat = path.stat()
+    key = str(path.absolute())
+    cached = hashes.get(key)
+    if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return cached[2]
+    h = hashlib.sha256()
+    with open(path, "rb") as fin:
+        for block in iter(lambda: fin.read(1 << 20), b""):
+            h.update(block)
+    hashes[key] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+    return hashes[key][2]
+
+
+def content_hash(path, hashes):
+    """
+    Returns the SHA-256 of a file, or of the names and contents of the files in a directory, or `None` if `path`
+    does not exist. `hashes` caches file hashes by path, size and modification time (and is updated).
+    """
+    path = Path(path)
+    if path.is_file():
+        return _hash_file(path, hashes)
+    if not path.is_dir():
+        return None
+    h = hashlib.sha256()
+    for file in sorted(p for p in path.rglob("*") if p.is_file()):
+        h.update(f"{file.relative_to(path).as_posix()}\0{_hash_file(file, hashes)}\0".encode("utf-8"))
+    return h.hexdigest()
+
+
+class Pipeline:
+    """
+    Stages and their dependencies.
+
+    Args:
+        stages (list[Stage]) : The stages, in any order.
+        config (omegaconf.Config or ConfigNode) : Config of the run (for `path.data`, `path.output_dir` and params).
+        config_path (str or Path) : Config file the stage processes load.
+    """
+
+    def __init__(self, stages, config, config_path):
+        self.stages = {stage.name: stage for stage in stages}
+        self.config = config
+        self.config_path = Path(config_path).absolute()
+        self.output_dir = Path(config.path.output_dir)
+        self.data_dir = Path(config.path.data)
+
+        producers = {self.resolve(out): stage.name for stage in stages for out in stage.outputs}
+        self.deps = {stage.name: sorted({producers[self.resolve(i)] for i in stage.inputs
+                                         if self.resolve(i) in producers} - {stage.name})
+                     for stage in stages}
+
+    def resolve(self, path):
+        path = Path(str(path).format(data=self.data_dir))
+        return path if path.is_absolute() else self.output_dir.joinpath(path)
+
+    def ancestors(self, name):
+        """
+        Returns `name` and every stage it depends on, directly or not.
+        """
+        seen, todo = set(), [name]
+        while todo:
+            n = todo.pop()
+            if n not in seen:
+                seen.add(n)
+                todo.extend(self.deps[n])
+        return seen
+
+    def fingerprint(self, stage, hashes):
+        spec = find_spec(stage.module)
+        code = _hash_file(Path(spec.origin), hashes) if spec is not None and spec.origin else None
+        payload = {"module": stage.module, "code": code,
+                   "params": {p: _plain(self.config.get(p, None)) for p in stage.params},
+                   "inputs": {i: content_hash(self.resolve(i), hashes) for i in stage.inputs}}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def _load_state(self, path):
+        try:
+            with open(path) as fin:
+                state = json.load(fin)
+            return state.get("stages", dict()), state.get("hashes", dict())
+        except (OSError, ValueError):
+            return dict(), dict()
+
+    def _save_state(self, path, stages, hashes):
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "w") as fout:
+            json.dump({"stages": stages, "hashes": hashes}, fout, indent=1)
+        os.replace(tmp_path, path)
+
+    def run(self, force=None, until=None, workers=None, dry_run=False):
+        """
+        Run the stages that are out of date.
+
+        Args:
+            force (bool or list[str]) : Run these stages (or all of them if `True`) even if they are up to date.
+            until (str) : Only run this stage and the stages it depends on.
+            workers (int) : Max stages run at once.
+            dry_run (bool) : Only report which stages would run. Stages after one that would run are reported as
+                'pending', since their inputs are not known yet.
+
+        Returns:
+            status (dict[str,str]) : 'skipped', 'done', 'failed' or 'blocked' (a dependency failed) per stage.
+        """
+        selected = self.ancestors(until) if until is not None else set(self.stages)
+        forced = set(self.stages) if force is True else set(force or ())
+        state_path = self.output_dir.joinpath(STATE_FILE)
+        state, hashes = self._load_state(state_path)
+        status = dict()
+        running = dict()  # future -> stage name
+
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers or len(selected) or 1, mp_context=ctx) as executor:
+            while len(status) < len(selected):
+                progressed = False
+                for name in sorted(selected - set(status) - set(running.values())):
+                    dep_status = [status.get(d) for d in self.deps[name] if d in selected]
+                    if any(s in ("failed", "blocked") for s in dep_status):
+                        status[name] = "blocked"
+                        progressed = True
+                        logger.error(f"Stage {name} blocked by a failed dependency")
+                        continue
+                    if any(s is None or s == "pending" for s in dep_status):
+                        if dry_run and all(s is not None for s in dep_status):
+                            status[name] = "pending"
+                            progressed = True
+                        continue
+                    stage = self.stages[name]
+                    fingerprint = self.fingerprint(stage, hashes)
+                    up_to_date = state.get(name, dict()).get("fingerprint") == fingerprint and \
+                        all(self.resolve(o).exists() for o in stage.outputs)
+                    progressed = True
+                    if up_to_date and name not in forced and not stage.always:
+                        status[name] = "skipped"
+                        logger.info(f"Stage {name} is up to date")
+                    elif dry_run:
+                        status[name] = "pending"
+                        logger.info(f"Stage {name} would run")
+                    else:
+                        logger.info(f"Running stage {name}")
+                        running[executor.submit(_run_stage, stage.module, str(self.config_path))] = name
+                if running:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        name = running.pop(future)
+                        try:
+                            elapsed = future.result()
+                        except KeyboardInterrupt:
+                            raise
+                        except BaseException as e:
+                            # Including SystemExit, e.g. from `exit(1)` in `init_workspace`
+                            status[name] = "failed"
+                            logger.error(f"Stage {name} failed: {e!r}")
+                            continue
+                        status[name] = "done"
+                        # Fingerprinted after the run: stages may update their inputs (e.g. rollups in the database)
+                        state[name] = {"fingerprint": self.fingerprint(self.stages[name], hashes),
+                                       "finished_at": time.time(), "seconds": elapsed}
+                        self._save_state(state_path, state, hashes)
+                        logger.info(f"Stage {name} done in {elapsed:.1f}s")
+                elif not progressed:
+                    raise RuntimeError(f"Dependency cycle among stages {sorted(selected - set(status))}")
+        if not dry_run:
+            self._save_state(state_path, state, hashes)
+        return status
+
+
+def _run_stage(module_name, config_path):
+    # Runs in a worker process: set the workspace up like the stand-alone script would
+    import importlib
+    from utils.config import init_workspace
+    t0 = time.perf_counter()
+    module = importlib.import_module(module_name)
+    module.main(init_workspace(config_path=config_path))
+    return time.perf_counter() - t0
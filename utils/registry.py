@@ -0,0 +1,234 @@
+"""
+Persistent registry of sources, media networks, domains and resolved IP addresses.
+
+The registry is an indexed SQLite database that holds the join between `ps_sources.txt`, the media network lists and
+the DNS resolutions. It is bulk-upserted by `source_crossref.py`, and downstream analyses query it directly instead of
+re-joining the raw files.
+"""
+import socket
+import sqlite3
+import struct
+import time
+from pathlib import Path
+
+import pandas as pd
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS networks (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+
+CREATE TABLE IF NOT EXISTS network_members (
+    network_id INTEGER NOT NULL REFERENCES networks(id),
+    name TEXT NOT NULL,
+    PRIMARY KEY (network_id, name)
+);
+CREATE INDEX IF NOT EXISTS idx_network_members_name ON network_members(name);
+
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    feed_url TEXT,
+    domain TEXT,
+    network_id INTEGER REFERENCES networks(id),
+    match_score REAL
+);
+CREATE INDEX IF NOT EXISTS idx_sources_network ON sources(network_id);
+CREATE INDEX IF NOT EXISTS idx_sources_domain ON sources(domain);
+
+CREATE TABLE IF NOT EXISTS ip_addresses (
+    domain TEXT NOT NULL,
+    ipaddr TEXT NOT NULL,
+    ip_int INTEGER,
+    prefix24 INTEGER,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (domain, ipaddr)
+);
+CREATE INDEX IF NOT EXISTS idx_ip_addresses_ip_int ON ip_addresses(ip_int);
+CREATE INDEX IF NOT EXISTS idx_ip_addresses_prefix24 ON ip_addresses(prefix24);
+"""
+
+_SOURCE_COLUMNS = "s.name AS source, s.feed_url, s.domain, coalesce(n.name, 'UNKNOWN') AS network, s.match_score"
+
+
+def ip_to_int(ipaddr):
+    """
+    Returns the IPv4 address `ipaddr` as an integer, or `None` if it is not a valid IPv4 address.
+    """
+    try:
+        return struct.unpack(">I", socket.inet_aton(ipaddr))[0]
+    except (OSError, TypeError):
+        return None
+
+
+def int_to_ip(ip_int):
+    """
+    Returns the dotted-quad string of the integer IPv4 address `ip_int`.
+    """
+    return socket.inet_ntoa(struct.pack(">I", ip_int))
+
+
+class SourceRegistry:
+    """
+    SQLite-backed registry of sources, networks, domains and IPs.
+
+    Args:
+        path (str or Path) : Path to the registry database. Created if it does not exist.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.con = sqlite3.connect(self.path)
+        self.con.row_factory = sqlite3.Row
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.con.close()
+
+    def upsert_networks(self, network_sources):
+        """
+        Set the networks and their member names: networks are added, and the members of every network are replaced by
+        those in `network_sources` (names dropped from a list on a re-scrape are removed, as are the members of
+        networks without a list).
+
+        Args:
+            network_sources (dict[str,list[str]]) : Normalized source names of each network.
+        """
+        with self.con:
+            self.con.executemany("INSERT OR IGNORE INTO networks(name) VALUES (?)",
+                                 [(network,) for network in network_sources])
+            self.con.execute("DELETE FROM network_members")
+            self.con.executemany("INSERT OR IGNORE INTO network_members(network_id, name) "
+                                 "SELECT id, ? FROM networks WHERE name = ?",
+                                 [(name, network) for network, names in network_sources.items() for name in names])
+
+    def upsert_sources(self, sources):
+        """
+        Set the registered sources: add or update each source, and remove the sources that are not in `sources`
+        (e.g. dropped from `ps_sources.txt`). The IP addresses of their domains are kept.
+
+        Args:
+            sources (iterable[tuple]) : Tuples of (source, feed_url, domain, network, match_score).
+                `network` is `None` (or 'UNKNOWN') for sources without a network.
+
+        Returns:
+            removed (int) : Number of sources removed.
+        """
+        rows = [(src, feed, domain, None if network == "UNKNOWN" else network, score)
+                for src, feed, domain, network, score in sources]
+        with self.con:
+            self.con.executemany("INSERT INTO sources(name, feed_url, domain, network_id, match_score) "
+                                 "VALUES (?, ?, ?, (SELECT id FROM networks WHERE name = ?), ?) "
+                                 "ON CONFLICT(name) DO UPDATE SET feed_url = excluded.feed_url, "
+                                 "domain = excluded.domain, network_id = excluded.network_id, "
+                                 "match_score = excluded.match_score", rows)
+            self.con.execute("CREATE TEMP TABLE IF NOT EXISTS registered (name TEXT PRIMARY KEY)")
+            self.con.execute("DELETE FROM registered")
+            self.con.executemany("INSERT OR IGNORE INTO registered(name) VALUES (?)", ((row[0],) for row in rows))
+            removed = self.con.execute("DELETE FROM sources WHERE name NOT IN (SELECT name FROM registered)")
+            self.con.execute("DELETE FROM registered")
+        return removed.rowcount
+
+    def upsert_ips(self, observations):
+        """
+        Add resolved IPs, widening the observation window of addresses that are already known.
+
+        Args:
+            observations (iterable[tuple]) : Tuples of (domain, ipaddr, first_seen, last_seen).
+        """
+        rows = list()
+        for domain, ipaddr, first_seen, last_seen in observations:
+            ip_int = ip_to_int(ipaddr)
+            rows.append((domain, ipaddr, ip_int, None if ip_int is None else ip_int >> 8, first_seen, last_seen))
+        with self.con:
+            self.con.executemany("INSERT INTO ip_addresses(domain, ipaddr, ip_int, prefix24, first_seen, last_seen) "
+                                 "VALUES (?, ?, ?, ?, ?, ?) "
+                                 "ON CONFLICT(domain, ipaddr) DO UPDATE SET "
+                                 "first_seen = min(first_seen, excluded.first_seen), "
+                                 "last_seen = max(last_seen, excluded.last_seen)", rows)
+
+    def _sources(self, where="", params=()):
+        query = f"SELECT {_SOURCE_COLUMNS} FROM sources s LEFT JOIN networks n ON n.id = s.network_id {where}"
+        return [dict(row) for row in self.con.execute(query, params)]
+
+    def by_source(self, source):
+        """
+        Returns the record of `source` (with its IPs under `ipaddrs`), or `None` if it is not registered.
+        """
+        rows = self._sources("WHERE s.name = ?", (source,))
+        if not rows:
+            return None
+        row = rows[0]
+        row["ipaddrs"] = [ip for ip, in self.con.execute("SELECT ipaddr FROM ip_addresses WHERE domain = ? "
+                                                         "ORDER BY last_seen DESC", (row["domain"],))]
+        return row
+
+    def by_network(self, network):
+        """
+        Returns the sources assigned to `network` ('UNKNOWN' for sources without a network).
+        """
+        if network == "UNKNOWN":
+            return self._sources("WHERE s.network_id IS NULL ORDER BY s.name")
+        return self._sources("WHERE n.name = ? ORDER BY s.name", (network,))
+
+    def by_ip(self, ipaddr):
+        """
+        Returns the sources whose domain ever resolved to `ipaddr`.
+        """
+        return self._sources("WHERE s.domain IN (SELECT domain FROM ip_addresses WHERE ip_int = ?) ORDER BY s.name",
+                             (ip_to_int(ipaddr),))
+
+    def by_prefix24(self, ipaddr):
+        """
+        Returns the sources whose domain ever resolved to an address in the /24 network of `ipaddr`.
+        """
+        ip_int = ip_to_int(ipaddr)
+        prefix = None if ip_int is None else ip_int >> 8
+        return self._sources("WHERE s.domain IN (SELECT domain FROM ip_addresses WHERE prefix24 = ?) ORDER BY s.name",
+                             (prefix,))
+
+    def source_ips(self, current_only=False):
+        """
+        Returns a DataFrame with one row per (source, IP) pair, with columns `source`, `network`, `domain`, `ipaddr`,
+        `ip_int`, `first_seen` and `last_seen`. Sources without IPs have a single row with `ipaddr` set to 'UNKNOWN'.
+
+        Args:
+            current_only (bool) : If `True`, only keep the IPs seen in the latest resolution of each domain.
+        """
+        query = "SELECT s.name AS source, coalesce(n.name, 'UNKNOWN') AS network, s.domain, " \
+                "coalesce(ip.ipaddr, 'UNKNOWN') AS ipaddr, ip.ip_int, ip.first_seen, ip.last_seen " \
+                "FROM sources s LEFT JOIN networks n ON n.id = s.network_id " \
+                "LEFT JOIN ip_addresses ip ON ip.domain = s.domain"
+        if current_only:
+            query += " AND ip.last_seen = (SELECT max(last_seen) FROM ip_addresses WHERE domain = s.domain)"
+        return pd.read_sql_query(query + " ORDER BY s.name, ip.ipaddr", self.con)
+
+
+def ip_observations_from_snapshot(records, domains, now=None):
+    """
+    Convert `source_IPs.jsonl` records into (domain, ipaddr, first_seen, last_seen) observations.
+
+    Args:
+        records (iterable[dict]) : Parsed JSONL records.
+        domains (dict[str,str]) : Domain of each source.
+        now (float) : Timestamp used for records without `resolved_at`.
+    """
+    now = time.time() if now is None else now
+    for d in records:
+        domain = domains.get(d["source"])
+        if domain is None:
+            continue
+        seen = d.get("resolved_at") or now
+        for ipaddr in d["ipaddrlist"]:
+            yield domain, ipaddr, seen, seen
@@ -0,0 +1,203 @@
+"""
+Persistent, TTL-aware cache of DNS resolutions.
+
+Results are committed to SQLite as soon as they are recorded, so an interrupted refresh resumes from where it stopped.
+Besides the latest resolution of each domain, the cache keeps the history of every IP address a domain resolved to.
+"""
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+from utils.fileio import JsonlWriter
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    source TEXT PRIMARY KEY,
+    domain TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_sources_domain ON sources(domain);
+
+CREATE TABLE IF NOT EXISTS resolutions (
+    domain TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    hostname TEXT,
+    aliaslist TEXT,
+    ipaddrlist TEXT,
+    ttl INTEGER,
+    nameserver TEXT,
+    error TEXT,
+    failures INTEGER NOT NULL DEFAULT 0,
+    resolved_at REAL,
+    checked_at REAL NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_resolutions_expires ON resolutions(expires_at);
+
+CREATE TABLE IF NOT EXISTS ip_history (
+    domain TEXT NOT NULL,
+    ipaddr TEXT NOT NULL,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL,
+    PRIMARY KEY (domain, ipaddr)
+);
+CREATE INDEX IF NOT EXISTS idx_ip_history_ipaddr ON ip_history(ipaddr);
+"""
+
+
+class ResolutionCache:
+    """
+    SQLite-backed resolution cache keyed by domain.
+
+    Args:
+        path (str or Path) : Path to the cache database. Created if it does not exist.
+        default_ttl (int) : TTL (seconds) used when the resolver does not report one.
+        min_ttl (int) : Lower bound applied to reported TTLs, so that short DNS TTLs do not force a refresh every run.
+    """
+
+    def __init__(self, path, default_ttl=86400, min_ttl=0):
+        self.path = Path(path)
+        self.path.parent.mkdir(exist_ok=True, parents=True)
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.con = sqlite3.connect(self.path)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute("PRAGMA synchronous=NORMAL")
+        self.con.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.con.close()
+
+    def register_sources(self, sources):
+        """
+        Set the registered sources: add or update the domain of each source, and remove the sources that are not in
+        `sources` (e.g. dropped from `ps_sources.txt`), so they are no longer resolved nor written to snapshots. The
+        resolutions and IP history of their domains are kept.
+
+        Args:
+            sources (iterable[tuple(str,str)]) : Pairs of (source, domain).
+
+        Returns:
+            removed (int) : Number of sources removed.
+        """
+        sources = list(sources)
+        with self.con:
+            self.con.executemany("INSERT INTO sources(source, domain) VALUES (?, ?) "
+                                 "ON CONFLICT(source) DO UPDATE SET domain = excluded.domain", sources)
+            self.con.execute("CREATE TEMP TABLE IF NOT EXISTS registered (source TEXT PRIMARY KEY)")
+            self.con.execute("DELETE FROM registered")
+            self.con.executemany("INSERT OR IGNORE INTO registered(source) VALUES (?)",
+                                 ((source,) for source, _ in sources))
+            removed = self.con.execute("DELETE FROM sources WHERE source NOT IN (SELECT source FROM registered)")
+            self.con.execute("DELETE FROM registered")
+        return removed.rowcount
+
+    def stale_domains(self, now=None):
+        """
+        Returns the registered domains that are missing from the cache, expired, or whose last lookup failed.
+
+        Args:
+            now (float) : Reference UNIX timestamp. Defaults to the current time.
+
+        Returns:
+            domains (list[str]) : Domains to re-resolve.
+        """
+        now = time.time() if now is None else now
+        rows = self.con.execute("SELECT DISTINCT s.domain FROM sources s "
+                                "LEFT JOIN resolutions r ON r.domain = s.domain "
+                                "WHERE r.domain IS NULL OR r.status != 'ok' OR r.expires_at <= ?", (now,))
+        return [domain for domain, in rows]
+
+    def record_success(self, domain, result, now=None):
+        """
+        Store a successful resolution and update the IP history of `domain`. Committed immediately.
+
+        Args:
+            domain (str) : The resolved domain.
+            result (dict) : Resolution with keys `hostname`, `aliaslist`, `ipaddrlist` and optionally `ttl`,
+                `nameserver`.
+            now (float) : Resolution timestamp. Defaults to the current time.
+        """
+        now = time.time() if now is None else now
+        ttl = result.get("ttl")
+        expiry = max(self.min_ttl, self.default_ttl if ttl is None else ttl)
+        with self.con:
+            self.con.execute("INSERT OR REPLACE INTO resolutions(domain, status, hostname, aliaslist, ipaddrlist, "
+                             "ttl, nameserver, error, failures, resolved_at, checked_at, expires_at) "
+                             "VALUES (?, 'ok', ?, ?, ?, ?, ?, NULL, 0, ?, ?, ?)",
+                             (domain, result["hostname"], json.dumps(result["aliaslist"]),
+                              json.dumps(result["ipaddrlist"]), ttl, result.get("nameserver"), now, now, now + expiry))
+            self.con.executemany("INSERT INTO ip_history(domain, ipaddr, first_seen, last_seen) VALUES (?, ?, ?, ?) "
+                                 "ON CONFLICT(domain, ipaddr) DO UPDATE SET last_seen = excluded.last_seen",
+                                 [(domain, ip, now, now) for ip in result["ipaddrlist"]])
+
+    def record_failure(self, domain, error, now=None):
+        """
+        Store a failed lookup. The last successful addresses (if any) are kept, and the entry is retried next run.
+
+        Args:
+            domain (str) : The domain that failed to resolve.
+            error (Exception or str) : The failure reason.
+            now (float) : Lookup timestamp. Defaults to the current time.
+        """
+        now = time.time() if now is None else now
+        with self.con:
+            self.con.execute("INSERT INTO resolutions(domain, status, error, failures, checked_at, expires_at) "
+                             "VALUES (?, 'failed', ?, 1, ?, ?) "
+                             "ON CONFLICT(domain) DO UPDATE SET status = 'failed', error = excluded.error, "
+                             "failures = failures + 1, checked_at = excluded.checked_at, "
+                             "expires_at = excluded.expires_at",
+                             (domain, str(error), now, now))
+
+    def iter_snapshot(self):
+        """
+        Iterate over the latest successful resolution of each registered source.
+
+        Returns:
+            records (generator[dict]) : Records with keys `source`, `hostname`, `aliaslist`, `ipaddrlist`, `ttl`
+                and `resolved_at`.
+        """
+        rows = self.con.execute("SELECT s.source, r.hostname, r.aliaslist, r.ipaddrlist, r.ttl, r.resolved_at "
+                                "FROM sources s JOIN resolutions r ON r.domain = s.domain "
+                                "WHERE r.ipaddrlist IS NOT NULL ORDER BY s.rowid")
+        for source, hostname, aliaslist, ipaddrlist, ttl, resolved_at in rows:
+            yield {"source": source, "hostname": hostname, "aliaslist": json.loads(aliaslist),
+                   "ipaddrlist": json.loads(ipaddrlist), "ttl": ttl, "resolved_at": resolved_at}
+
+    def write_snapshot(self, path, asn_index=None):
+        """
+        Write the latest resolutions to a JSONL file. The file is replaced atomically.
+
+        Args:
+            path (str or Path) : Output path (e.g. `ipaddrs/source_IPs.jsonl`, or `.jsonl.gz` to compress it).
+            asn_index (analysis.asn.AsnIndex) : If given, add the ASN (`asnlist`) and organization (`orglist`) of
+                each address to the records.
+        """
+        records = self.iter_snapshot()
+        if asn_index is not None:
+            records = asn_index.annotate_records(records)
+        with JsonlWriter(path) as writer:
+            writer.write_all(records)
+
+    def history(self, domain=None):
+        """
+        Returns the IP history as a list of (domain, ipaddr, first_seen, last_seen), optionally for a single `domain`.
+        """
+        if domain is None:
+            return self.con.execute("SELECT domain, ipaddr, first_seen, last_seen FROM ip_history "
+                                    "ORDER BY domain, first_seen").fetchall()
+        return self.con.execute("SELECT domain, ipaddr, first_seen, last_seen FROM ip_history WHERE domain = ? "
+                                "ORDER BY first_seen", (domain,)).fetchall()
+
+    def status_counts(self):
+        """
+        Returns a dict mapping each resolution status to its number of domains.
+        """
+        return dict(self.con.execute("SELECT status, count(*) FROM resolutions GROUP BY status"))
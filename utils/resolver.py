@@ -0,0 +1,301 @@
+"""
+Concurrent, rate-limited DNS resolution.
+
+Lookups run in a thread pool so that many of them are in flight at once. Every query first takes a token from a
+global bucket and from the bucket of the nameserver it is sent to, so throughput is bounded by the configured rates
+rather than by lookup latency.
+"""
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+logger = logging.getLogger(__name__)
+
+SYSTEM_RESOLVER = "system"
+
+_TYPE_A = 1
+_TYPE_CNAME = 5
+_CLASS_IN = 1
+_RCODE_NXDOMAIN = 3
+
+
+class ResolutionError(Exception):
+    """
+    Raised when a domain cannot be resolved.
+    Errors flagged as `permanent` (e.g. NXDOMAIN) are not retried.
+    """
+
+    def __init__(self, message, permanent=False):
+        super().__init__(message)
+        self.permanent = permanent
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket.
+
+    Args:
+        rate (float) : Tokens added per second. If `None` or 0, `acquire` never blocks.
+        burst (int) : Maximum number of tokens held by the bucket. Defaults to `max(1, rate)`.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst else max(1, rate or 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available.
+        """
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+def _encode_name(domain):
+    out = bytearray()
+    for label in domain.rstrip(".").split("."):
+        try:
+            label = label.encode("idna")
+        except UnicodeError:  # Empty or overlong labels, or invalid characters
+            raise ResolutionError(f"Invalid domain name {domain!r}", permanent=True) from None
+        if not 0 < len(label) < 64:
+            raise ResolutionError(f"Invalid domain name {domain!r}", permanent=True)
+        out.append(len(label))
+        out += label
+    out.append(0)
+    return bytes(out)
+
+
+def _read_name(msg, offset):
+    """
+    Read a (possibly compressed) domain name from `msg` starting at `offset`.
+
+    Returns:
+        name (str) : The decoded name.
+        offset (int) : Offset of the first byte after the name in the original position.
+    """
+    labels = list()
+    end = None
+    jumps = 0
+    while True:
+        length = msg[offset]
+        if length & 0xC0 == 0xC0:  # Compression pointer
+            if end is None:
+                end = offset + 2
+            offset = ((length & 0x3F) << 8) | msg[offset + 1]
+            jumps += 1
+            if jumps > 32:
+                raise ResolutionError("Malformed DNS response (pointer loop)")
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(msg[offset:offset + length].decode("ascii", errors="replace"))
+        offset += length
+    return ".".join(labels), (end if end is not None else offset)
+
+
+def query_nameserver(domain, nameserver, timeout=2.0, port=53):
+    """
+    Send an A query for `domain` to `nameserver` over UDP and parse the answer.
+
+    Args:
+        domain (str) : Domain to resolve.
+        nameserver (str) : IP address of the nameserver, optionally as `ip:port`.
+        timeout (float) : Socket timeout in seconds.
+        port (int) : Nameserver port, used when `nameserver` does not include one.
+
+    Returns:
+        hostname (str) : Canonical name of the host.
+        aliaslist (list[str]) : Names that were resolved through CNAME records.
+        ipaddrlist (list[str]) : IPv4 addresses of the host.
+        ttl (int) : Smallest TTL among the answer records.
+    """
+    host, _, ns_port = nameserver.partition(":")
+    qid = random.getrandbits(16)
+    query = struct.pack(">HHHHHH", qid, 0x0100, 1, 0, 0, 0) + _encode_name(domain) + struct.pack(">HH", _TYPE_A, _CLASS_IN)
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect((host, int(ns_port or port)))
+        sock.send(query)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                msg = sock.recv(4096)
+            except socket.timeout:
+                raise ResolutionError(f"Timed out querying {nameserver} for {domain}")
+            if len(msg) >= 12 and struct.unpack(">H", msg[:2])[0] == qid:
+                break
+            # Stray datagram, keep waiting for our answer
+            sock.settimeout(max(0.001, deadline - time.monotonic()))
+
+    try:
+        return _parse_response(msg, domain, nameserver)
+    except (IndexError, struct.error) as e:
+        raise ResolutionError(f"Malformed response from {nameserver} for {domain}: {e}")
+
+
+def _parse_response(msg, domain, nameserver):
+    _, flags, qdcount, ancount, _, _ = struct.unpack(">HHHHHH", msg[:12])
+    rcode = flags & 0x000F
+    if rcode == _RCODE_NXDOMAIN:
+        raise ResolutionError(f"NXDOMAIN for {domain}", permanent=True)
+    if rcode != 0:
+        raise ResolutionError(f"Nameserver {nameserver} returned rcode {rcode} for {domain}")
+    if flags & 0x0200:
+        raise ResolutionError(f"Truncated response from {nameserver} for {domain}")
+
+    offset = 12
+    for _ in range(qdcount):
+        _, offset = _read_name(msg, offset)
+        offset += 4
+
+    hostname = domain.rstrip(".")
+    aliaslist = list()
+    ipaddrlist = list()
+    ttls = list()
+    for _ in range(ancount):
+        name, offset = _read_name(msg, offset)
+        rtype, rclass, ttl, rdlength = struct.unpack(">HHIH", msg[offset:offset + 10])
+        offset += 10
+        rdata_offset = offset
+        offset += rdlength
+        if rclass != _CLASS_IN:
+            continue
+        if rtype == _TYPE_A and rdlength == 4:
+            ipaddrlist.append(socket.inet_ntoa(msg[rdata_offset:offset]))
+            ttls.append(ttl)
+        elif rtype == _TYPE_CNAME:
+            aliaslist.append(name)
+            hostname, _ = _read_name(msg, rdata_offset)
+            ttls.append(ttl)
+
+    if not ipaddrlist:
+        raise ResolutionError(f"No A records for {domain}", permanent=True)
+    return hostname, aliaslist, ipaddrlist, min(ttls)
+
+
+def query_system(domain):
+    """
+    Resolve `domain` with the operating system resolver.
+    The system resolver does not expose TTLs, so `ttl` is always `None`.
+    """
+    try:
+        hostname, aliaslist, ipaddrlist = socket.gethostbyname_ex(domain)
+    except socket.herror as e:
+        raise ResolutionError(f"{domain}: {e}", permanent=True)
+    except socket.gaierror as e:
+        raise ResolutionError(f"{domain}: {e}", permanent=e.errno == socket.EAI_NONAME)
+    return hostname, aliaslist, ipaddrlist, None
+
+
+class Resolver:
+    """
+    Thread-pool DNS resolver with global and per-nameserver rate limits.
+
+    Args:
+        nameservers (list[str]) : Nameserver IPs to query directly. If empty, the system resolver is used.
+        rate (float) : Maximum queries per second across all nameservers.
+        nameserver_rate (float) : Maximum queries per second sent to any single nameserver.
+        burst (int) : Burst size of the rate limit buckets.
+        timeout (float) : Timeout of a single query, in seconds.
+        retries (int) : Number of retries after a failed query.
+        backoff (float) : Base delay of the exponential backoff between retries, in seconds.
+        workers (int) : Number of lookups kept in flight.
+    """
+
+    def __init__(self, nameservers=None, rate=50, nameserver_rate=20, burst=None,
+                 timeout=2.0, retries=2, backoff=0.5, workers=32):
+        self.nameservers = list(nameservers) if nameservers else [SYSTEM_RESOLVER]
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.workers = workers
+        self.global_bucket = TokenBucket(rate, burst)
+        self.nameserver_buckets = {ns: TokenBucket(nameserver_rate, burst) for ns in self.nameservers}
+
+    def _query(self, domain, nameserver):
+        self.global_bucket.acquire()
+        self.nameserver_buckets[nameserver].acquire()
+        if nameserver == SYSTEM_RESOLVER:
+            return query_system(domain)
+        return query_nameserver(domain, nameserver, timeout=self.timeout)
+
+    def resolve(self, domain):
+        """
+        Resolve a single domain, retrying with exponential backoff. Retries rotate through the nameservers.
+
+        Args:
+            domain (str) : The domain to resolve.
+
+        Returns:
+            result (dict) : Keys `hostname`, `aliaslist`, `ipaddrlist`, `ttl` and `nameserver`.
+        """
+        start = random.randrange(len(self.nameservers))
+        for attempt in range(self.retries + 1):
+            nameserver = self.nameservers[(start + attempt) % len(self.nameservers)]
+            try:
+                hostname, aliaslist, ipaddrlist, ttl = self._query(domain, nameserver)
+                return {"hostname": hostname, "aliaslist": aliaslist, "ipaddrlist": ipaddrlist,
+                        "ttl": ttl, "nameserver": nameserver}
+            except UnicodeError as e:
+                # Raised by the IDNA codec (e.g. in `gethostbyname_ex`) for malformed names: retrying cannot help
+                raise ResolutionError(f"Invalid domain name {domain!r}: {e}", permanent=True) from e
+            except (ResolutionError, OSError) as e:
+                if getattr(e, "permanent", False) or attempt == self.retries:
+                    raise ResolutionError(str(e), permanent=getattr(e, "permanent", False)) from e
+                delay = self.backoff * (2 ** attempt) * (1 + random.random())
+                logger.debug(f"Retrying {domain=} in {delay:.2f}s after: {e}")
+                time.sleep(delay)
+
+    def resolve_many(self, items):
+        """
+        Resolve many domains concurrently, yielding results as they complete.
+        At most `2 * workers` lookups are queued at a time, so `items` may be a lazy iterable.
+
+        Args:
+            items (iterable[tuple(Any,str)]) : Pairs of (key, domain).
+
+        Returns:
+            results (generator[tuple(Any,str,dict,Exception)]) : Tuples of (key, domain, result, error).
+                Exactly one of `result` and `error` is `None`.
+        """
+        items = iter(items)
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = dict()
+
+            def fill():
+                for key, domain in items:
+                    pending[executor.submit(self.resolve, domain)] = (key, domain)
+                    if len(pending) >= 2 * self.workers:
+                        break
+
+            fill()
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, domain = pending.pop(future)
+                    try:
+                        yield key, domain, future.result(), None
+                    except ResolutionError as e:
+                        yield key, domain, None, e
+                fill()
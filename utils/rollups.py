@@ -0,0 +1,134 @@
+"""
+Materialized daily article counts for fast time-series queries.
+
+`update_rollups` builds covering indexes on `newsdata` and keeps one table of daily article counts per source and one
+per network. Only rows added since the previous update (by rowid) are aggregated, so refreshing after an ingest is
+cheap. Weekly, monthly or any other multi-day buckets are derived from the daily tables by `get_timeseries`, whose
+results are cached per database fingerprint.
+"""
+import logging
+from functools import lru_cache
+from pathlib import Path
+
+import pandas as pd
+
+from utils.db import get_connection, connect_writable, get_watermark, set_watermark
+
+
+logger = logging.getLogger(__name__)
+
+WATERMARK = "rollups"
+
+INDEXES = {
+    "idx_newsdata_published_network": "newsdata(published_utc, network)",
+    "idx_newsdata_published_source": "newsdata(published_utc, source)",
+}
+
+# Grouping column -> daily rollup table. NULL groups are stored as '' so that they can be upserted.
+ROLLUP_TABLES = {
+    "source": "rollup_daily_source",
+    "network": "rollup_daily_network",
+}
+
+
+def update_rollups(path):
+    """
+    Create the covering indexes and daily rollup tables of the database at `path`, or bring them up to date.
+
+    Args:
+        path (str or Path) : Path to the NELA database.
+
+    Returns:
+        n_rows (int) : Number of `newsdata` rows aggregated by this update.
+    """
+    con = connect_writable(path)
+    try:
+        for name, target in INDEXES.items():
+            con.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {target}")
+        for column, table in ROLLUP_TABLES.items():
+            con.execute(f"CREATE TABLE IF NOT EXISTS {table} (day INTEGER NOT NULL, {column} TEXT NOT NULL, "
+                        f"articles INTEGER NOT NULL, PRIMARY KEY (day, {column})) WITHOUT ROWID")
+
+        last_rowid = get_watermark(con, WATERMARK)
+        max_rowid = con.execute("SELECT coalesce(max(rowid), 0) FROM newsdata").fetchone()[0]
+        if max_rowid < last_rowid:
+            # The table shrank, so it was rebuilt: start over
+            logger.warning(f"newsdata max rowid {max_rowid} is below the rollup watermark {last_rowid}, rebuilding")
+            last_rowid = 0
+            with con:
+                for table in ROLLUP_TABLES.values():
+                    con.execute(f"DELETE FROM {table}")
+        if max_rowid == last_rowid:
+            return 0
+
+        with con:
+            for column, table in ROLLUP_TABLES.items():
+                con.execute(f"INSERT INTO {table}(day, {column}, articles) "
+                            f"SELECT published_utc/86400, coalesce({column}, ''), count(id) FROM newsdata "
+                            f"WHERE rowid > ? AND rowid <= ? AND published_utc IS NOT NULL "
+                            f"GROUP BY published_utc/86400, coalesce({column}, '') "
+                            f"ON CONFLICT(day, {column}) DO UPDATE SET articles = articles + excluded.articles",
+                            (last_rowid, max_rowid))
+            set_watermark(con, WATERMARK, max_rowid)
+        logger.info(f"Rolled up newsdata rows {last_rowid + 1}..{max_rowid}")
+        return max_rowid - last_rowid
+    finally:
+        con.close()
+
+
+def has_rollups(path):
+    """
+    Returns `True` if the rollup tables of the database at `path` exist and are up to date.
+    """
+    con = get_connection(path)
+    tables = {name for name, in con.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if not set(ROLLUP_TABLES.values()) <= tables or "_watermarks" not in tables:
+        return False
+    max_rowid = con.execute("SELECT coalesce(max(rowid), 0) FROM newsdata").fetchone()[0]
+    return get_watermark(con, WATERMARK) == max_rowid
+
+
+def db_fingerprint(path):
+    """
+    Returns a tuple identifying the current state of the database file at `path` (and its WAL, if any).
+    """
+    path = Path(path).absolute()
+    fingerprint = [str(path)]
+    for p in (path, path.with_name(f"{path.name}-wal")):
+        if p.exists():
+            stat = p.stat()
+            fingerprint += [stat.st_size, stat.st_mtime_ns]
+    return tuple(fingerprint)
+
+
+@lru_cache(maxsize=64)
+def _cached_timeseries(fingerprint, days, group_by):
+    path = fingerprint[0]
+    table = ROLLUP_TABLES[group_by or "network"]
+    if group_by is not None:
+        query = f"SELECT day/:days as published_utc, date(min(day)*86400, 'unixepoch') as date, " \
+                f"sum(articles) as articles, nullif({group_by}, '') as {group_by} FROM {table} " \
+                f"GROUP BY day/:days, {group_by} ORDER BY published_utc, {group_by}"
+    else:
+        query = f"SELECT day/:days as published_utc, date(min(day)*86400, 'unixepoch') as date, " \
+                f"sum(articles) as articles FROM {table} GROUP BY day/:days ORDER BY published_utc"
+    return pd.read_sql_query(query, get_connection(path), params={"days": days})
+
+
+def get_timeseries(path, days=7, group_by="source"):
+    """
+    Same result as `plot.over_time.get_article_timeseries`, computed from the daily rollups.
+    Call `update_rollups` first. `date` is the first day with articles in each bucket.
+
+    Args:
+        path (str or Path) : Path to the NELA database.
+        days (int) : Size of the bucket (in days).
+        group_by (str) : `source`, `network` or `None`.
+
+    Returns:
+        r (DataFrame) : Columns `published_utc` (bucket index), `date`, `articles` and `group_by`.
+    """
+    if group_by is not None and group_by not in ROLLUP_TABLES:
+        raise ValueError(f"Cannot group by {group_by!r}. Expected one of {list(ROLLUP_TABLES)} or None.")
+    # Cached frames are shared, so hand out copies
+    return _cached_timeseries(db_fingerprint(path), days, group_by).copy()
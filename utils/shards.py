@@ -0,0 +1,263 @@
+"""
+Aggregate queries over NELA data split across several SQLite files (shards), e.g. yearly releases and incremental
+dumps.
+
+`ShardSet` runs the same aggregate query on each shard in worker processes, each with its own read-only connection,
+and merges the partial results: counts are summed per key, minimums and maximums are combined, and top-k rows are
+merged by score. The `published_utc` range and row count of each shard are kept in a metadata file, refreshed only
+for shards whose file changed, so a query restricted to a date range never opens the shards outside of it.
+"""
+import heapq
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pandas as pd
+
+from utils.db import get_connection, query_pandas
+from utils.fts import search
+from utils.instrument import span
+from utils.rollups import db_fingerprint
+
+
+logger = logging.getLogger(__name__)
+
+GROUP_BY_COLUMNS = ("source", "network")
+
+
+def shard_meta(path):
+    """
+    Returns the `published_utc` range (`min_utc`, `max_utc`, `None` if there are no timestamps) and number of `rows`
+    of the `newsdata` table of a shard.
+    """
+    min_utc, max_utc, rows = get_connection(path).execute(
+        "SELECT min(published_utc), max(published_utc), count(*) FROM newsdata").fetchone()
+    return {"min_utc": min_utc, "max_utc": max_utc, "rows": rows}
+
+
+def _where(start, end, networks, sources):
+    """
+    Returns the WHERE clause (possibly empty) and the parameters of the common query filters.
+    """
+    where, params = list(), list()
+    if start is not None:
+        where.append("published_utc >= ?")
+        params.append(start)
+    if end is not None:
+        where.append("published_utc < ?")
+        params.append(end)
+    if networks is not None:
+        where.append(f"network IN ({', '.join('?' * len(networks))})")
+        params += list(networks)
+    if sources is not None:
+        where.append(f"source IN ({', '.join('?' * len(sources))})")
+        params += list(sources)
+    return (f" WHERE {' AND '.join(where)}" if where else ""), params
+
+
+class ShardSet:
+    """
+    A set of NELA databases queried as one.
+
+    Shards are assumed to hold distinct articles (e.g. different collection periods), so counts from different shards
+    are added up.
+
+    Args:
+        paths (list[str or Path]) : Database files.
+        meta_path (str or Path) : JSON file caching the metadata of the shards (see `shard_meta`). If `None`, the
+            metadata is kept in memory only.
+        workers (int) : Worker processes per query (default: CPU count, at most one per shard).
+    """
+
+    def __init__(self, paths, meta_path=None, workers=None):
+        self.paths = [Path(p).absolute() for p in paths]
+        self.meta_path = Path(meta_path) if meta_path is not None else None
+        self.workers = workers
+        self.meta = dict()
+        if self.meta_path is not None and self.meta_path.exists():
+            with open(self.meta_path) as fin:
+                self.meta = json.load(fin)
+        self.refresh()
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Returns the shards listed in the `shards` section of the config: glob patterns relative to the data
+        directory (default: only `nela_ps_final.db`), with their metadata cached in the output directory.
+        """
+        settings = config.get("shards", None) or dict()
+        data_dir = Path(config.path.data)
+        paths = sorted({p for pattern in settings.get("paths", None) or ["nela_ps_final.db"]
+                        for p in data_dir.glob(pattern)})
+        meta_path = Path(config.path.output_dir).joinpath(settings.get("meta", "shards.json"))
+        return cls(paths, meta_path=meta_path, workers=settings.get("workers", None))
+
+    def refresh(self):
+        """
+        Compute the metadata of the shards that are new or changed since it was last computed.
+        """
+        fingerprints = {str(p): list(db_fingerprint(p)) for p in self.paths}
+        stale = [p for p in self.paths if self.meta.get(str(p), {}).get("fingerprint") != fingerprints[str(p)]]
+        if not stale:
+            return
+        with span("shards.refresh", shards=len(stale)):
+            for path, meta in zip(stale, self._map(shard_meta, [(str(p),) for p in stale])):
+                self.meta[str(path)] = {**meta, "fingerprint": fingerprints[str(path)]}
+        if self.meta_path is not None:
+            self.meta_path.parent.mkdir(exist_ok=True, parents=True)
+            tmp_path = self.meta_path.with_name(f"{self.meta_path.name}.tmp")
+            with open(tmp_path, "w") as fout:
+                json.dump(self.meta, fout, indent=1)
+            os.replace(tmp_path, self.meta_path)
+        logger.info(f"Updated the metadata of {len(stale)} of {len(self.paths)} shards")
+
+    def shards(self, start=None, end=None):
+        """
+        Returns the shards that may hold articles published in [`start`, `end`) (UTC timestamps).
+        """
+        if start is None and end is None:
+            return list(self.paths)
+        selected = list()
+        for path in self.paths:
+            meta = self.meta[str(path)]
+            if meta["min_utc"] is None:
+                continue  # No timestamps, so no article in any range
+            if start is not None and meta["max_utc"] < start:
+                continue
+            if end is not None and meta["min_utc"] >= end:
+                continue
+            selected.append(path)
+        return selected
+
+    def _map(self, func, args):
+        """
+        Returns `func(*a)` for each `a` in `args`, in order, computed in worker processes if there are several.
+        """
+        args = list(args)
+        workers = min(self.workers or os.cpu_count() or 1, len(args))
+        if workers <= 1:
+            return [func(*a) for a in args]
+        results = [None] * len(args)
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+            futures = {executor.submit(func, *a): i for i, a in enumerate(args)}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        return results
+
+    def query(self, sql, params=(), start=None, end=None):
+        """
+        Run a query on each shard that may hold articles published in [`start`, `end`).
+
+        The range only prunes shards: the query must filter rows by itself.
+
+        Returns:
+            results (list[DataFrame]) : Result of each queried shard.
+        """
+        shards = self.shards(start, end)
+        logger.debug(f"Querying {len(shards)} of {len(self.paths)} shards")
+        with span("shards.query", shards=len(shards)):
+            return self._map(query_pandas, [(str(p), sql, params) for p in shards])
+
+    def aggregate(self, sql, params=(), by=(), agg=None, start=None, end=None):
+        """
+        Run an aggregate query on each shard and merge the partial results by key.
+
+        Args:
+            sql (str) : Query returning the columns `by` and the aggregates in `agg`.
+            params (tuple or dict) : Query parameters.
+            by (list[str]) : Key columns. Partial results with the same key are merged.
+            agg (dict[str,str]) : How to merge each aggregate column: 'sum' (counts and sums), 'min' or 'max'.
+                Averages must be computed from merged sums and counts.
+            start (int) : Prune shards without articles published at or after this UTC timestamp.
+            end (int) : Prune shards without articles published before this UTC timestamp.
+
+        Returns:
+            r (DataFrame) : Merged results, with one row per key, sorted by key.
+        """
+        by, agg = list(by), dict(agg or dict())
+        parts = [df for df in self.query(sql, params, start=start, end=end) if len(df)]
+        if not parts:
+            return pd.DataFrame(columns=by + list(agg))
+        df = pd.concat(parts, ignore_index=True)
+        if not by:
+            return df.agg(agg).to_frame().T
+        # NULL keys are a group of their own, as in SQL
+        return df.groupby(by, dropna=False, sort=True).agg(agg).reset_index()
+
+    def count_by(self, column, start=None, end=None, networks=None, sources=None):
+        """
+        Count articles per value of `column` (`source` or `network`) across shards.
+
+        Returns:
+            counts (Series) : Article counts indexed by value, in descending order.
+        """
+        if column not in GROUP_BY_COLUMNS:
+            raise ValueError(f"Cannot group by {column!r}. Expected one of {GROUP_BY_COLUMNS}.")
+        where, params = _where(start, end, networks, sources)
+        r = self.aggregate(f"SELECT {column}, count(*) AS articles FROM newsdata{where} GROUP BY {column}", params,
+                           by=[column], agg={"articles": "sum"}, start=start, end=end)
+        counts = r.set_index(column)["articles"].astype("int64")
+        return counts.sort_values(ascending=False, kind="stable")
+
+    def top_k(self, column, k=10, start=None, end=None, networks=None, sources=None):
+        """
+        Returns the `k` values of `column` with the most articles across shards.
+
+        A group can be small in every shard and large overall, so the full per-shard counts are merged before the
+        top `k` are taken.
+        """
+        return self.count_by(column, start=start, end=end, networks=networks, sources=sources).head(k)
+
+    def get_timeseries(self, days=7, group_by="source", start=None, end=None, networks=None):
+        """
+        Number of articles per bucket of `days` (and per `group_by` value) across shards, as returned by
+        `plot.over_time.get_article_timeseries`.
+
+        Args:
+            days (int) : Size of the bucket (in days).
+            group_by (str) : `source`, `network` or `None`.
+            start (int) : Minimum `published_utc` (inclusive).
+            end (int) : Maximum `published_utc` (exclusive).
+            networks (list[str]) : Only count articles from these networks.
+
+        Returns:
+            r (DataFrame) : Columns `published_utc` (bucket index), `date` (bucket start), `articles` and
+                `group_by`, sorted by bucket.
+        """
+        if group_by is not None and group_by not in GROUP_BY_COLUMNS:
+            raise ValueError(f"Cannot group by {group_by!r}. Expected one of {GROUP_BY_COLUMNS} or None.")
+        seconds = 60*60*24*days
+        where, params = _where(start, end, networks, None)
+        where = f"{where} AND published_utc IS NOT NULL" if where else " WHERE published_utc IS NOT NULL"
+        keys = ["published_utc"] + ([group_by] if group_by is not None else [])
+        columns = f", {group_by}" if group_by is not None else ""
+        r = self.aggregate(f"SELECT published_utc/{seconds} AS published_utc{columns}, count(*) AS articles "
+                           f"FROM newsdata{where} GROUP BY published_utc/{seconds}{columns}", params,
+                           by=keys, agg={"articles": "sum"}, start=start, end=end)
+        r["published_utc"] = r["published_utc"].astype("int64")
+        r["articles"] = r["articles"].astype("int64")
+        buckets = r["published_utc"].to_numpy() * seconds
+        r.insert(1, "date", buckets.astype("datetime64[s]").astype("datetime64[D]").astype(str))
+        return r
+
+    def search(self, query, k=20, start=None, end=None, networks=None, sources=None):
+        """
+        Returns the `k` best full-text matches across shards, best first (see `utils.fts.search`). The full-text
+        index of each shard must be up to date (see `utils.fts.update_fts`).
+
+        BM25 scores depend on statistics of each shard's index, so scores from different shards are comparable only
+        when the shards have similar contents.
+        """
+        shards = self.shards(start, end)
+        args = [(str(p), query, networks, sources, start, end, True, 0, k) for p in shards]
+        with span("shards.search", shards=len(shards)):
+            parts = [df.assign(shard=str(p)) for p, df in zip(shards, self._map(search, args)) if len(df)]
+        if not parts:
+            return pd.DataFrame()
+        # Each shard returns its own top k sorted by score, so the top k overall are among them
+        rows = heapq.merge(*(df.to_dict("records") for df in parts), key=lambda row: row["score"])
+        return pd.DataFrame([row for _, row in zip(range(k), rows)])